@@ -14,14 +14,33 @@
 # with linesman.  If not, see <http://www.gnu.org/licenses/>.
 #
 import logging
+import sys
+import time
 import uuid
 from inspect import getmodule
 
 import networkx as nx
 
+from linesman.callgraph import CallGraph
 
 log = logging.getLogger(__name__)
 
+# Resolving the module of a code object means scanning `sys.modules', so
+# resolved keys are cached for the lifetime of the process.
+KEY_CACHE_MAX_SIZE = 100000
+_key_cache = {}
+_key_cache_module_count = None
+
+
+def clear_key_cache():
+    """
+    Empties the cache used by :func:`_generate_key`.  This normally happens
+    automatically, whenever modules are imported or removed.
+    """
+    global _key_cache_module_count
+    _key_cache.clear()
+    _key_cache_module_count = None
+
 
 def _generate_key(stat):
     code = stat.code
@@ -30,6 +49,23 @@ def _generate_key(stat):
     if isinstance(code, str):
         return code
 
+    # Keys are cached per code object.  Reloading a module creates new code
+    # objects, so those are resolved again; a change to the set of loaded
+    # modules could change how any code object resolves, so that clears the
+    # whole cache.
+    global _key_cache_module_count
+    if (_key_cache_module_count != len(sys.modules) or
+            len(_key_cache) >= KEY_CACHE_MAX_SIZE):
+        _key_cache.clear()
+        _key_cache_module_count = len(sys.modules)
+
+    key = _key_cache.get(code)
+    if key is None:
+        key = _key_cache[code] = _resolve_key(code)
+    return key
+
+
+def _resolve_key(code):
     # If we have a module, generate the module name (a.b.c, etc..)
     module = getmodule(code)
     if module:
@@ -52,59 +88,54 @@ def draw_graph(graph, output_path):
     log.info("Wrote output to `%s'" % output_path)
 
 
-def create_graph(stats):
+def create_call_graph(stats):
     """
     Given an instance of :class:`pstats.Pstats`, this will use the generated
-    call data to create a graph using the :mod:`networkx` library.  Node
-    and edge information is stored in the graph itself, so that the stats
-    object itself--which can't be pickled--does not need to be kept around.
+    call data to create a compact :class:`~linesman.callgraph.CallGraph`.
+    Node and edge information is stored in the graph itself, so that the
+    stats object itself--which can't be pickled--does not need to be kept
+    around.
 
     ``stats``:
         An instance of :class:`pstats.Pstats`, usually retrieved by calling
         :func:`~cProfile.Profile.getstats()` on a cProfile object.
 
-    Returns a :class:`networkx.DiGraph` containing the callgraph.
+    Returns a :class:`~linesman.callgraph.CallGraph` containing the callgraph.
     """
-
-    # Create a graph; dot graphs need names, so just use `G' so that
-    # pygraphviz doesn't complain when we render it.
-    g = nx.DiGraph(name="G")
+    nodes = {}
+    edges = {}
 
     # Iterate through stats to add the original nodes.  The will add ALL
     # the nodes, even ones which might be pruned later.  This is so that
     # the library will always have the original callgraph, which can be
     # manipulated for display purposes later.
-    duration = max([stat.totaltime for stat in stats])
-
     for stat in stats:
         caller_key = _generate_key(stat)
-
-        attrs = {
-            'callcount': stat.callcount,
-            'inlinetime': stat.inlinetime,
-            'reccallcount': stat.reccallcount,
-            'totaltime': stat.totaltime,
-        }
-        g.add_node(caller_key, attr_dict=attrs)
+        nodes[caller_key] = (stat.callcount, stat.reccallcount,
+                             stat.inlinetime, stat.totaltime)
 
         # Add all the calls as edges
         for call in stat.calls or []:
             callee_key = _generate_key(call)
+            edges[(caller_key, callee_key)] = (
+                call.callcount, call.reccallcount,
+                call.inlinetime, call.totaltime)
 
-            call_attrs = {
-                'callcount': call.callcount,
-                'inlinetime': call.inlinetime,
-                'reccallcount': call.reccallcount,
-                'totaltime': call.totaltime,
-            }
+    return CallGraph.from_dicts(nodes, edges)
 
-            # Add the edge using a weight and label
-            g.add_edge(caller_key, callee_key,
-                       weight=call.totaltime,
-                       label=call.totaltime,
-                       attr_dict=call_attrs)
 
-    return g
+def create_graph(stats):
+    """
+    Given an instance of :class:`pstats.Pstats`, this will use the generated
+    call data to create a graph using the :mod:`networkx` library.
+
+    ``stats``:
+        An instance of :class:`pstats.Pstats`, usually retrieved by calling
+        :func:`~cProfile.Profile.getstats()` on a cProfile object.
+
+    Returns a :class:`networkx.DiGraph` containing the callgraph.
+    """
+    return create_call_graph(stats).to_networkx()
 
 
 class ProfilingSession(object):
@@ -128,23 +159,120 @@ class ProfilingSession(object):
         if your choosing; however, the default templates simply invoke
         ``timestamp.__repr__``, so whatever object you use should provide at
         _least_ that function.
+    ``duration``:
+        Total profiled time, in seconds.  If not specified, this is the
+        longest time spent in any single function in ``stats``.
+    ``time_to_first_byte``:
+        If specified, the time in seconds until the first chunk of the
+        response body was produced.
+    ``body_time``:
+        If specified, the time in seconds spent producing the response body
+        after the application returned.
+    ``status``:
+        If specified, the HTTP status code of the response.
+    ``endpoint``:
+        If specified, the normalized route of the request, such as
+        `/users/{id}`; see :class:`~linesman.routing.RouteNormalizer`.
+        Defaults to the request path.
     """
 
-    def __init__(self, stats, environ={}, timestamp=None):
-        self._graph = None
+    # Sessions pickled by older versions won't have these attributes.
+    time_to_first_byte = None
+    body_time = None
+    graph_build_time = None
+    method = None
+    status = None
+    endpoint = None
+
+    def __init__(self, stats, environ={}, timestamp=None, duration=None,
+                 time_to_first_byte=None, body_time=None, status=None,
+                 endpoint=None):
         self._uuid = uuid.uuid1()
 
         # Save some environment variables (if available)
         self.path = environ.get('PATH_INFO')
+        self.method = environ.get('REQUEST_METHOD')
+        self.status = status
+        self.endpoint = endpoint if endpoint is not None else self.path
 
         # Some profiling session attributes need to be calculated
-        self.duration = max([stat.totaltime for stat in stats])
+        if duration is None:
+            duration = max([stat.totaltime for stat in stats])
+        self.duration = duration
+        self.time_to_first_byte = time_to_first_byte
+        self.body_time = body_time
 
         self.timestamp = timestamp
 
-        self._graph = create_graph(stats)
+        # Keep track of how long it takes to build the graph, since that's
+        # the bulk of the cost of creating a session.
+        start_time = time.time()
+        self._callgraph = create_call_graph(stats)
+        self.graph_build_time = time.time() - start_time
+        log.debug("Built callgraph for `%s' in %fs.", self.path,
+                  self.graph_build_time)
+
+    def __getstate__(self):
+        # The networkx graph is only a cache of the callgraph.
+        state = self.__dict__.copy()
+        state.pop('_graph_cache', None)
+        return state
+
+    def __setstate__(self, state):
+        # Older versions stored the callgraph as a networkx graph.
+        if '_graph' in state:
+            state['_callgraph'] = CallGraph.from_networkx(state.pop('_graph'))
+        self.__dict__.update(state)
+
+    @property
+    def _graph(self):
+        """
+        A :class:`networkx.DiGraph` of this session's callgraph.  The graph
+        is built on first access and kept until the callgraph is replaced.
+        Changes made to it aren't kept, so assign a new graph instead.
+        """
+        cached = self.__dict__.get('_graph_cache')
+        if cached is None or cached[0] is not self._callgraph:
+            cached = (self._callgraph, self._callgraph.to_networkx())
+            self._graph_cache = cached
+        return cached[1]
+
+    @_graph.setter
+    def _graph(self, graph):
+        self._callgraph = CallGraph.from_networkx(graph)
+        self._graph_cache = (self._callgraph, graph)
 
     @property
     def uuid(self):
         """ See :term:`session_uuid`. """
         return str(self._uuid)
+
+    def summary(self):
+        """
+        Returns a :class:`SessionSummary` of this session.
+        """
+        endpoint = self.endpoint if self.endpoint is not None else self.path
+        return SessionSummary(self.uuid, self.path, self.duration,
+                              self.timestamp, self.method, self.status,
+                              len(self._callgraph), endpoint)
+
+
+class SessionSummary(object):
+    """
+    Describes a stored session without its callgraph, which is all that is
+    needed to list sessions.  See :meth:`ProfilingSession.summary`.
+    """
+
+    def __init__(self, uuid, path, duration, timestamp, method=None,
+                 status=None, node_count=None, endpoint=None):
+        self.uuid = uuid
+        self.path = path
+        self.duration = duration
+        self.timestamp = timestamp
+        self.method = method
+        self.status = status
+        self.node_count = node_count
+        self.endpoint = endpoint
+
+    def __repr__(self):
+        return "<SessionSummary %s %s>" % (self.uuid, self.path)
@@ -0,0 +1,216 @@
+# This file is part of linesman.
+#
+# linesman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# linesman is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with linesman.  If not, see <http://www.gnu.org/licenses/>.
+#
+import copy
+import hashlib
+import logging
+import time
+from datetime import datetime
+
+from linesman.callgraph import CallGraph, FIELDS
+from linesman.windows import WindowedStore
+
+
+log = logging.getLogger(__name__)
+
+# Aggregates are stored by the backend under keys starting with this.
+STATE_PREFIX = "aggregate:"
+
+# Aggregates can be viewed like sessions, using ids starting with this.
+AGGREGATE_ID_PREFIX = "agg-"
+
+
+def aggregate_id(endpoint, bucket_start):
+    """
+    Returns the id of the aggregate of ``endpoint`` for the window starting
+    at ``bucket_start``, which is safe to use in URLs and file names.
+    """
+    digest = hashlib.sha1((u"%s\0%d" % (endpoint, bucket_start))
+                          .encode("utf8"))
+    return "%s%s" % (AGGREGATE_ID_PREFIX, digest.hexdigest()[:16])
+
+
+class AggregateProfile(object):
+    """
+    The summed callgraphs of every session of an endpoint within a window of
+    time.  Each session is folded in by :meth:`add`, which only walks that
+    session's callgraph.
+
+    Aggregates can be displayed by the same pages as sessions, and so have
+    the same attributes that those use.  The ``duration`` of an aggregate is
+    the total duration of its sessions, so that the summed time of each
+    function is shown as a share of the total time spent on the endpoint.
+
+    ``endpoint``:
+        Normalized route of the sessions; see
+        :class:`~linesman.routing.RouteNormalizer`.
+    ``bucket_start``:
+        Start of the window, in seconds since the epoch.
+    ``bucket_seconds``:
+        Length of the window, in seconds.
+    """
+
+    time_to_first_byte = None
+    body_time = None
+    graph_build_time = None
+    method = None
+    status = None
+
+    def __init__(self, endpoint, bucket_start, bucket_seconds):
+        self.endpoint = endpoint
+        self.bucket_start = bucket_start
+        self.bucket_seconds = bucket_seconds
+        self.session_count = 0
+        self.duration = 0.0
+        self.max_duration = 0.0
+        # Summed values of every node and edge, in the order of `FIELDS'.
+        self.nodes = {}
+        self.edges = {}
+
+    def __deepcopy__(self, memo):
+        # The values are plain numbers, so copying the lists is enough, and
+        # much faster than copying every value.
+        other = copy.copy(self)
+        other.nodes = dict((key, list(values))
+                           for key, values in self.nodes.iteritems())
+        other.edges = dict((key, list(values))
+                           for key, values in self.edges.iteritems())
+        return other
+
+    @property
+    def id(self):
+        """
+        Id of this aggregate; see :func:`aggregate_id`.
+        """
+        return aggregate_id(self.endpoint, self.bucket_start)
+
+    @property
+    def uuid(self):
+        """
+        Id of this revision of the aggregate.  This changes whenever a
+        session is added, so that views and graphs cached by uuid are not
+        reused once they are out of date.
+        """
+        return "%s-%d" % (self.id, self.session_count)
+
+    @property
+    def path(self):
+        return self.endpoint
+
+    @property
+    def timestamp(self):
+        return datetime.fromtimestamp(self.bucket_start)
+
+    @property
+    def mean_duration(self):
+        if not self.session_count:
+            return 0.0
+        return self.duration / self.session_count
+
+    def add(self, session):
+        """
+        Adds the callgraph and duration of ``session`` to this aggregate.
+        """
+        callgraph = session._callgraph
+        keys = callgraph.keys
+        has_stats = callgraph.has_stats
+        node_values = callgraph.node_values
+        edge_values = callgraph.edge_values
+
+        nodes = self.nodes
+        for i, key in enumerate(keys):
+            if not has_stats[i]:
+                continue
+            totals = nodes.get(key)
+            if totals is None:
+                totals = nodes[key] = [0] * len(FIELDS)
+            for f, column in enumerate(node_values):
+                totals[f] += column[i]
+
+        edges = self.edges
+        for i, target, j in callgraph.edges():
+            edge = (keys[i], keys[target])
+            totals = edges.get(edge)
+            if totals is None:
+                totals = edges[edge] = [0] * len(FIELDS)
+            for f, column in enumerate(edge_values):
+                totals[f] += column[j]
+
+        self.session_count += 1
+        self.duration += session.duration or 0
+        self.max_duration = max(self.max_duration, session.duration or 0)
+
+    @property
+    def _callgraph(self):
+        return CallGraph.from_dicts(self.nodes, self.edges)
+
+    @property
+    def _graph(self):
+        """
+        A new :class:`networkx.DiGraph` of the summed callgraph.  Unlike
+        :attr:`ProfilingSession._graph`, it isn't kept, since the sums change
+        as sessions are added.
+        """
+        return self._callgraph.to_networkx()
+
+
+class AggregateStore(WindowedStore):
+    """
+    Folds stored sessions into an :class:`AggregateProfile` per endpoint and
+    window of time; see :class:`~linesman.windows.WindowedStore`.
+    """
+
+    state_prefix = STATE_PREFIX
+
+    def create(self, endpoint, bucket_start):
+        return AggregateProfile(endpoint, bucket_start, self.bucket_seconds)
+
+    def window_id(self, endpoint, bucket_start):
+        return aggregate_id(endpoint, bucket_start)
+
+    def add(self, session):
+        """
+        Adds ``session`` to the aggregate of its endpoint for the window it
+        started in.
+        """
+        endpoint = session.endpoint
+        if endpoint is None:
+            endpoint = session.path
+        if session.timestamp:
+            timestamp = time.mktime(session.timestamp.timetuple())
+        else:
+            timestamp = time.time()
+        super(AggregateStore, self).add(endpoint, timestamp, session)
+
+    def get(self, id):
+        """
+        Returns the aggregate with the id or uuid ``id``, or `None` if there
+        is no such aggregate.  A uuid only matches the current revision of
+        the aggregate, since older ones aren't kept.
+        """
+        digest, _, revision = id[len(AGGREGATE_ID_PREFIX):].partition("-")
+        aggregate = super(AggregateStore, self).get(AGGREGATE_ID_PREFIX +
+                                                    digest)
+        if aggregate is not None and revision and \
+                revision != str(aggregate.session_count):
+            return None
+        return aggregate
+
+
+def is_aggregate_id(id):
+    """
+    Returns True if ``id`` refers to an aggregate rather than a session.
+    """
+    return id.startswith(AGGREGATE_ID_PREFIX)
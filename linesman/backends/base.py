@@ -13,6 +13,51 @@
 # You should have received a copy of the GNU General Public License along
 # with linesman.  If not, see <http://www.gnu.org/licenses/>.
 #
+from itertools import islice
+
+
+# Summary fields that sessions can be ordered by.
+SUMMARY_ORDERS = ("timestamp", "duration", "path", "endpoint")
+
+
+def filter_summaries(summaries, order_by="timestamp", descending=False,
+                     path_prefix=None, min_duration=None, since=None,
+                     until=None, limit=None, offset=0, after=None):
+    """
+    Filters, orders and pages a list of :class:`~linesman.SessionSummary`
+    objects in memory, as described by :meth:`Backend.iter_summaries`.
+    """
+    if order_by not in SUMMARY_ORDERS:
+        raise ValueError("Cannot order sessions by %r" % order_by)
+
+    if min_duration is not None:
+        min_duration = float(min_duration)
+
+    def matches(summary):
+        return ((path_prefix is None or
+                 (summary.path or "").startswith(path_prefix)) and
+                (min_duration is None or summary.duration >= min_duration) and
+                (since is None or summary.timestamp >= since) and
+                (until is None or summary.timestamp < until))
+
+    def sort_key(summary):
+        return getattr(summary, order_by), summary.uuid
+
+    summaries = sorted((summary for summary in summaries
+                        if matches(summary)),
+                       key=sort_key, reverse=descending)
+    if after is not None:
+        # Sessions without a value to order by are never after anything,
+        # which matches how SQL compares NULLs.
+        after = tuple(after)
+        summaries = [summary for summary in summaries
+                     if getattr(summary, order_by) is not None and
+                     (sort_key(summary) < after if descending
+                      else sort_key(summary) > after)]
+
+    offset = int(offset or 0)
+    stop = offset + int(limit) if limit is not None else None
+    return islice(summaries, offset, stop)
 
 
 class Backend(object):
@@ -22,6 +67,11 @@ class Backend(object):
     pass are optional.
     """
 
+    #: Called with a list of session uuids that the backend is about to evict
+    #: on its own, such as for its retention limits, while they can still be
+    #: loaded.
+    on_evict = None
+
     def __init__(self, *args, **kwargs):
         pass
 
@@ -34,10 +84,38 @@ class Backend(object):
         """
         raise NotImplementedError()
 
+    def close(self):
+        """
+        Releases any resources, such as open files or connections, held by
+        the backend.  This is run when the middleware is shut down.
+        """
+        pass
+
+    def enforce_retention(self):
+        """
+        Evicts stored sessions that are outside of the backend's retention
+        limits, if it has any.  Backends that support retention should call
+        this whenever a session is added.
+
+        This should return the number of sessions evicted.
+        """
+        return 0
+
+    def _evicting(self, session_uuids):
+        """
+        Passes ``session_uuids`` to :attr:`on_evict`, if it's set.  Backends
+        should call this before evicting sessions.
+        """
+        if session_uuids and self.on_evict is not None:
+            self.on_evict(session_uuids)
+
     def add(self, session):
         """
         Store a new session in history.
 
+        Backends that decide not to keep some sessions, such as when only the
+        slowest sessions are kept, should return False for those.
+
         Raises a :class:`NotImplementedError` exception.
         """
         raise NotImplementedError()
@@ -89,3 +167,105 @@ class Backend(object):
         Raises a :class:`NotImplementedError` exception.
         """
         raise NotImplementedError()
+
+    def get_summaries(self):
+        """
+        Returns a list of :class:`~linesman.SessionSummary` objects for ALL
+        sessions, oldest first.  This is used to list sessions without the
+        expense of loading their callgraphs.
+
+        By default, this is built from :meth:`get_all`; backends that can
+        retrieve summaries without loading every session should override it.
+        """
+        return [session.summary() for session in self.get_all().values()]
+
+    def iter_summaries(self, order_by="timestamp", descending=False,
+                       path_prefix=None, min_duration=None, since=None,
+                       until=None, limit=None, offset=0, after=None):
+        """
+        Returns an iterator of :class:`~linesman.SessionSummary` objects,
+        filtered and ordered as requested.  Backends should yield these as
+        they are read, so that any number of sessions can be listed in
+        constant memory.
+
+        ``order_by``:
+            One of :data:`SUMMARY_ORDERS`.  Ties are ordered by uuid.
+        ``descending``:
+            If true, the largest or newest sessions come first.
+        ``path_prefix``:
+            Only include sessions whose path starts with this.
+        ``min_duration``:
+            Only include sessions that took at least this many seconds.
+        ``since``, ``until``:
+            Only include sessions whose timestamp is within this range of
+            :class:`datetime.datetime` objects.
+        ``limit``, ``offset``:
+            Maximum number of sessions to return, after skipping ``offset``
+            sessions.
+        ``after``:
+            An `(order_by value, uuid)` tuple of the last session of the
+            previous page.  Only sessions that come after it are included,
+            which is cheaper than using ``offset`` for later pages.
+
+        By default, this filters the result of :meth:`get_summaries` in
+        memory.
+        """
+        return filter_summaries(self.get_summaries(), order_by, descending,
+                                path_prefix, min_duration, since, until,
+                                limit, offset, after)
+
+    def count_summaries(self, path_prefix=None, min_duration=None,
+                        since=None, until=None):
+        """
+        Returns the number of sessions that match the filters of
+        :meth:`iter_summaries`.
+        """
+        return sum(1 for summary in self.iter_summaries(
+            path_prefix=path_prefix, min_duration=min_duration, since=since,
+            until=until))
+
+    def save_state(self, key, value):
+        """
+        Stores ``value`` under ``key``, replacing any previous value.  This
+        is used for state that isn't tied to a single session, such as
+        aggregate profiles; ``value`` can be any picklable object.
+
+        By default, state is only kept in memory, and is lost when the
+        process exits.  Backends should override this, along with
+        :meth:`load_state`, :meth:`iter_states` and :meth:`delete_state`, to
+        persist it.
+        """
+        self._memory_states()[key] = value
+
+    def load_state(self, key, default=None):
+        """
+        Returns the value stored under ``key`` by :meth:`save_state`, or
+        ``default`` if there is none.
+        """
+        return self._memory_states().get(key, default)
+
+    def iter_states(self, prefix=""):
+        """
+        Yields a `(key, value)` tuple for every stored state whose key
+        starts with ``prefix``, ordered by key.
+        """
+        states = self._memory_states()
+        for key in sorted(states):
+            if key.startswith(prefix):
+                yield key, states[key]
+
+    def delete_state(self, key):
+        """
+        Removes the state stored under ``key``.
+
+        This should return the number of states removed (0 or 1).
+        """
+        return int(self._memory_states().pop(key, None) is not None)
+
+    def _memory_states(self):
+        # Subclasses don't necessarily call `Backend.__init__', so the
+        # dictionary is created on first use.
+        states = self.__dict__.get('_states')
+        if states is None:
+            states = self.__dict__['_states'] = {}
+        return states
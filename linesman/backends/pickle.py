@@ -15,8 +15,15 @@
 #
 import cPickle
 import logging
+import os
+import struct
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
 
+from linesman.backends import serialization
 from linesman.backends.base import Backend
+from linesman.backends.retention import EndpointReservoir, RetentionPolicy
 
 
 try:
@@ -26,90 +33,526 @@ except ImportError: #pragma no cover
     # Python 2.4+
     from ordereddict import OrderedDict
 
+try:
+    import fcntl
+except ImportError: #pragma no cover
+    # Without file locks, the log can't be shared between processes.
+    fcntl = None
+
 
 log = logging.getLogger(__name__)
 
+# Every log starts with this, which tells it apart from the single pickled
+# dictionary written by older versions.
+MAGIC = "LINESMAN-LOG\x01\n"
+
+# Every record starts with its type, the length of its key and the length of
+# its body.  The key is a pickled `(uuid, summary)' tuple for sessions, and a
+# pickled uuid for tombstones, which have no body.
+RECORD_HEADER = struct.Struct(">cII")
+SESSION_RECORD = "S"
+TOMBSTONE_RECORD = "D"
+
+# Where a live session is stored in the log.  Its pickled body is the last
+# ``body_size`` bytes of the record.
+_Record = namedtuple("_Record", "offset size body_size summary")
+
 
 class PickleBackend(Backend):
     """
-    Stores entire session as a pickled object.  This can be extremely slow when
-    using even smaller sets of sessions--on the order of 30mb, or around 200
-    requests.
+    Stores pickled sessions in an append-only log file.  Adding or deleting
+    a session only ever appends a single record to the end of the file, while
+    an index of where each session is stored is kept in memory and rebuilt
+    from the log on startup.
+
+    Deleted sessions are left in the log until it is compacted, which
+    happens periodically in the background once enough of the file is taken
+    up by deleted sessions.
+
+    The log can be shared by several processes, such as the workers of a
+    prefork server.  Records are appended while holding a lock on a
+    ``.lock`` file next to the log, and each process reads the records
+    appended by the others before using its index.  Compacting or clearing
+    the log replaces the file, which the other processes then reload.  The
+    sessions kept by ``keep_slowest`` are tracked by each process
+    separately, though.
     """
 
-    def __init__(self, filename="sessions.dat"):
+    def __init__(self, filename="sessions.dat", compact_interval=300,
+                 compact_ratio=0.5, compression="none",
+                 compression_level=None, max_sessions=None, max_size_mb=None,
+                 max_age=None, keep_slowest=None, reservoir_size=None):
+        """
+        ``filename``:
+            filename of the log.  Files written by older versions, which
+            pickled every session into a single dictionary, are converted
+            on startup.
+        ``compact_interval``:
+            Number of seconds between checks for whether the log should be
+            compacted.  If `0`, the log is never compacted automatically.
+        ``compact_ratio``:
+            Fraction of the log that must be taken up by deleted sessions
+            before it is compacted.
+        ``compression``:
+            Codec used to compress stored sessions; one of `none`, `zlib`,
+            `bz2` or `lzma`.  Sessions are always readable, whichever codec
+            they were stored with.
+        ``compression_level``:
+            Compression level passed to the codec, if not its default.
+        ``max_sessions``, ``max_size_mb``, ``max_age``:
+            Retention limits, enforced whenever a session is added; see
+            :class:`~linesman.backends.retention.RetentionPolicy`.  Evicted
+            sessions are removed from the file when the log is compacted.
+        ``keep_slowest``, ``reservoir_size``:
+            If either is set, only the slowest sessions of each endpoint and
+            a random sample of the others are kept; see
+            :class:`~linesman.backends.retention.EndpointReservoir`.
+        """
         self.filename = filename
+        self.compact_interval = float(compact_interval)
+        self.compact_ratio = float(compact_ratio)
+        self.codec = serialization.get_codec(compression)
+        self.compression_level = compression_level
+        self.retention = RetentionPolicy(max_sessions, max_size_mb, max_age)
+        self.reservoir = EndpointReservoir(keep_slowest, reservoir_size)
 
-    def _flush(self):
+        self._fd = None
+        self._lock_fd = None
+        self._lock_depth = 0
+        self._index = OrderedDict()
+        self._size = 0
+        self._garbage = 0
+        self._lock = threading.RLock()
+        self._stop_compacting = threading.Event()
+        self._compactor = None
+
+    def setup(self):
         """
-        Writes the session history to disk, in pickled form.
+        Opens the log at ``filename``, creating it if needed, and rebuilds
+        the index of the sessions stored in it.
         """
-        with open(self.filename, "w+b") as pickle_fd:
-            cPickle.dump(self._session_history,
-                        pickle_fd,
-                        cPickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            if self._fd is not None:
+                self._fd.close()
+                self._fd = None
+            if self._lock_fd is None:
+                self._lock_fd = open(self.filename + ".lock", "a")
 
-    def setup(self):
+            with self._locked(exclusive=True):
+                if not os.path.exists(self.filename):
+                    log.debug("`%s' does not exist; creating a new log.",
+                              self.filename)
+                    self._create(self.filename, [])
+                else:
+                    with open(self.filename, "rb") as fd:
+                        magic = fd.read(len(MAGIC))
+                    if not magic:
+                        self._create(self.filename, [])
+                    elif magic != MAGIC:
+                        self._convert_legacy()
+
+                # Records are always appended, whatever the file position.
+                self._fd = open(self.filename, "a+b")
+                self._load_index()
+                if self._fd.tell() > self._size:
+                    # The last record was only partly written, most likely
+                    # because the process died while writing it.
+                    log.warning("Discarding incomplete record at the end "
+                                "of `%s'.", self.filename)
+                    self._fd.truncate(self._size)
+
+            if self.reservoir.enabled:
+                self.delete_many(self.reservoir.load(self.get_summaries()))
+
+        if self.compact_interval > 0 and self._compactor is None:
+            self._stop_compacting.clear()
+            self._compactor = threading.Thread(target=self._compact_loop,
+                                               name="linesman-compactor")
+            self._compactor.daemon = True
+            self._compactor.start()
+
+    def close(self):
+        """
+        Stops the compaction thread and closes the log.
         """
-        Reads in pickled data from ``filename``.
+        self._stop_compacting.set()
+        if self._compactor is not None:
+            self._compactor.join()
+            self._compactor = None
+
+        with self._lock:
+            if self._fd is not None:
+                self._fd.close()
+                self._fd = None
+            if self._lock_fd is not None:
+                self._lock_fd.close()
+                self._lock_fd = None
+
+    @contextmanager
+    def _locked(self, exclusive=False):
         """
+        Holds the lock, along with a lock on the log shared with other
+        processes, which is exclusive if ``exclusive`` is true.  The index
+        is first brought up to date with any changes the other processes
+        made to the log.
+        """
+        with self._lock:
+            self._lock_depth += 1
+            try:
+                if self._lock_depth == 1:
+                    if fcntl is not None:
+                        fcntl.flock(self._lock_fd, fcntl.LOCK_EX if exclusive
+                                    else fcntl.LOCK_SH)
+                    if self._fd is not None:
+                        self._sync()
+                yield
+            finally:
+                self._lock_depth -= 1
+                if self._lock_depth == 0 and fcntl is not None:
+                    fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def _sync(self):
+        """
+        Adds the records appended by other processes to the index, or
+        reloads it if another process replaced the log by compacting or
+        clearing it.
+        """
+        if os.fstat(self._fd.fileno()).st_ino != \
+                os.stat(self.filename).st_ino:
+            self._fd.close()
+            self._fd = open(self.filename, "a+b")
+            self._load_index()
+        else:
+            self._read_records()
+
+    def _create(self, filename, sessions):
+        """
+        Writes a new log containing ``sessions`` to ``filename``.
+        """
+        with open(filename, "wb") as fd:
+            fd.write(MAGIC)
+            for session in sessions:
+                fd.write(self._session_record(session))
+
+    def _convert_legacy(self):
+        """
+        Converts the single pickled dictionary written by older versions
+        into a log.
+        """
+        log.info("Converting `%s' to the log format; this may take a while.",
+                 self.filename)
         try:
-            with open(self.filename, "rb") as pickle_fd:
-                self._session_history = cPickle.load(pickle_fd)
-        except IOError:
-            log.debug(
-                "`%s' does not exist; creating new dictionary.",
-                self.filename)
-            self._session_history = OrderedDict()
-        except ValueError:
+            with open(self.filename, "rb") as fd:
+                sessions = cPickle.load(fd)
+        except (ValueError, cPickle.UnpicklingError, EOFError):
             log.error("Could not unpickle `%s`; this is likely not "
                       "recoverable.  Please delete this file and start "
                       "from scratch.", self.filename)
             raise
 
+        temp_filename = "%s.%d.tmp" % (self.filename, os.getpid())
+        self._create(temp_filename, sessions.values())
+        os.rename(temp_filename, self.filename)
+
+    def _load_index(self):
+        """
+        Reads the header of every record in the log, to find where each live
+        session is stored.  The bodies of the records are skipped over.
+        """
+        self._index = OrderedDict()
+        self._size = len(MAGIC)
+        self._garbage = 0
+        self._read_records()
+
+    def _read_records(self):
+        """
+        Adds the records after the end of the index to it, up to the first
+        one that is incomplete or can't be read, leaving the file position
+        at the end of the log.
+        """
+        fd = self._fd
+        fd.seek(0, os.SEEK_END)
+        file_size = fd.tell()
+
+        index = self._index
+        offset = self._size
+        while offset < file_size:
+            fd.seek(offset)
+            header = fd.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                break
+            record_type, key_size, body_size = RECORD_HEADER.unpack(header)
+            size = RECORD_HEADER.size + key_size + body_size
+            if offset + size > file_size:
+                break
+
+            try:
+                key = cPickle.loads(fd.read(key_size))
+                if record_type == SESSION_RECORD:
+                    uuid, summary = key
+                elif record_type != TOMBSTONE_RECORD:
+                    raise ValueError("Unknown record type %r" % record_type)
+            except Exception:
+                log.warning("Could not read the record at offset %d of "
+                            "`%s'.", offset, self.filename)
+                break
+
+            if record_type == SESSION_RECORD:
+                old_record = index.pop(uuid, None)
+                index[uuid] = _Record(offset, size, body_size, summary)
+            else:
+                old_record = index.pop(key, None)
+                self._garbage += size
+            if old_record:
+                self._garbage += old_record.size
+            offset += size
+
+        self._size = offset
+        fd.seek(0, os.SEEK_END)
+
+    def _session_record(self, session):
+        key = cPickle.dumps((session.uuid, session.summary()),
+                            cPickle.HIGHEST_PROTOCOL)
+        body = serialization.dumps(session, self.codec,
+                                   self.compression_level)
+        return (RECORD_HEADER.pack(SESSION_RECORD, len(key), len(body)) +
+                key + body)
+
+    def _append(self, record):
+        """
+        Appends ``record`` to the end of the log, returning its offset.  The
+        exclusive lock must be held.
+        """
+        fd = self._fd
+        fd.seek(0, os.SEEK_END)
+        if fd.tell() > self._size:
+            # Left by a process that died while appending it.
+            log.warning("Discarding incomplete record at the end of `%s'.",
+                        self.filename)
+            fd.truncate(self._size)
+            fd.seek(0, os.SEEK_END)
+        offset = self._size
+        fd.write(record)
+        fd.flush()
+        self._size += len(record)
+        return offset
+
     def add(self, session):
         """
-        Adds a session to this dictionary and flushes it to disk.
+        Appends a session to the log.
+
+        Returns False if the session wasn't stored, because it isn't among
+        the sessions kept for its endpoint.
         """
-        self._session_history[session.uuid] = session
-        self._flush()
+        if self.reservoir.enabled:
+            keep, evicted = self.reservoir.offer(
+                session.uuid, session.summary().endpoint, session.duration)
+            self._evicting(evicted)
+            self.delete_many(evicted)
+            if not keep:
+                return False
 
-    def delete(self, session_uuid):
+        record = self._session_record(session)
+        body_size = RECORD_HEADER.unpack_from(record)[2]
+        with self._locked(exclusive=True):
+            offset = self._append(record)
+            old_record = self._index.pop(session.uuid, None)
+            if old_record:
+                self._garbage += old_record.size
+            self._index[session.uuid] = _Record(
+                offset, len(record), body_size, session.summary())
+            if self.retention.enabled:
+                self.enforce_retention()
+        return True
+
+    def enforce_retention(self):
+        """
+        Deletes the oldest sessions until the retention limits are met.
         """
-        Remove a session from the dictionary and flush it to disk.
+        with self._locked(exclusive=True):
+            live_size = self._size - self._garbage - len(MAGIC)
+            evicted = self.retention.select(
+                ((uuid, record.summary.timestamp, record.size)
+                 for uuid, record in self._index.iteritems()),
+                len(self._index), live_size)
+            if evicted:
+                log.debug("Evicting %d sessions from `%s'.", len(evicted),
+                          self.filename)
+                self._evicting(evicted)
+            return sum(self._delete(uuid) for uuid in evicted)
+
+    def _delete(self, session_uuid):
+        """
+        Appends a tombstone for ``session_uuid``, if it's stored.  The
+        exclusive lock must be held.
         """
-        if self.get(session_uuid):
-            del self._session_history[session_uuid]
-            self._flush()
-            return 1
+        old_record = self._index.pop(session_uuid, None)
+        if not old_record:
+            return 0
+        self.reservoir.discard([session_uuid])
 
-        return 0
+        key = cPickle.dumps(session_uuid, cPickle.HIGHEST_PROTOCOL)
+        record = RECORD_HEADER.pack(TOMBSTONE_RECORD, len(key), 0) + key
+        self._append(record)
+        self._garbage += old_record.size + len(record)
+        return 1
 
-    def delete_many(self, session_uuids):
+    def delete(self, session_uuid):
         """
-        Remove the sessions from the dictionary and flush it to disk.
+        Marks a session as deleted.
         """
-        count = 0
-        for session_uuid in session_uuids:
-            if session_uuid in self._session_history:
-                del self._session_history[session_uuid]
-                count += 1
+        with self._locked(exclusive=True):
+            return self._delete(session_uuid)
 
-        self._flush()
-        return count
+    def delete_many(self, session_uuids):
+        """
+        Marks the sessions as deleted.
+        """
+        with self._locked(exclusive=True):
+            return sum(self._delete(session_uuid)
+                       for session_uuid in session_uuids)
 
     def delete_all(self):
         """
-        Clear the entire session history and flush it to disk.
+        Clear the entire session history.  The log is replaced by an empty
+        one right away.
         """
-        deleted_rows = len(self._session_history)
-        self._session_history.clear()
-        self._flush()
+        with self._locked(exclusive=True):
+            deleted_rows = len(self._index)
+            # The log is replaced, rather than truncated, so that other
+            # processes notice that it has changed.
+            temp_filename = "%s.%d.tmp" % (self.filename, os.getpid())
+            self._create(temp_filename, [])
+            self._replace(temp_filename)
+            self._index.clear()
+            self.reservoir.clear()
+            self._size = len(MAGIC)
+            self._garbage = 0
 
         return deleted_rows
 
     def get(self, session_uuid):
-        return self._session_history.get(session_uuid)
+        with self._locked():
+            record = self._index.get(session_uuid)
+            if not record:
+                return None
+            self._fd.seek(record.offset + record.size - record.body_size)
+            body = self._fd.read(record.body_size)
+        return serialization.loads(body)
 
     def get_all(self):
-        return self._session_history.copy()
+        with self._locked():
+            uuids = list(self._index)
+        return OrderedDict((uuid, self.get(uuid)) for uuid in uuids)
+
+    def get_summaries(self):
+        """
+        Lists the stored sessions using the summaries kept in the index.
+        """
+        with self._locked():
+            return [record.summary for record in self._index.values()]
+
+    def needs_compaction(self):
+        """
+        Returns True if the deleted sessions take up more than
+        ``compact_ratio`` of the log.
+        """
+        return self._garbage > 0 and (
+            self._garbage >= self.compact_ratio * self._size)
+
+    def compact(self):
+        """
+        Rewrites the log with only the live sessions.  The records are
+        copied as they are, without being unpickled, and without holding the
+        lock; the sessions added or deleted in the meantime are then copied
+        or deleted with it held.
+        """
+        with self._locked():
+            records = self._index.items()
+            old_size = self._size
+            fd = open(self.filename, "rb")
+
+        temp_filename = "%s.%d.tmp" % (self.filename, os.getpid())
+        try:
+            with open(temp_filename, "wb") as temp_fd:
+                temp_fd.write(MAGIC)
+                copied = self._copy_records(fd, temp_fd, records)
+
+                with self._locked(exclusive=True):
+                    if os.fstat(fd.fileno()).st_ino != \
+                            os.fstat(self._fd.fileno()).st_ino:
+                        # Another process replaced the log first.
+                        return
+
+                    index = OrderedDict()
+                    garbage = 0
+                    offset = temp_fd.tell()
+                    for uuid, record in self._index.iteritems():
+                        copy = copied.pop(uuid, None)
+                        if copy is not None and copy[0] is record:
+                            index[uuid] = record._replace(offset=copy[1])
+                            continue
+                        if copy is not None:
+                            # The session was added again.
+                            garbage += copy[0].size
+                        self._fd.seek(record.offset)
+                        temp_fd.write(self._fd.read(record.size))
+                        index[uuid] = record._replace(offset=offset)
+                        offset += record.size
+
+                    # Sessions deleted while the records were being copied
+                    for uuid, (record, _) in copied.iteritems():
+                        if uuid in index:
+                            continue
+                        key = cPickle.dumps(uuid, cPickle.HIGHEST_PROTOCOL)
+                        tombstone = RECORD_HEADER.pack(TOMBSTONE_RECORD,
+                                                       len(key), 0) + key
+                        temp_fd.write(tombstone)
+                        garbage += record.size + len(tombstone)
+                        offset += len(tombstone)
+
+                    temp_fd.flush()
+                    os.fsync(temp_fd.fileno())
+                    self._replace(temp_filename)
+                    log.debug("Compacted `%s' from %d to %d bytes.",
+                              self.filename, old_size, offset)
+                    self._index = index
+                    self._size = offset
+                    self._garbage = garbage
+        finally:
+            fd.close()
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+
+    def _copy_records(self, fd, temp_fd, records):
+        """
+        Copies each of the ``records`` of the log open as ``fd`` to the end
+        of ``temp_fd``.  Returns a dictionary of uuid to the `(record,
+        offset)` it was copied from and to.
+        """
+        copied = {}
+        for uuid, record in records:
+            offset = temp_fd.tell()
+            fd.seek(record.offset)
+            temp_fd.write(fd.read(record.size))
+            copied[uuid] = (record, offset)
+        return copied
+
+    def _replace(self, filename):
+        """
+        Replaces the log with the log at ``filename``, and opens it.  The
+        exclusive lock must be held.
+        """
+        os.rename(filename, self.filename)
+        self._fd.close()
+        self._fd = open(self.filename, "a+b")
+
+    def _compact_loop(self):
+        while not self._stop_compacting.wait(self.compact_interval):
+            try:
+                with self._locked():
+                    compact = self._fd is not None and self.needs_compaction()
+                if compact:
+                    self.compact()
+            except Exception:
+                log.exception("Failed to compact `%s'.", self.filename)
@@ -0,0 +1,238 @@
+# This file is part of linesman.
+#
+# linesman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# linesman is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with linesman.  If not, see <http://www.gnu.org/licenses/>.
+#
+import heapq
+import random
+import threading
+from datetime import datetime, timedelta
+
+
+# Key of the number of sessions offered per endpoint by
+# `EndpointReservoir', which backends can persist with their state, so that
+# sessions stay uniformly sampled across restarts.
+RESERVOIR_STATE_KEY = "reservoir"
+
+class RetentionPolicy(object):
+    """
+    Decides which stored sessions should be evicted to stay within the
+    configured limits.  Every limit is optional; sessions are kept forever
+    if none are set.
+
+    ``max_sessions``:
+        Maximum number of sessions to keep.
+    ``max_size_mb``:
+        Maximum total size of the stored sessions, in megabytes.
+    ``max_age``:
+        Number of seconds after which sessions are evicted.
+    """
+
+    def __init__(self, max_sessions=None, max_size_mb=None, max_age=None):
+        self.max_sessions = int(max_sessions) if max_sessions else None
+        self.max_bytes = (int(float(max_size_mb) * 1024 * 1024)
+                          if max_size_mb else None)
+        self.max_age = (timedelta(seconds=float(max_age))
+                        if max_age else None)
+
+    @property
+    def enabled(self):
+        """
+        True if any limit is set.
+        """
+        return bool(self.max_sessions or self.max_bytes or self.max_age)
+
+    def select(self, sessions, count, total_size=0, now=None):
+        """
+        Returns the uuids of the sessions that should be evicted.
+
+        ``sessions``:
+            Iterable of `(uuid, timestamp, size)` tuples, oldest first.  This
+            is only consumed until the limits are met, so it can be a
+            lazily evaluated query.  Sessions without a timestamp count as
+            the oldest, like SQL orders NULLs.
+        ``count``:
+            Number of stored sessions.
+        ``total_size``:
+            Total size of the stored sessions, in bytes.
+        ``now``:
+            Current :class:`datetime.datetime`; defaults to now.
+        """
+        if self.max_age:
+            cutoff = (now or datetime.now()) - self.max_age
+        else:
+            cutoff = None
+
+        evicted = []
+        for uuid, timestamp, size in sessions:
+            if not ((self.max_sessions and count > self.max_sessions) or
+                    (self.max_bytes and total_size > self.max_bytes) or
+                    (cutoff and (timestamp is None or timestamp < cutoff))):
+                break
+            evicted.append(uuid)
+            count -= 1
+            total_size -= size or 0
+        return evicted
+
+
+class _EndpointState(object):
+    """
+    Sessions kept for a single endpoint by :class:`EndpointReservoir`.
+    """
+
+    def __init__(self):
+        # Min-heap of `(duration, uuid)', so the fastest of the slowest
+        # sessions is first.
+        self.slowest = []
+        self.reservoir = []
+        self.seen = 0
+
+
+class EndpointReservoir(object):
+    """
+    Keeps the slowest sessions of every endpoint, along with a uniform random
+    sample of the others, so that the tail latencies are kept no matter how
+    many fast requests are profiled.
+
+    Sessions are offered as they are stored, and whether to keep them is
+    decided right away: a session that is slower than the fastest of the
+    slowest sessions of its endpoint replaces it, and whichever of the two
+    is left over is offered to the reservoir.  The reservoir is maintained
+    with Algorithm R, so every session that was offered to it has the same
+    chance of being kept.
+
+    ``keep_slowest``:
+        Number of slowest sessions kept per endpoint.
+    ``reservoir_size``:
+        Number of other sessions sampled per endpoint.
+    ``randrange``:
+        Function used to pick random numbers; this is only useful for
+        testing.
+    """
+
+    def __init__(self, keep_slowest=None, reservoir_size=None,
+                 randrange=random.randrange):
+        self.keep_slowest = int(keep_slowest or 0)
+        self.reservoir_size = int(reservoir_size or 0)
+        self._randrange = randrange
+        self._endpoints = {}
+        self._locations = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        """
+        True if sessions are only kept per endpoint.
+        """
+        return bool(self.keep_slowest or self.reservoir_size)
+
+    def load(self, summaries, seen=None):
+        """
+        Rebuilds the kept sessions from ``summaries``, a list of
+        :class:`~linesman.SessionSummary` objects ordered oldest first.
+        ``seen`` is what :meth:`seen_counts` returned before, if it was
+        saved; otherwise, only the stored sessions are counted as offered.
+
+        Returns the uuids of the sessions that aren't kept, which can happen
+        if the limits were lowered.
+        """
+        self.clear()
+        evicted = []
+        for summary in summaries:
+            keep, offer_evicted = self.offer(
+                summary.uuid, summary.endpoint, summary.duration)
+            evicted.extend(offer_evicted)
+            if not keep:
+                evicted.append(summary.uuid)
+
+        with self._lock:
+            for endpoint, count in (seen or {}).iteritems():
+                state = self._endpoints.get(endpoint)
+                if state is None:
+                    state = self._endpoints[endpoint] = _EndpointState()
+                state.seen = max(state.seen, count)
+        return evicted
+
+    def seen_counts(self):
+        """
+        Returns the number of sessions offered to the reservoir of every
+        endpoint, which can be passed to :meth:`load` after a restart.
+        """
+        with self._lock:
+            return dict((endpoint, state.seen)
+                        for endpoint, state in self._endpoints.iteritems())
+
+    def offer(self, uuid, endpoint, duration):
+        """
+        Decides whether to keep a new session.
+
+        Returns a tuple of whether to store the session, and a list of the
+        uuids of stored sessions that should now be deleted.
+        """
+        candidate = (duration or 0, uuid)
+        with self._lock:
+            state = self._endpoints.get(endpoint)
+            if state is None:
+                state = self._endpoints[endpoint] = _EndpointState()
+            self._locations[uuid] = endpoint
+
+            if self.keep_slowest:
+                if len(state.slowest) < self.keep_slowest:
+                    heapq.heappush(state.slowest, candidate)
+                    return True, []
+                if candidate > state.slowest[0]:
+                    candidate = heapq.heapreplace(state.slowest, candidate)
+
+            # Algorithm R: the nth session offered to the reservoir replaces
+            # a random one with a probability of `reservoir_size / n'.
+            state.seen += 1
+            if len(state.reservoir) < self.reservoir_size:
+                state.reservoir.append(candidate[1])
+                return True, []
+
+            index = self._randrange(state.seen)
+            if index < self.reservoir_size:
+                evicted = state.reservoir[index]
+                state.reservoir[index] = candidate[1]
+            else:
+                evicted = candidate[1]
+
+            del self._locations[evicted]
+            if evicted == uuid:
+                return False, []
+            return True, [evicted]
+
+    def discard(self, uuids):
+        """
+        Forgets sessions that were deleted by other means.
+        """
+        with self._lock:
+            for uuid in uuids:
+                endpoint = self._locations.pop(uuid, None)
+                if endpoint is None:
+                    continue
+                state = self._endpoints[endpoint]
+                if uuid in state.reservoir:
+                    state.reservoir.remove(uuid)
+                else:
+                    state.slowest = [entry for entry in state.slowest
+                                     if entry[1] != uuid]
+                    heapq.heapify(state.slowest)
+
+    def clear(self):
+        """
+        Forgets every session.
+        """
+        with self._lock:
+            self._endpoints.clear()
+            self._locations.clear()
@@ -0,0 +1,143 @@
+# This file is part of linesman.
+#
+# linesman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# linesman is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with linesman.  If not, see <http://www.gnu.org/licenses/>.
+#
+import bz2
+import cPickle
+import zlib
+from cStringIO import StringIO
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+
+# Compressed data starts with this byte, followed by the id of the codec
+# used.  Pickles never start with a null byte, so data stored by older
+# versions, or without compression, is still read as a plain pickle.
+CODEC_MARKER = "\0"
+
+
+class Codec(object):
+    """
+    Compresses and decompresses stored sessions.
+
+    ``name``:
+        Name used to select this codec in the configuration.
+    ``id``:
+        Single character stored in front of the compressed data, so that it
+        can be decompressed no matter which codec is configured.
+    ``default_level``:
+        Compression level used when none is configured.
+    """
+
+    def __init__(self, name, id, compress, decompress, default_level):
+        self.name = name
+        self.id = id
+        self._compress = compress
+        self._decompress = decompress
+        self.default_level = default_level
+
+    def compress(self, data, level=None):
+        if level is None:
+            level = self.default_level
+        return self._compress(data, int(level))
+
+    def decompress(self, data):
+        return self._decompress(data)
+
+
+CODECS = {}
+
+
+def register_codec(codec):
+    """
+    Makes ``codec`` available by its name, and for decoding data tagged with
+    its id.
+    """
+    CODECS[codec.name] = codec
+
+
+register_codec(Codec("zlib", "z", zlib.compress, zlib.decompress, 6))
+register_codec(Codec("bz2", "b", bz2.compress, bz2.decompress, 9))
+if lzma is not None:
+    register_codec(Codec(
+        "lzma", "x",
+        lambda data, level: lzma.compress(data, preset=level),
+        lzma.decompress, 6))
+
+
+def get_codec(name):
+    """
+    Returns the codec called ``name``, or `None` if ``name`` is `none` or
+    empty, meaning that data isn't compressed.
+
+    Raises a :class:`ValueError` if there is no such codec, which is also
+    the case for `lzma` when the :mod:`lzma` module isn't installed.
+    """
+    if not name or name.lower() == "none":
+        return None
+    try:
+        return CODECS[name.lower()]
+    except KeyError:
+        raise ValueError("Unknown compression codec %r; available codecs "
+                         "are: none, %s" % (name, ", ".join(sorted(CODECS))))
+
+
+def dumps(obj, codec=None, level=None, persistent_id=None):
+    """
+    Pickles ``obj``, and compresses it with ``codec``, if given.
+
+    ``persistent_id`` is passed on to the pickler, so that some objects can
+    be stored separately; see :mod:`pickle`.
+    """
+    if persistent_id is None:
+        data = cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL)
+    else:
+        buf = StringIO()
+        pickler = cPickle.Pickler(buf, cPickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = persistent_id
+        pickler.dump(obj)
+        data = buf.getvalue()
+
+    if codec is None:
+        return data
+    return CODEC_MARKER + codec.id + codec.compress(data, level)
+
+
+def loads(data, persistent_load=None):
+    """
+    Unpickles data written by :func:`dumps`, using whichever codec it was
+    compressed with.  ``persistent_load`` is needed if the data was pickled
+    with a ``persistent_id``.
+    """
+    if data[:1] == CODEC_MARKER:
+        codec_id = data[1:2]
+        for codec in CODECS.itervalues():
+            if codec.id == codec_id:
+                data = codec.decompress(data[2:])
+                break
+        else:
+            raise ValueError("Data was compressed with an unknown codec "
+                             "(%r)" % codec_id)
+
+    if persistent_load is None:
+        return cPickle.loads(data)
+    unpickler = cPickle.Unpickler(StringIO(data))
+    unpickler.persistent_load = persistent_load
+    return unpickler.load()
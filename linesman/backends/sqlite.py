@@ -13,12 +13,27 @@
 # You should have received a copy of the GNU General Public License along
 # with linesman.  If not, see <http://www.gnu.org/licenses/>.
 #
-import cPickle
+import copy
 import logging
+import os
 import sqlite3
+import sys
+import threading
 import time
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
 
-from linesman.backends.base import Backend
+from paste.util.converters import asbool
+
+from linesman import SessionSummary
+from linesman.backends import serialization
+from linesman.backends.base import Backend, SUMMARY_ORDERS
+from linesman.backends.retention import (EndpointReservoir,
+                                         RESERVOIR_STATE_KEY, RetentionPolicy)
+from linesman.cache import LRUCache
+from linesman.callgraph import CallGraph, CallGraphStructure, FIELDS
 
 
 try:
@@ -29,16 +44,205 @@ except ImportError:
     from ordereddict import OrderedDict
 
 
-sqlite3.register_converter("pickle", cPickle.loads)
+sqlite3.register_converter("pickle", serialization.loads)
 log = logging.getLogger(__name__)
 
+# Columns used to list sessions without loading them.  Older databases
+# won't have these, so they are added by `SqliteBackend.setup'.
+SUMMARY_COLUMNS = [
+    ("path", "TEXT"),
+    ("duration", "FLOAT"),
+    ("method", "TEXT"),
+    ("status", "INTEGER"),
+    ("node_count", "INTEGER"),
+    ("endpoint", "TEXT"),
+]
+INDEXED_COLUMNS = ["timestamp", "path", "duration", "endpoint"]
+
+# Size of the stored session, in bytes, used to enforce `max_size_mb'.
+# Older databases are upgraded by `SqliteBackend.setup', too.
+SIZE_COLUMN = ("size", "INTEGER")
+
+# Digest of the callgraph structure of sessions stored with
+# `dedup_structures', which is kept in the `structures' table instead.
+STRUCTURE_COLUMN = ("structure", "TEXT")
+STRUCTURES_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS structures (
+        id TEXT PRIMARY KEY,
+        structure PICKLE
+    );
+    CREATE INDEX IF NOT EXISTS sessions_structure ON sessions (structure);
+    CREATE TRIGGER IF NOT EXISTS sessions_delete_structure
+    AFTER DELETE ON sessions
+    WHEN OLD.structure IS NOT NULL
+    BEGIN
+        DELETE FROM structures
+        WHERE id = OLD.structure AND NOT EXISTS (
+            SELECT 1 FROM sessions WHERE structure = OLD.structure);
+    END;
+"""
+
+# Maximum number of sessions deleted by a single statement of
+# `SqliteBackend.delete_many', which stays below SQLite's default limit of
+# 999 parameters.
+DELETE_CHUNK_SIZE = 500
+
+# Number of loaded structures kept in memory, so that sessions of the same
+# endpoint share a single copy.
+STRUCTURE_CACHE_SIZE = 256
+
+
+# Tables used to store callgraphs as rows, when `normalized' is enabled.
+# Function keys are interned in `functions', and the stats of every node and
+# edge of a session refer to them by id.  Rows are removed along with their
+# session by a trigger.
+NORMALIZED_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS functions (
+        id INTEGER PRIMARY KEY,
+        key TEXT UNIQUE NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS nodes (
+        session TEXT NOT NULL,
+        function INTEGER NOT NULL,
+        callcount INTEGER,
+        reccallcount INTEGER,
+        inlinetime FLOAT,
+        totaltime FLOAT,
+        PRIMARY KEY (session, function)
+    );
+    CREATE INDEX IF NOT EXISTS nodes_function ON nodes (function);
+    CREATE TABLE IF NOT EXISTS edges (
+        session TEXT NOT NULL,
+        caller INTEGER NOT NULL,
+        callee INTEGER NOT NULL,
+        callcount INTEGER,
+        reccallcount INTEGER,
+        inlinetime FLOAT,
+        totaltime FLOAT,
+        PRIMARY KEY (session, caller, callee)
+    );
+    CREATE INDEX IF NOT EXISTS edges_callee ON edges (callee);
+    CREATE TRIGGER IF NOT EXISTS sessions_delete_rows
+    AFTER DELETE ON sessions
+    BEGIN
+        DELETE FROM nodes WHERE session = OLD.uuid;
+        DELETE FROM edges WHERE session = OLD.uuid;
+    END;
+"""
+
+# Number and total size of the stored sessions, kept up to date by triggers
+# so that retention limits can be checked without scanning every session.
+# These are separate statements, so that they can be run in a transaction.
+TOTALS_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS totals (
+        id INTEGER PRIMARY KEY CHECK (id = 0),
+        count INTEGER NOT NULL,
+        size INTEGER NOT NULL
+    );""",
+    """
+    CREATE TRIGGER IF NOT EXISTS sessions_insert_totals
+    AFTER INSERT ON sessions
+    BEGIN
+        UPDATE totals SET count = count + 1,
+                          size = size + IFNULL(NEW.size, 0);
+    END;""",
+    """
+    CREATE TRIGGER IF NOT EXISTS sessions_delete_totals
+    AFTER DELETE ON sessions
+    BEGIN
+        UPDATE totals SET count = count - 1,
+                          size = size - IFNULL(OLD.size, 0);
+    END;""",
+    """
+    CREATE TRIGGER IF NOT EXISTS sessions_update_totals
+    AFTER UPDATE OF size ON sessions
+    BEGIN
+        UPDATE totals SET size = size + IFNULL(NEW.size, 0) -
+                                 IFNULL(OLD.size, 0);
+    END;""",
+)
+
+# State that isn't tied to a single session; see `Backend.save_state'.
+STATE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS state (
+        key TEXT PRIMARY KEY,
+        value PICKLE
+    );
+"""
+
+# Totals of a single function across sessions; see
+# `SqliteBackend.top_functions'.
+FunctionStats = namedtuple(
+    "FunctionStats",
+    "key callcount reccallcount inlinetime totaltime sessions")
+
+
+JOURNAL_MODES = ("DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF")
+SYNCHRONOUS_LEVELS = ("OFF", "NORMAL", "FULL", "EXTRA")
+
+
+def _retry_if_locked(func):
+    """
+    Retries ``func`` when SQLite reports that the database is locked or busy,
+    which can still happen once the busy timeout has expired when many
+    threads or processes are writing at once.
+    """
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        for attempt in xrange(self.retries + 1):
+            try:
+                return func(self, *args, **kwargs)
+            except sqlite3.OperationalError as e:
+                message = str(e)
+                if (("locked" not in message and "busy" not in message) or
+                        attempt == self.retries):
+                    raise
+                log.debug("Database is locked; retrying `%s'.",
+                          func.__name__)
+                try:
+                    self.conn.execute("ROLLBACK;")
+                except sqlite3.OperationalError:
+                    pass
+                time.sleep(0.01 * 2 ** attempt)
+    return wrapper
+
+
+@contextmanager
+def _transaction(c):
+    """
+    Runs the statements executed on cursor ``c`` within the `with` block in a
+    transaction.  If any of them fail, the transaction is rolled back, so
+    that the connection, which is kept open, isn't left in it.
+    """
+    c.execute("BEGIN;")
+    try:
+        yield c
+        c.execute("COMMIT;")
+    except:
+        exc_info = sys.exc_info()
+        try:
+            c.execute("ROLLBACK;")
+        except sqlite3.OperationalError:
+            # SQLite may have rolled back already.
+            pass
+        raise exc_info[0], exc_info[1], exc_info[2]
+
 
 class SqliteBackend(Backend):
     """
     Stores sessions in a SQLite database.
+
+    Each thread keeps its own connection open for as long as the backend is
+    in use, rather than connecting for every query.
     """
 
-    def __init__(self, filename="sessions.db"):
+    def __init__(self, filename="sessions.db", journal_mode="WAL",
+                 synchronous="NORMAL", busy_timeout=5, retries=3,
+                 compression="none", compression_level=None,
+                 max_sessions=None, max_size_mb=None, max_age=None,
+                 keep_slowest=None, reservoir_size=None, normalized=False,
+                 dedup_structures=False):
         """
         Opens up a connection to a sqlite3 database.
 
@@ -47,49 +251,400 @@ class SqliteBackend(Backend):
             will be created automatically.
 
             This can also be set to `:memory:` to store the database in
-            memory; however, this will not persist across runs.
+            memory; however, this will not persist across runs, and every
+            thread will see its own database.
+        ``journal_mode``:
+            SQLite journal mode.  The default, `WAL`, lets readers and a
+            writer work at the same time.
+        ``synchronous``:
+            SQLite synchronous level; one of `OFF`, `NORMAL`, `FULL` or
+            `EXTRA`.  With `WAL`, `NORMAL` is safe from corruption, but the
+            last sessions stored may be lost on power failure.
+        ``busy_timeout``:
+            Number of seconds to wait for a lock held by another connection.
+        ``retries``:
+            Number of times a query is retried if the database is still
+            locked once ``busy_timeout`` has expired.
+        ``compression``:
+            Codec used to compress stored sessions; one of `none`, `zlib`,
+            `bz2` or `lzma`.  Sessions are always readable, whichever codec
+            they were stored with.
+        ``compression_level``:
+            Compression level passed to the codec, if not its default.
+        ``max_sessions``, ``max_size_mb``, ``max_age``:
+            Retention limits, enforced whenever a session is added; see
+            :class:`~linesman.backends.retention.RetentionPolicy`.  Space
+            freed by evicted sessions is returned to the filesystem, for
+            databases created with this version or later.
+        ``keep_slowest``, ``reservoir_size``:
+            If either is set, only the slowest sessions of each endpoint and
+            a random sample of the others are kept; see
+            :class:`~linesman.backends.retention.EndpointReservoir`.
+        ``normalized``:
+            If true, the callgraphs of new sessions are stored as rows in the
+            `functions`, `nodes` and `edges` tables, rather than as part of
+            the pickled session.  This allows questions across sessions to be
+            answered in SQL; see :meth:`top_functions`.
+        ``dedup_structures``:
+            If true, the structure of each callgraph--its function keys and
+            edges--is stored once in the `structures` table and shared by
+            every session with the same structure, so that only the numbers
+            are stored per session.
         """
         self.filename = filename
+        self.journal_mode = journal_mode.upper()
+        self.synchronous = synchronous.upper()
+        self.busy_timeout = float(busy_timeout)
+        self.retries = int(retries)
+        self.codec = serialization.get_codec(compression)
+        self.compression_level = compression_level
+        self.retention = RetentionPolicy(max_sessions, max_size_mb, max_age)
+        self.reservoir = EndpointReservoir(keep_slowest, reservoir_size)
+        self.normalized = asbool(normalized)
+        self.dedup_structures = asbool(dedup_structures)
+        self._function_ids = {}
+        self._structures = LRUCache(STRUCTURE_CACHE_SIZE)
+
+        if self.journal_mode not in JOURNAL_MODES:
+            raise ValueError("journal_mode must be one of %s, not %r" % (
+                ", ".join(JOURNAL_MODES), journal_mode))
+        if self.synchronous not in SYNCHRONOUS_LEVELS:
+            raise ValueError("synchronous must be one of %s, not %r" % (
+                ", ".join(SYNCHRONOUS_LEVELS), synchronous))
+
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._function_ids_lock = threading.Lock()
 
     @property
     def conn(self):
-        return sqlite3.connect(self.filename, isolation_level=None,
-            detect_types=(sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES))
+        """
+        The connection for the current thread, which is opened on first use.
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+
+        # Connections can't be shared with a forked child, so a new one is
+        # needed after a fork.
+        conn = sqlite3.connect(self.filename, isolation_level=None,
+            detect_types=(sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES),
+            timeout=self.busy_timeout, check_same_thread=False)
+        # This only has an effect on new databases, so it has to come before
+        # anything is written.  It lets `enforce_retention' give the space it
+        # frees back to the filesystem.
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+        conn.execute("PRAGMA journal_mode = %s;" % self.journal_mode)
+        conn.execute("PRAGMA synchronous = %s;" % self.synchronous)
+
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        with self._connections_lock:
+            self._connections.append(conn)
+        return conn
+
+    def close(self):
+        """
+        Saves the number of sessions offered to the reservoir, and closes
+        the connections of every thread.
+        """
+        if self.reservoir.enabled:
+            self.save_state(RESERVOIR_STATE_KEY, self.reservoir.seen_counts())
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
 
+    @_retry_if_locked
     def setup(self):
         """
-        Creates table for Linesman, if it doesn't already exist.
+        Creates table for Linesman, if it doesn't already exist.  Tables
+        created by older versions are upgraded with the summary columns.
         """
-        query = """
-            CREATE TABLE sessions (
+        conn = self.conn
+        c = conn.cursor()
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS sessions (
                 uuid PRIMARY KEY,
                 timestamp FLOAT,
-                session PICKLE
+                session PICKLE,
+                path TEXT,
+                duration FLOAT,
+                method TEXT,
+                status INTEGER,
+                node_count INTEGER,
+                endpoint TEXT,
+                size INTEGER,
+                structure TEXT
             );
+        """)
+
+        c.execute("PRAGMA table_info(sessions);")
+        existing_columns = set(row[1] for row in c.fetchall())
+        missing_columns = [(name, type)
+                           for name, type in SUMMARY_COLUMNS
+                           if name not in existing_columns]
+        for name, type in missing_columns:
+            c.execute("ALTER TABLE sessions ADD COLUMN %s %s;" % (name, type))
+        if missing_columns:
+            self._backfill_summaries(conn)
+        if SIZE_COLUMN[0] not in existing_columns:
+            c.execute("ALTER TABLE sessions ADD COLUMN %s %s;" % SIZE_COLUMN)
+            c.execute("UPDATE sessions SET size = LENGTH(session);")
+        if STRUCTURE_COLUMN[0] not in existing_columns:
+            c.execute("ALTER TABLE sessions ADD COLUMN %s %s;" %
+                      STRUCTURE_COLUMN)
+
+        for column in INDEXED_COLUMNS:
+            c.execute("CREATE INDEX IF NOT EXISTS sessions_%s "
+                      "ON sessions (%s);" % (column, column))
+
+        # The totals are counted once, when the table is created, in the same
+        # transaction as the triggers that keep them up to date.
+        with _transaction(c):
+            for statement in TOTALS_SCHEMA:
+                c.execute(statement)
+            c.execute("SELECT 1 FROM totals;")
+            if not c.fetchone():
+                c.execute("INSERT INTO totals SELECT 0, COUNT(*), "
+                          "IFNULL(SUM(size), 0) FROM sessions;")
+
+        c.execute(STATE_SCHEMA)
+        if self.normalized:
+            c.executescript(NORMALIZED_SCHEMA)
+        if self.dedup_structures:
+            c.executescript(STRUCTURES_SCHEMA)
+
+        if self.reservoir.enabled:
+            evicted = self.reservoir.load(
+                self.iter_summaries(), self.load_state(RESERVOIR_STATE_KEY))
+            if evicted:
+                self.delete_many(evicted)
+
+    def _backfill_summaries(self, conn):
         """
-        try:
-            c = self.conn.cursor()
-            c.execute(query)
-        except sqlite3.OperationalError:
-            log.debug("Table already exists.")
+        Fills in the summary columns of sessions stored by older versions.
+        This loads every session, but only ever needs to happen once.
+        """
+        log.info("Adding summary columns to `%s'; this may take a while.",
+                 self.filename)
+        c = conn.cursor()
+        c.execute("SELECT session FROM sessions;")
+        params = [self._summary_params(session.summary()) + (session.uuid,)
+                  for (session,) in c]
+        with _transaction(c):
+            c.executemany("""
+                UPDATE sessions
+                SET path = ?, duration = ?, method = ?, status = ?,
+                    node_count = ?, endpoint = ?
+                WHERE uuid = ?;""", params)
+
+    def _summary_params(self, summary):
+        return (summary.path, summary.duration, summary.method,
+                summary.status, summary.node_count, summary.endpoint)
 
     def add(self, session):
         """
-        Insert a new session into the database.
+        Insert a new session into the database, and then evict any sessions
+        outside of the retention limits.
+
+        Returns False if the session wasn't stored, because it isn't among
+        the sessions kept for its endpoint.
         """
+        if self.reservoir.enabled:
+            keep, evicted = self.reservoir.offer(
+                session.uuid, session.summary().endpoint, session.duration)
+            if evicted:
+                self._evicting(evicted)
+                self.delete_many(evicted)
+            if not keep:
+                return False
+
+        self._insert(session)
+        if self.retention.enabled:
+            self.enforce_retention()
+        return True
+
+    @_retry_if_locked
+    def _insert(self, session):
         uuid = session.uuid
-        if session.timestamp:
-            timestamp = time.mktime(session.timestamp.timetuple())
-        else:
-            timestamp = None
-        pickled_session = sqlite3.Binary(cPickle.dumps(session, -1))
+        timestamp = _to_timestamp(session.timestamp)
+
+        summary = session.summary()
+        callgraph = session._callgraph
+        if self.normalized:
+            # The callgraph is stored as rows instead.
+            session = copy.copy(session)
+            session._callgraph = None
+
+        structures = {}
+        persistent_id = None
+        if self.dedup_structures:
+            def persistent_id(obj):
+                if isinstance(obj, CallGraphStructure):
+                    structures[obj.digest] = obj
+                    return obj.digest
+        pickled_session = sqlite3.Binary(serialization.dumps(
+            session, self.codec, self.compression_level, persistent_id))
+        structure_id = structures.keys()[0] if structures else None
 
-        query = "INSERT INTO sessions VALUES (?, ?, ?);"
-        params = (uuid, timestamp, pickled_session)
+        query = """
+            INSERT INTO sessions (uuid, timestamp, session, path, duration,
+                                  method, status, node_count, endpoint, size,
+                                  structure)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);"""
+        params = ((uuid, timestamp, pickled_session) +
+                  self._summary_params(summary) +
+                  (len(pickled_session), structure_id))
 
         c = self.conn.cursor()
-        c.execute(query, params)
+        if not (self.normalized or structures):
+            c.execute(query, params)
+            return
+
+        # Function ids added by this transaction are only cached once it has
+        # been committed, since SQLite reuses the ids of rolled back rows.
+        new_function_ids = {}
+        with _transaction(c):
+            for digest, structure in structures.iteritems():
+                # The check only saves serializing a stored structure;
+                # another connection may still store it first.
+                c.execute("SELECT 1 FROM structures WHERE id = ?;",
+                          (digest,))
+                if not c.fetchone():
+                    pickled_structure = sqlite3.Binary(serialization.dumps(
+                        structure, self.codec, self.compression_level))
+                    c.execute("INSERT OR IGNORE INTO structures "
+                              "VALUES (?, ?);", (digest, pickled_structure))
+            c.execute(query, params)
+            if self.normalized:
+                self._insert_callgraph(c, uuid, callgraph, new_function_ids)
+        if new_function_ids:
+            with self._function_ids_lock:
+                self._function_ids.update(new_function_ids)
+
+    def _function_ids_for(self, c, keys, new_function_ids):
+        """
+        Returns the ids of the function ``keys``, adding any that aren't in
+        the `functions` table yet.  Ids never change once committed, so they
+        are cached; the ids looked up here are added to ``new_function_ids``,
+        to be cached after the transaction commits.
+        """
+        function_ids = self._function_ids
+        missing = [key for key in keys if key not in function_ids]
+        if missing:
+            c.executemany("INSERT OR IGNORE INTO functions (key) VALUES (?);",
+                          [(key,) for key in missing])
+            for key in missing:
+                c.execute("SELECT id FROM functions WHERE key = ?;", (key,))
+                new_function_ids[key] = c.fetchone()[0]
+        return [function_ids[key] if key in function_ids
+                else new_function_ids[key] for key in keys]
+
+    def _insert_callgraph(self, c, uuid, callgraph, new_function_ids):
+        ids = self._function_ids_for(c, callgraph.keys, new_function_ids)
+
+        node_rows = []
+        for i, function_id in enumerate(ids):
+            data = callgraph.node_data(i)
+            node_rows.append((uuid, function_id) +
+                             tuple(data.get(field) for field in FIELDS))
+        c.executemany("INSERT INTO nodes VALUES (?, ?, ?, ?, ?, ?);",
+                      node_rows)
+
+        edge_rows = []
+        for i, target, j in callgraph.edges():
+            data = callgraph.edge_data(j)
+            edge_rows.append((uuid, ids[i], ids[target]) +
+                             tuple(data[field] for field in FIELDS))
+        c.executemany("INSERT INTO edges VALUES (?, ?, ?, ?, ?, ?, ?);",
+                      edge_rows)
+
+    def _load_callgraph(self, c, uuid):
+        """
+        Rebuilds the callgraph of session ``uuid`` from its rows.
+        """
+        c.execute("""
+            SELECT functions.key, callcount, reccallcount, inlinetime,
+                   totaltime
+            FROM nodes JOIN functions ON functions.id = nodes.function
+            WHERE session = ?;""", (uuid,))
+        nodes = dict((row[0], row[1:] if row[1] is not None else None)
+                     for row in c)
+
+        c.execute("""
+            SELECT caller.key, callee.key, callcount, reccallcount,
+                   inlinetime, totaltime
+            FROM edges
+            JOIN functions AS caller ON caller.id = edges.caller
+            JOIN functions AS callee ON callee.id = edges.callee
+            WHERE session = ?;""", (uuid,))
+        edges = dict(((row[0], row[1]), row[2:]) for row in c)
+
+        return CallGraph.from_dicts(nodes, edges)
+
+    def _load_structure(self, c, digest):
+        structure = self._structures.get(digest)
+        if structure is None:
+            c.execute("SELECT structure FROM structures WHERE id = ?;",
+                      (digest,))
+            structure = c.fetchone()[0]
+            self._structures.set(digest, structure)
+        return structure
+
+    def _load_session(self, c, data):
+        """
+        Unpickles a stored session, loading its callgraph structure or rows
+        if they are stored separately.
+        """
+        session = serialization.loads(
+            str(data), lambda digest: self._load_structure(c, digest))
+        if session._callgraph is None:
+            session._callgraph = self._load_callgraph(c, session.uuid)
+        return session
 
+    def enforce_retention(self):
+        """
+        Deletes the oldest sessions until the retention limits are met, and
+        then reclaims the free space.
+        """
+        evicted = self._select_evicted()
+        if not evicted:
+            return 0
+
+        self._evicting(evicted)
+        self._delete_evicted(evicted)
+        return len(evicted)
+
+    @_retry_if_locked
+    def _select_evicted(self):
+        c = self.conn.cursor()
+        c.execute("SELECT count, size FROM totals;")
+        count, total_size = c.fetchone()
+
+        c.execute("SELECT uuid, timestamp, size FROM sessions "
+                  "ORDER BY timestamp;")
+        evicted = self.retention.select(
+            ((uuid, _from_timestamp(timestamp), size)
+             for uuid, timestamp, size in c),
+            count, total_size)
+        c.close()
+        return evicted
+
+    @_retry_if_locked
+    def _delete_evicted(self, evicted):
+        log.debug("Evicting %d sessions from `%s'.", len(evicted),
+                  self.filename)
+        c = self.conn.cursor()
+        with _transaction(c):
+            c.executemany("DELETE FROM sessions WHERE uuid = ?;",
+                          [(uuid,) for uuid in evicted])
+        self.reservoir.discard(evicted)
+        c.execute("PRAGMA incremental_vacuum;").fetchall()
+
+    @_retry_if_locked
     def delete(self, session_uuid):
         """
         Remove the session.
@@ -97,57 +652,272 @@ class SqliteBackend(Backend):
         query = "DELETE FROM sessions WHERE uuid = ?;"
         params = (session_uuid,)
 
-        conn = self.conn
-        curs = conn.cursor()
+        curs = self.conn.cursor()
         curs.execute(query, params)
+        self.reservoir.discard([session_uuid])
 
-        return conn.total_changes
+        return curs.rowcount
 
+    @_retry_if_locked
     def delete_many(self, session_uuids):
         """
-        Remove the sessions.
+        Remove the sessions, a chunk at a time.
         """
-        query = "DELETE FROM sessions WHERE uuid IN (%s);" % ", ".join('?' * len(session_uuids))
-        params = session_uuids
+        curs = self.conn.cursor()
+        deleted_rows = 0
+        for start in xrange(0, len(session_uuids), DELETE_CHUNK_SIZE):
+            params = session_uuids[start:start + DELETE_CHUNK_SIZE]
+            query = ("DELETE FROM sessions WHERE uuid IN (%s);" %
+                     ", ".join('?' * len(params)))
+            curs.execute(query, params)
+            deleted_rows += curs.rowcount
+        self.reservoir.discard(session_uuids)
 
-        conn = self.conn
-        curs = conn.cursor()
-        curs.execute(query, params)
-
-        return conn.total_changes
+        return deleted_rows
 
+    @_retry_if_locked
     def delete_all(self):
         """
         Truncate the database.
         """
         query = "DELETE FROM sessions;"
 
-        conn = self.conn
-        curs = conn.cursor()
+        curs = self.conn.cursor()
         curs.execute(query)
+        self.reservoir.clear()
 
-        return conn.total_changes
+        return curs.rowcount
 
+    @_retry_if_locked
     def get(self, session_uuid):
         """
         Retrieves the session from the database.
         """
-        query = "SELECT session FROM sessions WHERE uuid = ?;"
+        query = """
+            SELECT CAST(session AS BLOB) FROM sessions WHERE uuid = ?;"""
         params = (session_uuid,)
 
         c = self.conn.cursor()
         c.execute(query, params)
         result = c.fetchone()
 
-        return result[0] if result else None
+        return self._load_session(c, result[0]) if result else None
 
+    @_retry_if_locked
     def get_all(self):
         """
         Generates a dictionary of the data based on the contents of the DB.
         """
-        query = "SELECT uuid, session FROM sessions ORDER BY timestamp;"
+        query = """
+            SELECT uuid, CAST(session AS BLOB) FROM sessions
+            ORDER BY timestamp;"""
 
         c = self.conn.cursor()
         c.execute(query)
 
-        return OrderedDict(c.fetchall())
+        return OrderedDict((uuid, self._load_session(c, data))
+                           for uuid, data in c.fetchall())
+
+    def get_summaries(self):
+        """
+        Lists the sessions in the DB, using only the summary columns.
+        """
+        return list(self.iter_summaries())
+
+    @_retry_if_locked
+    def _execute(self, query, params=()):
+        """
+        Executes ``query`` on a new cursor, which is returned so that its
+        results can be read lazily.
+        """
+        c = self.conn.cursor()
+        c.execute(query, params)
+        return c
+
+    def _summary_conditions(self, path_prefix, min_duration, since, until):
+        """
+        Returns the SQL conditions and parameters for the filters of
+        :meth:`iter_summaries`.
+        """
+        conditions = []
+        params = []
+        if path_prefix is not None:
+            # A range, rather than LIKE, can use the index on `path'.
+            conditions.append("path >= ? AND path < ?")
+            params.extend([path_prefix, path_prefix + u"\uffff"])
+        if min_duration is not None:
+            conditions.append("duration >= ?")
+            params.append(float(min_duration))
+        if since is not None:
+            conditions.append("timestamp >= ?")
+            params.append(_to_timestamp(since))
+        if until is not None:
+            conditions.append("timestamp < ?")
+            params.append(_to_timestamp(until))
+        return conditions, params
+
+    def iter_summaries(self, order_by="timestamp", descending=False,
+                       path_prefix=None, min_duration=None, since=None,
+                       until=None, limit=None, offset=0, after=None):
+        """
+        Yields the summaries of the sessions in the DB, as they are read.
+        See :meth:`Backend.iter_summaries`.
+        """
+        if order_by not in SUMMARY_ORDERS:
+            raise ValueError("Cannot order sessions by %r" % order_by)
+
+        conditions, params = self._summary_conditions(
+            path_prefix, min_duration, since, until)
+        if after is not None:
+            after_value, after_uuid = after
+            if order_by == "timestamp":
+                after_value = _to_timestamp(after_value)
+            operator = "<" if descending else ">"
+            conditions.append("(%s %s ? OR (%s = ? AND uuid %s ?))" % (
+                order_by, operator, order_by, operator))
+            params.extend([after_value, after_value, after_uuid])
+        where = "WHERE " + " AND ".join(conditions) if conditions else ""
+        direction = "DESC" if descending else "ASC"
+
+        query = """
+            SELECT uuid, path, duration, timestamp, method, status, node_count,
+                   endpoint
+            FROM sessions
+            %s
+            ORDER BY %s %s, uuid %s
+            LIMIT ? OFFSET ?;""" % (where, order_by, direction, direction)
+        params.extend([int(limit) if limit is not None else -1,
+                       int(offset or 0)])
+
+        for (uuid, path, duration, timestamp, method, status, node_count,
+             endpoint) in self._execute(query, params):
+            yield SessionSummary(uuid, path, duration,
+                                 _from_timestamp(timestamp), method, status,
+                                 node_count, endpoint)
+
+    def count_summaries(self, path_prefix=None, min_duration=None,
+                        since=None, until=None):
+        """
+        Counts the sessions that match the filters of
+        :meth:`iter_summaries`.
+        """
+        conditions, params = self._summary_conditions(
+            path_prefix, min_duration, since, until)
+        where = "WHERE " + " AND ".join(conditions) if conditions else ""
+        query = "SELECT COUNT(*) FROM sessions %s;" % where
+        return self._execute(query, params).fetchone()[0]
+
+    @_retry_if_locked
+    def top_functions(self, limit=20, order_by="inlinetime", endpoint=None,
+                      since=None, until=None):
+        """
+        Returns a list of :class:`FunctionStats`, totalling the stats of every
+        function across sessions stored with ``normalized``, most expensive
+        first.
+
+        ``limit``:
+            Maximum number of functions to return.
+        ``order_by``:
+            Either `inlinetime`, `totaltime` or `callcount`.
+        ``endpoint``:
+            If given, only sessions of this endpoint are included.
+        ``since``, ``until``:
+            If given, only sessions whose timestamp is within this range of
+            :class:`datetime.datetime` objects are included.
+        """
+        if order_by not in ("inlinetime", "totaltime", "callcount"):
+            raise ValueError("Cannot order functions by %r" % order_by)
+
+        conditions = []
+        params = []
+        if endpoint is not None:
+            conditions.append("sessions.endpoint = ?")
+            params.append(endpoint)
+        if since is not None:
+            conditions.append("sessions.timestamp >= ?")
+            params.append(_to_timestamp(since))
+        if until is not None:
+            conditions.append("sessions.timestamp < ?")
+            params.append(_to_timestamp(until))
+        where = "WHERE " + " AND ".join(conditions) if conditions else ""
+
+        query = """
+            SELECT functions.key, SUM(callcount), SUM(reccallcount),
+                   SUM(inlinetime), SUM(totaltime), COUNT(*)
+            FROM nodes
+            JOIN sessions ON sessions.uuid = nodes.session
+            JOIN functions ON functions.id = nodes.function
+            %s
+            GROUP BY nodes.function
+            ORDER BY SUM(%s) DESC
+            LIMIT ?;""" % (where, order_by)
+        params.append(int(limit))
+
+        c = self.conn.cursor()
+        c.execute(query, params)
+        return [FunctionStats(*row) for row in c]
+
+    @_retry_if_locked
+    def save_state(self, key, value):
+        """
+        Stores ``value`` in the `state` table.  See
+        :meth:`Backend.save_state`.
+        """
+        self.conn.execute(
+            "INSERT OR REPLACE INTO state (key, value) VALUES (?, ?);",
+            (key, sqlite3.Binary(serialization.dumps(
+                value, self.codec, self.compression_level))))
+
+    @_retry_if_locked
+    def load_state(self, key, default=None):
+        """
+        Retrieves a value from the `state` table.  See
+        :meth:`Backend.load_state`.
+        """
+        c = self.conn.cursor()
+        c.execute("SELECT CAST(value AS BLOB) FROM state WHERE key = ?;",
+                  (key,))
+        result = c.fetchone()
+        return serialization.loads(str(result[0])) if result else default
+
+    def iter_states(self, prefix=""):
+        """
+        Yields the values of the `state` table whose key starts with
+        ``prefix``, as they are read.  See :meth:`Backend.iter_states`.
+        """
+        query = """
+            SELECT key, CAST(value AS BLOB) FROM state
+            WHERE key >= ? AND key < ?
+            ORDER BY key;"""
+        params = (prefix, prefix + u"\uffff")
+        for key, value in self._execute(query, params):
+            yield key, serialization.loads(str(value))
+
+    @_retry_if_locked
+    def delete_state(self, key):
+        """
+        Removes a value from the `state` table.
+        """
+        c = self.conn.cursor()
+        c.execute("DELETE FROM state WHERE key = ?;", (key,))
+        return c.rowcount
+
+
+def _to_timestamp(dt):
+    """
+    Converts a :class:`datetime.datetime` into the timestamp stored in the
+    `timestamp` column.
+    """
+    if not dt:
+        return None
+    return time.mktime(dt.timetuple())
+
+
+def _from_timestamp(timestamp):
+    """
+    Converts a timestamp, as stored by :meth:`SqliteBackend.add`, back into a
+    :class:`datetime.datetime`.
+    """
+    if timestamp is None:
+        return None
+    return datetime.fromtimestamp(timestamp)
@@ -0,0 +1,108 @@
+# This file is part of linesman.
+#
+# linesman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# linesman is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with linesman.  If not, see <http://www.gnu.org/licenses/>.
+#
+import threading
+
+try:
+    # Python 2.7+
+    from collections import OrderedDict
+except ImportError:
+    # Python 2.4+
+    from ordereddict import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Thread-safe, least-recently-used cache that is bounded by the total size
+    of its values, rather than by the number of entries.
+
+    ``max_size``:
+        Maximum total size of all cached values.  Values that are larger than
+        this on their own are never cached.
+    ``sizeof``:
+        Function that returns the size of a value, in the same units as
+        ``max_size``.  By default, every value has a size of `1`, which bounds
+        the number of entries instead.
+    """
+
+    def __init__(self, max_size, sizeof=lambda value: 1):
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        """
+        Returns the value stored for ``key``, marking it as recently used, or
+        ``default`` if it isn't cached.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return default
+            self._entries[key] = entry
+            return entry[0]
+
+    def set(self, key, value):
+        """
+        Caches ``value`` under ``key``, evicting the least recently used
+        values until everything fits.
+        """
+        size = self.sizeof(value)
+        with self._lock:
+            self._remove(key)
+            if size > self.max_size:
+                return
+
+            self._entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def discard(self, key):
+        """
+        Removes ``key`` from the cache, if it's present.
+        """
+        with self._lock:
+            self._remove(key)
+
+    def discard_where(self, predicate):
+        """
+        Removes every entry whose key matches ``predicate``.
+        """
+        with self._lock:
+            for key in [key for key in self._entries if predicate(key)]:
+                self._remove(key)
+
+    def clear(self):
+        """
+        Removes every entry from the cache.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
@@ -0,0 +1,318 @@
+# This file is part of linesman.
+#
+# linesman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# linesman is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with linesman.  If not, see <http://www.gnu.org/licenses/>.
+#
+import hashlib
+from array import array
+
+import networkx as nx
+
+
+# Order of the values stored for every node and edge, and the array type
+# used to store each of them.
+FIELDS = ('callcount', 'reccallcount', 'inlinetime', 'totaltime')
+TYPECODES = ('i', 'i', 'd', 'd')
+
+
+def _from_string(typecode, data):
+    column = array(typecode)
+    column.fromstring(data)
+    return column
+
+
+class CallGraphStructure(object):
+    """
+    The topology of a :class:`CallGraph`: its function keys, which of them
+    have stats, and its edges.  Requests to the same endpoint usually have
+    the same structure, so it is kept separately from the values of the
+    nodes and edges, and can be shared by many graphs.
+    """
+
+    def __init__(self, keys, has_stats, offsets, targets):
+        self.keys = keys
+        self.has_stats = has_stats
+        self.offsets = offsets
+        self.targets = targets
+        self._index = None
+        self._digest = None
+
+    @property
+    def index(self):
+        """
+        Dictionary of function key to node index.
+        """
+        if self._index is None:
+            self._index = dict((key, i) for i, key in enumerate(self.keys))
+        return self._index
+
+    @property
+    def digest(self):
+        """
+        Hex digest identifying this structure, which is the same for every
+        structure with the same keys and edges.
+        """
+        if self._digest is None:
+            digest = hashlib.sha1()
+            for data in self.__getstate__():
+                digest.update("%d:" % len(data))
+                digest.update(data)
+            self._digest = digest.hexdigest()
+        return self._digest
+
+    def __eq__(self, other):
+        if not isinstance(other, CallGraphStructure):
+            return NotImplemented
+        return self.__getstate__() == other.__getstate__()
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __getstate__(self):
+        # Plain strings pickle much faster than lists and arrays.
+        return ("\0".join(self.keys),
+                self.has_stats.tostring(),
+                self.offsets.tostring(),
+                self.targets.tostring())
+
+    def __setstate__(self, state):
+        keys, has_stats, offsets, targets = state
+        self.keys = keys.split("\0") if keys else []
+        self.has_stats = _from_string('b', has_stats)
+        self.offsets = _from_string('i', offsets)
+        self.targets = _from_string('i', targets)
+        self._index = None
+        self._digest = None
+
+
+class CallGraph(object):
+    """
+    Compact, read-only representation of a callgraph.  Rather than using a
+    dictionary per node and edge, like :class:`networkx.DiGraph` does, this
+    stores:
+
+        - a table of function keys, so that every node is identified by its
+          index in this table;
+        - the successors of each node in CSR form, where the successors of
+          node ``i`` are ``targets[offsets[i]:offsets[i + 1]]``;
+        - typed arrays of the ``callcount``, ``reccallcount``,
+          ``inlinetime`` and ``totaltime`` of every node and edge.
+
+    This makes sessions much smaller in memory and much faster to pickle.
+    Use :meth:`to_networkx` to get a graph that can be manipulated or drawn.
+
+    The keys and edges are kept in a :class:`CallGraphStructure`, which is
+    pickled as a separate object so that backends can store it only once.
+
+    Instances should be created using :meth:`from_dicts` or
+    :meth:`from_networkx`.
+    """
+
+    def __init__(self, keys, has_stats, node_values, offsets, targets,
+                 edge_values):
+        self.structure = CallGraphStructure(keys, has_stats, offsets,
+                                            targets)
+        self.node_values = node_values
+        self.edge_values = edge_values
+
+    keys = property(lambda self: self.structure.keys)
+    has_stats = property(lambda self: self.structure.has_stats)
+    offsets = property(lambda self: self.structure.offsets)
+    targets = property(lambda self: self.structure.targets)
+
+    @classmethod
+    def from_dicts(cls, nodes, edges):
+        """
+        Creates a new graph.
+
+        ``nodes``:
+            Dictionary of function key to a tuple of values, in the order of
+            :data:`FIELDS`.  The values may be `None` for functions that are
+            only known from being called by another function.
+        ``edges``:
+            Dictionary of `(caller key, callee key)` to a tuple of values, in
+            the order of :data:`FIELDS`.
+        """
+        nodes = dict(nodes)
+        for caller, callee in edges:
+            for key in (caller, callee):
+                if key not in nodes:
+                    nodes[key] = None
+        # Keys are sorted, so that the same topology always gets the same
+        # structure, and so the same digest, whatever order the dictionaries
+        # were built in.
+        keys = sorted(nodes)
+        index = dict((key, i) for i, key in enumerate(keys))
+
+        has_stats = array('b')
+        node_values = [array(typecode) for typecode in TYPECODES]
+        for key in keys:
+            values = nodes[key]
+            has_stats.append(values is not None)
+            for column, value in zip(node_values, values or (0, 0, 0, 0)):
+                column.append(value)
+
+        successors = [[] for key in keys]
+        for (caller, callee), values in edges.iteritems():
+            successors[index[caller]].append((index[callee], values))
+
+        offsets = array('i', [0])
+        targets = array('i')
+        edge_values = [array(typecode) for typecode in TYPECODES]
+        for node_successors in successors:
+            node_successors.sort()
+            for target, values in node_successors:
+                targets.append(target)
+                for column, value in zip(edge_values, values):
+                    column.append(value)
+            offsets.append(len(targets))
+
+        graph = cls(keys, has_stats, node_values, offsets, targets,
+                    edge_values)
+        graph.structure._index = index
+        return graph
+
+    @classmethod
+    def from_networkx(cls, graph):
+        """
+        Creates a new graph from a :class:`networkx.DiGraph`, such as the ones
+        stored by older versions of linesman.
+        """
+        nodes = {}
+        for node, data in graph.nodes_iter(data=True):
+            if data:
+                nodes[node] = tuple(data.get(field, 0) for field in FIELDS)
+            else:
+                nodes[node] = None
+
+        edges = {}
+        for caller, callee, data in graph.edges_iter(data=True):
+            edges[(caller, callee)] = tuple(data.get(field, 0)
+                                            for field in FIELDS)
+
+        return cls.from_dicts(nodes, edges)
+
+    @property
+    def index(self):
+        """
+        Dictionary of function key to node index.
+        """
+        return self.structure.index
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __eq__(self, other):
+        if not isinstance(other, CallGraph):
+            return NotImplemented
+        return self.__getstate__() == other.__getstate__()
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def node_data(self, i):
+        """
+        Returns a dictionary of the values of node ``i``, or an empty
+        dictionary if there are no stats for it.
+        """
+        if not self.has_stats[i]:
+            return {}
+        return dict((field, column[i])
+                    for field, column in zip(FIELDS, self.node_values))
+
+    def edge_data(self, j):
+        """
+        Returns a dictionary of the values of the edge at position ``j`` of
+        :attr:`targets`.
+        """
+        return dict((field, column[j])
+                    for field, column in zip(FIELDS, self.edge_values))
+
+    def successors(self, i):
+        """
+        Returns a list of `(edge position, callee index)` tuples for the
+        functions called by node ``i``.
+        """
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return zip(xrange(start, end), self.targets[start:end])
+
+    def edges(self):
+        """
+        Yields a `(caller index, callee index, edge position)` tuple for every
+        edge in the graph.
+        """
+        for i in xrange(len(self.keys)):
+            for j, target in self.successors(i):
+                yield i, target, j
+
+    @property
+    def nbytes(self):
+        """
+        Rough estimate of the memory used by this graph, in bytes.
+        """
+        arrays = ([self.has_stats, self.offsets, self.targets] +
+                  self.node_values + self.edge_values)
+        return (sum(len(a) * a.itemsize for a in arrays) +
+                sum(len(key) for key in self.keys))
+
+    def to_networkx(self):
+        """
+        Returns a new :class:`networkx.DiGraph` with the same nodes, edges and
+        attributes as the graphs created by :func:`~linesman.create_graph`.
+        """
+        # Create a graph; dot graphs need names, so just use `G' so that
+        # pygraphviz doesn't complain when we render it.
+        g = nx.DiGraph(name="G")
+
+        keys = self.keys
+        for i, key in enumerate(keys):
+            g.add_node(key, attr_dict=self.node_data(i))
+
+        for i, target, j in self.edges():
+            attrs = self.edge_data(j)
+            g.add_edge(keys[i], keys[target],
+                       weight=attrs['totaltime'],
+                       label=attrs['totaltime'],
+                       attr_dict=attrs)
+
+        return g
+
+    def __getstate__(self):
+        return (self.structure,
+                tuple(column.tostring() for column in self.node_values),
+                tuple(column.tostring() for column in self.edge_values))
+
+    def __setstate__(self, state):
+        if len(state) == 6:
+            # Graphs pickled before the structure was split out.
+            (keys, has_stats, node_values, offsets, targets,
+             edge_values) = state
+            structure = CallGraphStructure.__new__(CallGraphStructure)
+            structure.__setstate__((keys, has_stats, offsets, targets))
+        else:
+            structure, node_values, edge_values = state
+
+        self.structure = structure
+        self.node_values = [_from_string(typecode, data)
+                            for typecode, data in zip(TYPECODES, node_values)]
+        self.edge_values = [_from_string(typecode, data)
+                            for typecode, data in zip(TYPECODES, edge_values)]
@@ -0,0 +1,182 @@
+# This file is part of linesman.
+#
+# linesman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# linesman is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with linesman.  If not, see <http://www.gnu.org/licenses/>.
+#
+import heapq
+from collections import namedtuple
+from itertools import izip
+
+import networkx as nx
+
+from linesman.callgraph import FIELDS
+
+
+# Fields that functions and calls can be ranked by.
+DIFF_ORDERS = ("totaltime", "inlinetime", "callcount")
+
+_ZEROS = (0,) * len(FIELDS)
+
+
+class Delta(namedtuple("Delta", "key before after")):
+    """
+    The stats of a function, or of a call between two functions, in two
+    profiles.  ``before`` and ``after`` are tuples of values in the order of
+    :data:`~linesman.callgraph.FIELDS`, or `None` if the function or call
+    isn't in that profile.
+    """
+
+    __slots__ = ()
+
+    def value(self, field, profile="after"):
+        """
+        Returns ``field`` of the ``profile`` (`before` or `after`) stats.
+        """
+        values = getattr(self, profile) or _ZEROS
+        return values[FIELDS.index(field)]
+
+    def delta(self, field):
+        """
+        Returns how much ``field`` grew from ``before`` to ``after``.
+        """
+        i = FIELDS.index(field)
+        return (self.after or _ZEROS)[i] - (self.before or _ZEROS)[i]
+
+
+def _node_stats(callgraph):
+    """
+    Returns a dictionary of function key to the values of each node of
+    ``callgraph`` that has stats.
+    """
+    rows = zip(*callgraph.node_values)
+    return dict((key, row)
+                for key, row, has_stats in izip(callgraph.keys, rows,
+                                                callgraph.has_stats)
+                if has_stats)
+
+
+def _edge_stats(callgraph):
+    """
+    Returns a dictionary of `(caller key, callee key)` to the values of each
+    edge of ``callgraph``.
+    """
+    keys = callgraph.keys
+    rows = zip(*callgraph.edge_values)
+    return dict(((keys[i], keys[target]), rows[j])
+                for i, target, j in callgraph.edges())
+
+
+def _align(before, after):
+    """
+    Pairs the values of ``before`` and ``after`` by key.  This is a hash
+    join, so it takes time linear in the size of both dictionaries.
+    """
+    deltas = dict((key, Delta(key, values, after.get(key)))
+                  for key, values in before.iteritems())
+    for key, values in after.iteritems():
+        if key not in deltas:
+            deltas[key] = Delta(key, None, values)
+    return deltas
+
+
+def _top(deltas, order_by, limit):
+    if order_by not in DIFF_ORDERS:
+        raise ValueError("Cannot rank differences by %r" % order_by)
+    key = lambda delta: abs(delta.delta(order_by))
+    if limit is None:
+        return sorted(deltas, key=key, reverse=True)
+    return heapq.nlargest(int(limit), deltas, key=key)
+
+
+class ProfileDiff(object):
+    """
+    The differences between the callgraphs of two profiles, which can be
+    sessions or aggregate profiles.  Functions are matched by their key, as
+    generated when the profiles were created, so this takes time linear in
+    the size of both callgraphs.
+
+    ``before``, ``after``:
+        The profiles to compare; anything with a `_callgraph` and a
+        `duration`.
+    """
+
+    def __init__(self, before, after):
+        self.before = before
+        self.after = after
+        before_graph = before._callgraph
+        after_graph = after._callgraph
+        self.functions = _align(_node_stats(before_graph),
+                                _node_stats(after_graph))
+        self.calls = _align(_edge_stats(before_graph),
+                            _edge_stats(after_graph))
+
+    @property
+    def duration_delta(self):
+        return (self.after.duration or 0) - (self.before.duration or 0)
+
+    def top_functions(self, order_by="totaltime", limit=20):
+        """
+        Returns the :class:`Delta` of the ``limit`` functions that changed
+        the most in ``order_by``, one of :data:`DIFF_ORDERS`, largest first.
+        """
+        return _top(self.functions.itervalues(), order_by, limit)
+
+    def top_calls(self, order_by="totaltime", limit=20):
+        """
+        Returns the :class:`Delta` of the ``limit`` calls between functions
+        that changed the most in ``order_by``, largest first.  The key of
+        each is a `(caller key, callee key)` tuple.
+        """
+        return _top(self.calls.itervalues(), order_by, limit)
+
+    def to_networkx(self, min_totaltime=None):
+        """
+        Returns a :class:`networkx.DiGraph` of every function and call in
+        either profile.  The `callcount`, `inlinetime` and `totaltime` of
+        each are the largest of the two profiles, so that the graph can be
+        pruned by :func:`~linesman.middleware.prepare_graph` without losing
+        functions that got faster, and `before_*`, `after_*` and `delta_*`
+        attributes hold the values of each profile and their difference.
+
+        ``min_totaltime``:
+            If given, functions that took less than this many seconds in
+            both profiles are left out, which saves building nodes that
+            would be pruned anyway.
+        """
+        g = nx.DiGraph(name="G")
+        for key, delta in self.functions.iteritems():
+            if (min_totaltime is not None and
+                    max(delta.value("totaltime", "before"),
+                        delta.value("totaltime", "after")) < min_totaltime):
+                continue
+            g.add_node(key, attr_dict=_attributes(delta))
+        for (caller, callee), delta in self.calls.iteritems():
+            if min_totaltime is not None and (caller not in g or
+                                              callee not in g):
+                continue
+            attrs = _attributes(delta)
+            g.add_edge(caller, callee, weight=attrs['totaltime'],
+                       label=attrs['delta_totaltime'], attr_dict=attrs)
+        return g
+
+
+def _attributes(delta):
+    attrs = {}
+    for field in FIELDS:
+        before = delta.value(field, "before")
+        after = delta.value(field, "after")
+        attrs[field] = max(before, after)
+        attrs['before_' + field] = before
+        attrs['after_' + field] = after
+        attrs['delta_' + field] = after - before
+    return attrs
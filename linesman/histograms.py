@@ -0,0 +1,226 @@
+# This file is part of linesman.
+#
+# linesman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# linesman is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with linesman.  If not, see <http://www.gnu.org/licenses/>.
+#
+import math
+import time
+from datetime import datetime
+
+from linesman.windows import WindowedStore
+
+
+# Histograms are stored by the backend under keys starting with this.
+STATE_PREFIX = "latency:"
+
+# Durations are clamped to this range, so that the number of buckets is
+# bounded no matter what is recorded.  Shorter durations are all counted as
+# zero.
+MIN_VALUE = 1e-6
+MAX_VALUE = 1e5
+
+# Percentiles shown by default
+DEFAULT_PERCENTILES = (50, 90, 95, 99)
+
+
+class LatencyHistogram(object):
+    """
+    Counts durations in logarithmically sized buckets, so that any
+    percentile can be estimated to within ``relative_accuracy`` of the true
+    value, using a bounded amount of memory.  Histograms with the same
+    accuracy can be merged, which gives the histogram of all of their
+    durations.
+
+    With the default accuracy of 1%, durations between a microsecond and a
+    day need at most around 1200 buckets, and requests to an endpoint
+    usually fall into a few dozen of them.
+
+    ``endpoint``, ``bucket_start``, ``bucket_seconds``:
+        The endpoint and window of time that the durations were recorded
+        for, if any; see :class:`HistogramStore`.
+    ``relative_accuracy``:
+        Maximum relative error of the estimated percentiles.
+    """
+
+    def __init__(self, endpoint=None, bucket_start=None, bucket_seconds=None,
+                 relative_accuracy=0.01):
+        relative_accuracy = float(relative_accuracy)
+        if not 0 < relative_accuracy < 1:
+            raise ValueError("relative_accuracy must be between 0 and 1, "
+                             "not %r" % relative_accuracy)
+        self.endpoint = endpoint
+        self.bucket_start = bucket_start
+        self.bucket_seconds = bucket_seconds
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+
+        self.count = 0
+        self.zero_count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        # Number of durations in each bucket; bucket `i' holds durations in
+        # `(gamma ** (i - 1), gamma ** i]'.
+        self.buckets = {}
+
+    def add(self, value, count=1):
+        """
+        Records ``count`` durations of ``value`` seconds.
+        """
+        self.count += count
+        self.sum += value * count
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+        if value <= MIN_VALUE:
+            self.zero_count += count
+            return
+        index = int(math.ceil(math.log(min(value, MAX_VALUE)) /
+                              self._log_gamma))
+        self.buckets[index] = self.buckets.get(index, 0) + count
+
+    def merge(self, other):
+        """
+        Adds the durations recorded by ``other`` to this histogram.
+
+        Raises a :class:`ValueError` if the histograms don't have the same
+        accuracy.
+        """
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Cannot merge histograms with different "
+                             "accuracies (%r and %r)" % (
+                                 self.relative_accuracy,
+                                 other.relative_accuracy))
+        if not other.count:
+            return
+        self.count += other.count
+        self.zero_count += other.zero_count
+        self.sum += other.sum
+        if self.min is None or other.min < self.min:
+            self.min = other.min
+        if self.max is None or other.max > self.max:
+            self.max = other.max
+        buckets = self.buckets
+        for index, count in other.buckets.iteritems():
+            buckets[index] = buckets.get(index, 0) + count
+
+    @property
+    def timestamp(self):
+        """
+        Start of the window of time, as a :class:`datetime.datetime`, or
+        `None` if the histogram isn't for a single window.
+        """
+        if self.bucket_start is None:
+            return None
+        return datetime.fromtimestamp(self.bucket_start)
+
+    @property
+    def mean(self):
+        if not self.count:
+            return None
+        return self.sum / self.count
+
+    def percentiles(self, percentiles=DEFAULT_PERCENTILES):
+        """
+        Returns the estimated durations at each of ``percentiles``, which
+        are numbers between 0 and 100, in a single pass over the buckets.
+        Returns `None` for each percentile if nothing has been recorded.
+        """
+        if not self.count:
+            return [None] * len(percentiles)
+
+        # The rank of each percentile, in increasing order
+        ranks = sorted((p / 100.0 * (self.count - 1), i)
+                       for i, p in enumerate(percentiles))
+        results = [None] * len(percentiles)
+        r = 0
+
+        seen = self.zero_count
+        while r < len(ranks) and ranks[r][0] < seen:
+            results[ranks[r][1]] = 0.0
+            r += 1
+
+        for index in sorted(self.buckets):
+            if r == len(ranks):
+                break
+            seen += self.buckets[index]
+            # Estimate each value as the point of the bucket that is within
+            # the relative accuracy of both of its bounds.
+            value = 2 * self.gamma ** index / (self.gamma + 1)
+            value = max(self.min, min(value, self.max))
+            while r < len(ranks) and ranks[r][0] < seen:
+                results[ranks[r][1]] = value
+                r += 1
+
+        for rank, i in ranks[r:]:
+            results[i] = self.max
+        return results
+
+    def percentile(self, percentile):
+        """
+        Returns the estimated duration at ``percentile``, a number between 0
+        and 100.
+        """
+        return self.percentiles([percentile])[0]
+
+
+class HistogramStore(WindowedStore):
+    """
+    Records the duration of requests in a :class:`LatencyHistogram` per
+    endpoint and window of time; see :class:`~linesman.windows.WindowedStore`
+    for the other arguments.
+
+    ``relative_accuracy``:
+        Relative accuracy of the histograms.
+    """
+
+    state_prefix = STATE_PREFIX
+
+    def __init__(self, backend, bucket_seconds=3600, max_buckets=24,
+                 flush_interval=60, relative_accuracy=0.01, max_endpoints=0):
+        super(HistogramStore, self).__init__(backend, bucket_seconds,
+                                             max_buckets, flush_interval,
+                                             max_endpoints)
+        self.relative_accuracy = float(relative_accuracy)
+
+    def create(self, endpoint, bucket_start):
+        return LatencyHistogram(endpoint, bucket_start, self.bucket_seconds,
+                                self.relative_accuracy)
+
+    def add(self, endpoint, duration, timestamp=None):
+        """
+        Records a request to ``endpoint`` that took ``duration`` seconds,
+        and started at ``timestamp`` seconds since the epoch, or now.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        super(HistogramStore, self).add(endpoint, timestamp, duration)
+
+    def merged(self, since=None):
+        """
+        Returns a dictionary of endpoint to a :class:`LatencyHistogram` of
+        every duration recorded for it, in the windows that end after
+        ``since`` seconds since the epoch, if given.
+        """
+        histograms = {}
+        for window in self.list(since=since):
+            histogram = histograms.get(window.endpoint)
+            if histogram is None:
+                histogram = histograms[window.endpoint] = LatencyHistogram(
+                    window.endpoint, relative_accuracy=self.relative_accuracy)
+            with self._lock:
+                histogram.merge(window)
+        return histograms
@@ -0,0 +1,389 @@
+# This file is part of linesman.
+#
+# linesman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# linesman is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with linesman.  If not, see <http://www.gnu.org/licenses/>.
+#
+import copy
+import heapq
+import logging
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+
+from linesman.callgraph import FIELDS
+from linesman.windows import WindowedStore
+
+
+log = logging.getLogger(__name__)
+
+# Totals are stored by the backend under keys starting with this.
+STATE_PREFIX = "hotspots:"
+
+# The index isn't kept per endpoint, so every window is stored under this.
+ALL_ENDPOINTS = "*"
+
+# Fields that functions can be ranked by.
+HOTSPOT_ORDERS = ("inlinetime", "totaltime", "callcount")
+
+
+def session_time(session):
+    """
+    Returns the time ``session`` started at, in seconds since the epoch, or
+    the current time if it doesn't have a timestamp.
+    """
+    if session.timestamp:
+        return time.mktime(session.timestamp.timetuple())
+    return time.time()
+
+
+class Hotspot(namedtuple("Hotspot", ("key",) + FIELDS)):
+    """
+    The summed stats of a function across many sessions.
+    """
+
+    __slots__ = ()
+
+
+class FunctionTotals(object):
+    """
+    The summed stats of every function called by the sessions within a
+    window of time, whatever their endpoint.
+
+    ``endpoint``, ``bucket_start``, ``bucket_seconds``:
+        The window of time; see :class:`HotspotStore`.
+    """
+
+    def __init__(self, endpoint=ALL_ENDPOINTS, bucket_start=None,
+                 bucket_seconds=None):
+        self.endpoint = endpoint
+        self.bucket_start = bucket_start
+        self.bucket_seconds = bucket_seconds
+        self.session_count = 0
+        self.duration = 0.0
+        # Summed values of every function, in the order of `FIELDS'.
+        self.functions = {}
+
+    def __deepcopy__(self, memo):
+        # The values are plain numbers, so copying the lists is enough.
+        other = copy.copy(self)
+        other.functions = dict((key, list(values))
+                               for key, values in self.functions.iteritems())
+        return other
+
+    @property
+    def timestamp(self):
+        if self.bucket_start is None:
+            return None
+        return datetime.fromtimestamp(self.bucket_start)
+
+    def add(self, session, sign=1):
+        """
+        Adds the stats of every function called by ``session``, or subtracts
+        them if ``sign`` is -1.
+        """
+        callgraph = session._callgraph
+        has_stats = callgraph.has_stats
+        node_values = callgraph.node_values
+
+        functions = self.functions
+        for i, key in enumerate(callgraph.keys):
+            if not has_stats[i]:
+                continue
+            totals = functions.get(key)
+            if totals is None:
+                totals = functions[key] = [0] * len(FIELDS)
+            for f, column in enumerate(node_values):
+                totals[f] += sign * column[i]
+            if sign < 0 and totals[0] <= 0:
+                del functions[key]
+
+        self.session_count += sign
+        self.duration += sign * (session.duration or 0)
+
+    def remove(self, session):
+        """
+        Subtracts the stats of ``session``, which must have been added.
+        Functions that are left without any calls are removed.
+        """
+        self.add(session, -1)
+
+    def merge(self, other, sign=1):
+        """
+        Adds the totals of ``other`` to these, or subtracts them if ``sign``
+        is -1.  Functions that are left without any calls are removed.
+        """
+        functions = self.functions
+        for key, values in other.functions.iteritems():
+            totals = functions.get(key)
+            if totals is None:
+                totals = functions[key] = [0] * len(FIELDS)
+            for f, value in enumerate(values):
+                totals[f] += sign * value
+            if sign < 0 and totals[0] <= 0:
+                del functions[key]
+        self.session_count += sign * other.session_count
+        self.duration += sign * other.duration
+
+    def top(self, order_by="totaltime", limit=20):
+        """
+        Returns a :class:`Hotspot` for each of the ``limit`` functions with
+        the largest ``order_by``, one of :data:`HOTSPOT_ORDERS`, largest
+        first.
+
+        Raises a :class:`ValueError` if ``order_by`` isn't valid.
+        """
+        if order_by not in HOTSPOT_ORDERS:
+            raise ValueError("Cannot rank functions by %r" % order_by)
+        f = FIELDS.index(order_by)
+        top = heapq.nlargest(int(limit), self.functions.iteritems(),
+                             key=lambda item: item[1][f])
+        return [Hotspot(key, *values) for key, values in top]
+
+
+class SessionRebuilder(object):
+    """
+    Adds the stored sessions of ``backend`` to an index, such as
+    :class:`HotspotStore`, on a background thread.  Sessions that are added
+    to or removed from the index directly in the meantime are only counted
+    once; see :meth:`apply`.
+
+    ``add``:
+        Function that adds a session to the index.
+    """
+
+    def __init__(self, backend, add):
+        self.backend = backend
+        self._add = add
+        self._lock = threading.Lock()
+        self._started = None
+        # Sessions given to the index while rebuilding, and sessions
+        # rebuilt that may still be added directly afterwards.
+        self._seen = None
+        self._late = set()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, target):
+        """
+        Runs ``target``, which should call :meth:`run`, on a new thread.
+        Sessions added to the index from now on are left out of the rebuild.
+        """
+        self._started = time.time()
+        self._seen = set()
+        self._thread = threading.Thread(target=target,
+                                        name="linesman-rebuild")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def run(self, since=None):
+        """
+        Adds every stored session that started after ``since``, loading them
+        one at a time, and returns how many were added.
+        """
+        # Backends may only keep timestamps to the second, so sessions from
+        # the second the rebuild started may also be added directly.
+        started = int(self._started or time.time())
+        late = datetime.fromtimestamp(started)
+        until = datetime.fromtimestamp(started + 1)
+        late_uuids = set()
+        count = 0
+        try:
+            for summary in self.backend.iter_summaries(since=since,
+                                                       until=until):
+                if self._stop.is_set():
+                    break
+                session = self.backend.get(summary.uuid)
+                if session is not None and self.apply(session, self._add):
+                    count += 1
+                    if summary.timestamp >= late:
+                        late_uuids.add(session.uuid)
+        finally:
+            with self._lock:
+                self._seen = None
+                self._late = late_uuids
+        return count
+
+    def apply(self, session, func, adding=True):
+        """
+        Calls ``func`` with ``session``, unless the index has already been
+        given it while rebuilding, or, if ``adding`` is False, hasn't been
+        given it yet.  Returns False if ``func`` wasn't called, and its
+        result otherwise.
+        """
+        with self._lock:
+            if session.uuid in self._late:
+                self._late.discard(session.uuid)
+                if adding:
+                    return False
+            elif self._seen is not None:
+                seen = session.uuid in self._seen
+                self._seen.add(session.uuid)
+                if seen == adding:
+                    return False
+            return func(session)
+
+    def join(self):
+        """
+        Waits for the rebuild to finish.
+        """
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stop(self):
+        """
+        Stops the rebuild, and waits for it to do so.
+        """
+        self._stop.set()
+        self.join()
+
+
+class HotspotStore(WindowedStore):
+    """
+    Index of the summed stats of every function across all stored sessions,
+    kept in a :class:`FunctionTotals` per window of time, so that the
+    functions that took the most time can be listed without loading any
+    sessions; see :class:`~linesman.windows.WindowedStore`.
+
+    The totals of every window kept are also summed as sessions are added,
+    so that the functions of the whole history can be ranked in time
+    proportional to the number of distinct functions.
+
+    Sessions should be removed with :meth:`remove` before they are deleted,
+    so that the index only ever includes stored sessions.
+    """
+
+    state_prefix = STATE_PREFIX
+
+    def __init__(self, *args, **kwargs):
+        super(HotspotStore, self).__init__(*args, **kwargs)
+        self._totals = FunctionTotals()
+        self._rebuilder = SessionRebuilder(self.backend, self._add_session)
+
+    def create(self, endpoint, bucket_start):
+        return FunctionTotals(endpoint, bucket_start, self.bucket_seconds)
+
+    def load(self):
+        """
+        Loads the totals persisted by the backend.  If there are none, the
+        index is rebuilt from the stored sessions on a background thread;
+        see :meth:`rebuild`.
+        """
+        super(HotspotStore, self).load()
+        with self._lock:
+            self._totals = FunctionTotals()
+            for window in self._windows.itervalues():
+                self._totals.merge(window)
+            missing = not self._windows
+        if missing:
+            self._rebuilder.start(self.rebuild)
+
+    def rebuild(self):
+        """
+        Adds every stored session that started within the windows kept to
+        the index, loading them one at a time.  Sessions that start once
+        this has begun are left to be added as they are stored.
+        """
+        since = None
+        if self.max_buckets:
+            now = time.time()
+            since = datetime.fromtimestamp(
+                now - now % self.bucket_seconds -
+                (self.max_buckets - 1) * self.bucket_seconds)
+
+        count = self._rebuilder.run(since)
+        if count:
+            log.info("Rebuilt the function index from %d sessions.", count)
+            self.flush()
+
+    def close(self):
+        """
+        Stops any rebuild of the index, and then writes the totals that
+        changed.
+        """
+        self._rebuilder.stop()
+        super(HotspotStore, self).close()
+
+    def add(self, session):
+        """
+        Adds ``session`` to the totals of the window it started in.
+        """
+        self._rebuilder.apply(session, self._add_session)
+
+    def remove(self, session):
+        """
+        Subtracts ``session`` from the totals of the window it started in,
+        if that window is still kept.
+        """
+        return self._rebuilder.apply(session, self._remove_session,
+                                     adding=False)
+
+    def _add_session(self, session):
+        super(HotspotStore, self).add(ALL_ENDPOINTS, session_time(session),
+                                      session)
+        return True
+
+    def _remove_session(self, session):
+        return super(HotspotStore, self).remove(ALL_ENDPOINTS,
+                                                session_time(session),
+                                                session)
+
+    def _add_to(self, window, session):
+        window.add(session)
+        self._totals.add(session)
+
+    def _remove_from(self, window, session):
+        window.remove(session)
+        self._totals.remove(session)
+
+    def _on_evict(self, window):
+        self._totals.merge(window, -1)
+
+    def _on_clear(self):
+        self._totals = FunctionTotals()
+
+    def totals(self, since=None, until=None):
+        """
+        Returns a :class:`FunctionTotals` of the sessions in the windows that
+        overlap the range ``since`` to ``until``, in seconds since the
+        epoch.  Either may be `None` to leave the range open.
+        """
+        windows = [window for window in self.list(since=since)
+                   if until is None or window.bucket_start < until]
+        totals = FunctionTotals()
+        with self._lock:
+            for window in windows:
+                totals.merge(window)
+        return totals
+
+    def top(self, order_by="totaltime", limit=20, since=None, until=None):
+        """
+        Returns the ``limit`` functions with the largest ``order_by``, in the
+        windows that overlap the range ``since`` to ``until``; see
+        :meth:`FunctionTotals.top`.  Without a range, this uses the totals
+        summed as sessions were added, and so doesn't depend on the number
+        of windows kept.
+        """
+        if since is None and until is None:
+            with self._lock:
+                return self._totals.top(order_by, limit)
+        return self.totals(since, until).top(order_by, limit)
+
+    @property
+    def session_count(self):
+        return self._totals.session_count
+
+    @property
+    def duration(self):
+        return self._totals.duration
@@ -1,12 +1,72 @@
 $(function(){
     var slideSpeed = "fast";
-    $('#callhierarchy .row').click(function() {
+
+    // Builds a list item for a node returned by the `children' JSON
+    // endpoint, the same way the template renders the root nodes.
+    var renderNode = function(node) {
+        var li = $('<li class="profile-stats"/>')
+            .addClass(node.has_children ? 'closed' : 'leaf')
+            .attr('title', node.node);
+        var measurements = $('<span class="measurements"/>');
+        if (node.callcount > 1) {
+            measurements.append(
+                $('<span class="count"/>').text('x' + node.callcount));
+        }
+        measurements.append($('<span class="time"/>').text(node.totaltime));
+        measurements.append(
+            $('<span class="graph"><span class="bar">' +
+              '<span class="bar-inlinetime">&nbsp</span>' +
+              '<span class="bar-totaltime">&nbsp</span>' +
+              '</span></span>'));
+        measurements.find('.bar-inlinetime')
+            .css('width', node.inlinetime_percent + '%');
+        measurements.find('.bar-totaltime')
+            .css('width', (node.totaltime_percent -
+                           node.inlinetime_percent) + '%');
+        if (window.SPARKLINES_URL) {
+            measurements.append($('<span class="sparkline"/>'));
+        }
+
+        $('<span class="row"/>')
+            .append($('<span class="module"/>').text(node.node))
+            .append(measurements)
+            .appendTo(li);
+        li.append('<ul/>');
+        return li;
+    };
+
+    // Pages can display other kinds of nodes by defining their own
+    // `renderTreeNode' function.
+    var render = function(node) {
+        return (window.renderTreeNode || renderNode)(node);
+    };
+
+    // Children are only loaded the first time a node is expanded.
+    $('#callhierarchy .row').live('click', function() {
         // navigate up to the nearest parent list item
         var parent_li = $(this).parent('li');
-        if (parent_li.hasClass('leaf')) {
+        if (parent_li.hasClass('leaf') || parent_li.hasClass('loading')) {
+            return false;
+        }
+        var children = parent_li.children('ul');
+        if (parent_li.hasClass('closed') && !parent_li.data('loaded')) {
+            parent_li.addClass('loading');
+            $.getJSON(CHILDREN_URL, {node: parent_li.attr('title')},
+                      function(nodes) {
+                children.hide();
+                $.each(nodes, function(i, node) {
+                    children.append(render(node));
+                });
+                parent_li.data('loaded', true);
+                parent_li.removeClass('loading closed').addClass('open');
+                children.show(slideSpeed);
+                children.trigger('nodesloaded');
+            }).error(function() {
+                parent_li.removeClass('loading');
+            });
             return false;
         }
-        parent_li.children('ul').toggle(slideSpeed);
+        children.toggle(slideSpeed);
         parent_li.toggleClass('open closed');
     });
 });
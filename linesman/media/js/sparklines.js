@@ -0,0 +1,67 @@
+$(function(){
+    var width = 100;
+    var height = 14;
+    var svgNS = 'http://www.w3.org/2000/svg';
+
+    // Draws the mean time per call of each point as a line, placed by time
+    // between `since' and `until'.
+    var draw = function(span, points, since, until) {
+        if (since === null && points.length) {
+            since = points[0][0];
+        }
+        var max = 0;
+        var values = $.map(points, function(point) {
+            // Points are [start, callcount, reccallcount, inlinetime,
+            // totaltime].
+            var value = point[1] ? point[4] / point[1] : 0;
+            max = Math.max(max, value);
+            return [[point[0], value]];
+        });
+        var coords = $.map(values, function(point) {
+            var x = until > since ?
+                (point[0] - since) / (until - since) * width : width;
+            var y = max ? height - point[1] / max * (height - 1) : height;
+            return x.toFixed(1) + ',' + y.toFixed(1);
+        });
+
+        var svg = document.createElementNS(svgNS, 'svg');
+        svg.setAttribute('width', width);
+        svg.setAttribute('height', height);
+        var line = document.createElementNS(svgNS, 'polyline');
+        line.setAttribute('points', coords.join(' '));
+        line.setAttribute('fill', 'none');
+        line.setAttribute('stroke', 'black');
+        svg.appendChild(line);
+        span.empty().attr('title', values.length ?
+            'Up to ' + max.toPrecision(3) + 's per call' : 'No history')
+            .append(svg);
+    };
+
+    // Loads the series of every function in `items' with a single request.
+    var load = function(items) {
+        if (!items.length) {
+            return;
+        }
+        var keys = items.map(function() {
+            return $(this).attr('title');
+        }).get();
+        $.ajax({
+            url: SPARKLINES_URL,
+            data: $.param({key: keys}, true),
+            dataType: 'json',
+            success: function(data) {
+                items.each(function() {
+                    var li = $(this);
+                    var points = data.series[li.attr('title')] || [];
+                    draw(li.find('> .row .sparkline'), points, data.since,
+                         data.until);
+                });
+            }
+        });
+    };
+
+    load($('#callhierarchy > li.profile-stats'));
+    $('#callhierarchy').bind('nodesloaded', function(event) {
+        load($(event.target).children('li.profile-stats'));
+    });
+});
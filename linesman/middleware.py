@@ -13,21 +13,36 @@
 # You should have received a copy of the GNU General Public License along
 # with linesman.  If not, see <http://www.gnu.org/licenses/>.
 #
+import atexit
+import json
 import logging
 import os
+import time
 from cProfile import Profile
+from cgi import escape
 from datetime import datetime
 from tempfile import gettempdir
 
 from PIL import Image
-import networkx as nx
 from mako.lookup import TemplateLookup
 from paste.urlparser import StaticURLParser
+from paste.util.converters import asbool
 from pkg_resources import resource_filename
 from webob import Request, Response
 from webob.exc import HTTPNotFound
 
 from linesman import ProfilingSession, draw_graph
+from linesman.aggregates import AggregateStore, is_aggregate_id
+from linesman.cache import LRUCache
+from linesman.diff import DIFF_ORDERS, ProfileDiff
+from linesman.histograms import DEFAULT_PERCENTILES, HistogramStore
+from linesman.hotspots import HOTSPOT_ORDERS, HotspotStore
+from linesman.profilers import StackSampler
+from linesman.render import RenderPool, placeholder_image
+from linesman.routing import RouteNormalizer
+from linesman.sampling import RequestSampler
+from linesman.timeseries import TimeSeriesStore, parse_resolutions
+from linesman.workers import BackgroundWorker
 
 
 log = logging.getLogger(__name__)
@@ -40,6 +55,37 @@ ENABLED_FLAG_FILE = 'linesman-enabled'
 
 CUTOFF_TIME_UNITS = 1e9  # Nanoseconds per second
 
+# Percentage of the total time below which calls are hidden by default
+DEFAULT_CUTOFF_PERCENT = 5
+
+# Rough number of bytes used by each node or edge of a networkx graph, used
+# to estimate the size of cached views.
+NX_BYTES_PER_ITEM = 600
+
+# Columns of the session list, by DataTables column index, and the field the
+# backend sorts them by; `None' if the column can't be sorted.
+SESSION_LIST_ORDERS = ("path", None, None, "duration", "timestamp", None)
+
+# Most sessions returned for a single page of the session list
+MAX_SESSION_LIST_LENGTH = 1000
+
+# Most sessions deleted at once when deleting the filtered session list, so
+# that any number of them can be deleted in constant memory.
+DELETE_BATCH_SIZE = 500
+
+# Formats accepted by the timestamp filter of the session list
+TIMESTAMP_FORMATS = ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d")
+
+
+def _import_object(path):
+    """
+    Imports and returns the object referred to by ``path``, which should be
+    of the form `module.name:object_name`.
+    """
+    module_name, sep, object_name = path.rpartition(":")
+    module = __import__(module_name, fromlist=[object_name], level=0)
+    return getattr(module, object_name)
+
 
 class ProfilingMiddleware(object):
     """
@@ -58,24 +104,103 @@ class ProfilingMiddleware(object):
         an implementation of :class:`~linesman.backend.Backend`.
     ``chart_packages``:
         Space separated list of packages to be charted in the pie graph.
+    ``sample_rate``:
+        Probability, between `0.0` and `1.0`, that a request is profiled.
+    ``sample_every``:
+        Only every Nth request is considered for profiling.
+    ``max_profiles_per_second``:
+        Upper bound on the number of requests profiled per second.  If not
+        set, no limit is applied.
+    ``engine``:
+        Profiler used to capture requests.  This can be `cprofile` (the
+        default) for deterministic tracing, `sampling` for the low-overhead
+        :class:`~linesman.profilers.StackSampler`, or a full path to a class,
+        in the same format as ``backend``, that provides ``enable()``,
+        ``disable()`` and ``getstats()``.
+    ``sampling_interval``:
+        Seconds between stack samples when using the `sampling` engine.
+    ``ingest_queue_size``:
+        If greater than `0`, profiled requests are turned into sessions and
+        stored by a background thread, and up to this many profiles can be
+        waiting to be stored.  Otherwise, this happens before the response is
+        returned.
+    ``ingest_drop_policy``:
+        What to do with a profile when the ingest queue is full.  See
+        :class:`~linesman.workers.BackgroundWorker`.
+    ``cache_size_mb``:
+        Approximate amount of memory, in megabytes, used to cache loaded
+        sessions and prepared profile views.
+    ``render_workers``:
+        Number of threads used to render graphs.  If `0`, graphs are
+        rendered by the request that needs them.
+    ``prerender_graphs``:
+        If true, the graph shown by default on a session's profile page is
+        rendered as soon as the session is stored.
     """
 
     def __init__(self, app,
                        profiler_path="/__profiler__",
                        backend="linesman.backends.sqlite:SqliteBackend",
                        chart_packages="",
+                       sample_rate=1.0,
+                       sample_every=1,
+                       max_profiles_per_second=None,
+                       engine="cprofile",
+                       sampling_interval=0.005,
+                       ingest_queue_size=0,
+                       ingest_drop_policy="newest",
+                       cache_size_mb=64,
+                       render_workers=2,
+                       prerender_graphs=False,
+                       route_patterns="",
+                       aggregate_window=0,
+                       aggregate_buckets=24,
+                       aggregate_flush_interval=60,
+                       latency_window=0,
+                       latency_buckets=24,
+                       latency_accuracy=0.01,
+                       latency_flush_interval=60,
+                       latency_max_endpoints=1000,
+                       hotspot_window=0,
+                       hotspot_buckets=24,
+                       hotspot_flush_interval=60,
+                       timeseries_resolutions="",
+                       timeseries_flush_interval=60,
                        **kwargs):
         self.app = app
         self.profiler_path = profiler_path
 
+        # Decides which requests get profiled while profiling is enabled.
+        if max_profiles_per_second in ("", None):
+            max_profiles_per_second = None
+        self.sampler = RequestSampler(rate=sample_rate,
+                                      every=sample_every,
+                                      max_per_second=max_profiles_per_second)
+
         # Always reverse sort these packages, so that child packages of the
         # same module will always be picked first.
         self.chart_packages = sorted(chart_packages.split(), reverse=True)
 
+        # Maps request paths to the endpoints they are grouped under
+        self.route_normalizer = RouteNormalizer(route_patterns)
+
+        # Setup the profiler engine
+        if engine == "cprofile":
+            self._create_profiler = Profile
+        elif engine == "sampling":
+            sampling_interval = float(sampling_interval)
+            self._create_profiler = lambda: StackSampler(sampling_interval)
+        else:
+            self._create_profiler = _import_object(engine)
+
         # Setup the backend
-        module_name, sep, class_name = backend.rpartition(":")
-        module = __import__(module_name, fromlist=[class_name], level=0)
-        self._backend = getattr(module, class_name)(**kwargs)
+        self._backend = _import_object(backend)(**kwargs)
+
+        # Sessions can optionally be built and stored off the request thread
+        self._worker = None
+        if int(ingest_queue_size) > 0:
+            self._worker = BackgroundWorker(ingest_queue_size,
+                                            ingest_drop_policy)
 
         # Attempt to create the GRAPH_DIR
         if not os.path.exists(GRAPH_DIR):
@@ -85,12 +210,63 @@ class ProfilingMiddleware(object):
                 log.error("Could not create directory `%s'", GRAPH_DIR)
                 raise
 
+        # Cache of loaded sessions and prepared views, so that browsing a
+        # profile doesn't hit the backend or rebuild the graph every time.
+        self._cache = LRUCache(float(cache_size_mb) * 1024 * 1024,
+                               sizeof=_cached_size)
+
+        # Graphs are rendered on a separate pool of threads
+        self._render_pool = RenderPool(render_workers)
+        self.prerender_graphs = asbool(prerender_graphs)
+
         # Setup the Mako template lookup
         self.template_lookup = TemplateLookup(directories=[TEMPLATES_DIR])
 
         # Set it up
         self._backend.setup()
 
+        # Sessions can also be summed into an aggregate profile per endpoint
+        self._aggregates = None
+        if int(aggregate_window) > 0:
+            self._aggregates = AggregateStore(
+                self._backend, aggregate_window, aggregate_buckets,
+                aggregate_flush_interval)
+            self._aggregates.load()
+
+        # The duration of every request can be recorded in a histogram per
+        # endpoint, whether or not it is profiled.
+        self._latencies = None
+        if int(latency_window) > 0:
+            self._latencies = HistogramStore(
+                self._backend, latency_window, latency_buckets,
+                latency_flush_interval, latency_accuracy,
+                latency_max_endpoints)
+            self._latencies.load()
+
+        # The stats of every function can be summed across sessions, to find
+        # the functions that take the most time overall.
+        self._hotspots = None
+        if int(hotspot_window) > 0:
+            self._hotspots = HotspotStore(
+                self._backend, hotspot_window, hotspot_buckets,
+                hotspot_flush_interval)
+            self._hotspots.load()
+
+        # The stats of every function can also be kept as a time series,
+        # which is shown on the profile pages.
+        self._timeseries = None
+        if timeseries_resolutions.strip():
+            self._timeseries = TimeSeriesStore(
+                self._backend, parse_resolutions(timeseries_resolutions),
+                timeseries_flush_interval)
+            self._timeseries.load()
+
+        # Sessions that the backend evicts on its own are taken out of the
+        # function index, time series and cache too.
+        self._backend.on_evict = self._evict_sessions
+
+        atexit.register(self.close)
+
     def __call__(self, environ, start_response):
         """
         This will be called when the application is being run.  This can be
@@ -107,18 +283,40 @@ class ProfilingMiddleware(object):
 
         self.profiling_enabled = os.path.exists(ENABLED_FLAG_FILE)
         if req.path_info_peek() != self.profiler_path.strip('/'):
-            if not self.profiling_enabled:
+            if not self.profiling_enabled or not self.sampler.should_sample():
+                if self._latencies:
+                    return self._timed_request(environ, start_response)
                 return self.app(environ, start_response)
-            _locals = locals()
-            prof = Profile()
-            start_timestamp = datetime.now()
-            prof.runctx(
-                "app = self.app(environ, start_response)", globals(), _locals)
-            stats = prof.getstats()
-            session = ProfilingSession(stats, environ, start_timestamp)
-            self._backend.add(session)
+            response_status = []
+
+            def _start_response(status, headers, exc_info=None):
+                response_status.append(status)
+                return start_response(status, headers, exc_info)
 
-            return _locals['app']
+            prof = self._create_profiler()
+            start_timestamp = datetime.now()
+            start_time = time.time()
+            prof.enable()
+            try:
+                app_iter = self.app(environ, _start_response)
+            finally:
+                prof.disable()
+
+            # The environ is only valid for the duration of the request, so
+            # hold on to a copy of the plain string values.
+            environ_copy = dict((key, value)
+                                for key, value in environ.iteritems()
+                                if isinstance(value, basestring))
+
+            def on_close(**timings):
+                if self._latencies:
+                    self._record_latency(environ_copy, start_time)
+                if response_status:
+                    timings['status'] = _status_code(response_status[-1])
+                self._submit(self._store_session, prof, environ_copy,
+                             start_timestamp, timings)
+
+            return ProfiledResponse(app_iter, prof, start_time, on_close)
 
         req.path_info_pop()
 
@@ -128,6 +326,8 @@ class ProfilingMiddleware(object):
         query_param = req.path_info_pop()
         if not query_param:
             wsgi_app = self.list_profiles(req)
+        elif query_param == "sessions":
+            wsgi_app = self.list_sessions(req)
         elif query_param == "graph":
             wsgi_app = self.render_graph(req)
         elif query_param == "media":
@@ -136,11 +336,208 @@ class ProfilingMiddleware(object):
             wsgi_app = self.show_profile(req)
         elif query_param == "delete":
             wsgi_app = self.delete_profile(req)
+        elif query_param == "aggregates" and self._aggregates:
+            wsgi_app = self.list_aggregates(req)
+        elif query_param == "latency" and self._latencies:
+            wsgi_app = self.show_latency(req)
+        elif query_param == "hotspots" and self._hotspots:
+            wsgi_app = self.show_hotspots(req)
+        elif query_param == "timeseries" and self._timeseries:
+            wsgi_app = self.show_timeseries(req)
+        elif query_param == "diff":
+            wsgi_app = self.show_diff(req)
         else:
             wsgi_app = HTTPNotFound()
 
         return wsgi_app(environ, start_response)
 
+    def _timed_request(self, environ, start_response):
+        """
+        Calls the application without profiling it, and records how long it
+        took to produce the response in the latency histograms.
+        """
+        start_time = time.time()
+        path = environ.get('PATH_INFO')
+        app_iter = self.app(environ, start_response)
+        return TimedResponse(
+            app_iter, lambda: self._record_latency({'PATH_INFO': path},
+                                                   start_time))
+
+    def _record_latency(self, environ, start_time):
+        """
+        Records the time since ``start_time`` in the latency histogram of the
+        endpoint of the request.
+        """
+        self._latencies.add(self.route_normalizer(environ.get('PATH_INFO')),
+                            time.time() - start_time, start_time)
+
+    def _submit(self, func, *args):
+        """
+        Runs ``func`` on the background worker, if there is one, or
+        immediately otherwise.
+        """
+        if self._worker:
+            self._worker.submit(func, *args)
+        else:
+            func(*args)
+
+    def _store_session(self, prof, environ, start_timestamp, timings):
+        """
+        Builds a :class:`~linesman.ProfilingSession` from the profiler's stats
+        and stores it in the backend.  ``timings`` are passed on to the
+        session as keyword arguments, along with the response status.
+        """
+        stats = prof.getstats()
+        if not stats:
+            # Sampling engines may finish before taking a single sample.
+            log.debug("No profiling data collected for `%s'.",
+                      environ.get('PATH_INFO'))
+            return
+
+        endpoint = self.route_normalizer(environ.get('PATH_INFO'))
+        session = ProfilingSession(stats, environ, start_timestamp,
+                                   endpoint=endpoint, **timings)
+        if self._aggregates:
+            self._aggregates.add(session)
+        stored = self._backend.add(session)
+        if stored is False:
+            return
+        if self._hotspots:
+            self._hotspots.add(session)
+        if self._timeseries:
+            self._timeseries.add(session)
+        if self.prerender_graphs:
+            self._prerender_graph(session)
+
+    def close(self):
+        """
+        Stores any profiles that are still waiting in the ingest queue, and
+        any changed aggregates, histograms, function totals and time series,
+        and then closes the backend.  This is run automatically when the
+        interpreter exits.
+        """
+        if self._worker:
+            self._worker.close()
+        if self._aggregates:
+            self._aggregates.close()
+        if self._latencies:
+            self._latencies.close()
+        if self._hotspots:
+            self._hotspots.close()
+        if self._timeseries:
+            self._timeseries.close()
+        self._render_pool.close()
+        self._backend.close()
+
+    def _get_session(self, session_uuid):
+        """
+        Returns the session for ``session_uuid`` from the cache, loading it
+        from the backend if necessary.  Returns `None` if it doesn't exist.
+
+        Aggregate profiles are returned for aggregate ids; see
+        :mod:`linesman.aggregates`.  They are cached by the uuid of their
+        revision, which changes whenever a session is added to them.
+        """
+        session = self._cache.get(('session', session_uuid))
+        if session is not None:
+            return session
+
+        if is_aggregate_id(session_uuid):
+            if not self._aggregates:
+                return None
+            session = self._aggregates.get(session_uuid)
+        else:
+            session = self._backend.get(session_uuid)
+        if session:
+            key = ('session', session.uuid)
+            cached = self._cache.get(key)
+            if cached is not None:
+                return cached
+            self._cache.set(key, session)
+        return session
+
+    def _get_view(self, session, cutoff_percentage):
+        """
+        Returns a :class:`ProfileView` of ``session``, with calls taking less
+        than ``cutoff_percentage`` of the total time pruned.  Views are cached
+        per session and cutoff percentage.
+        """
+        key = ('view', session.uuid, cutoff_percentage)
+        view = self._cache.get(key)
+        if view is None:
+            cutoff_time = int(
+                session.duration * cutoff_percentage * CUTOFF_TIME_UNITS)
+            # The graph isn't kept by the session, which may be cached too.
+            full_graph = session._callgraph.to_networkx()
+            graph, root_nodes, removed_edges = prepare_graph(
+                full_graph, cutoff_time, True)
+            chart_values = time_per_field(full_graph, root_nodes,
+                                          self.chart_packages)
+            view = ProfileView(graph, root_nodes, removed_edges,
+                               cutoff_time, chart_values)
+            self._cache.set(key, view)
+        return view
+
+    def _get_diff_view(self, before, after, cutoff_percentage):
+        """
+        Returns a :class:`DiffView` of the differences between the profiles
+        ``before`` and ``after``, pruned like :meth:`_get_view` relative to
+        the longer of the two.  Views are cached per pair of profiles and
+        cutoff percentage.
+        """
+        key = ('diff', before.uuid, after.uuid, cutoff_percentage)
+        view = self._cache.get(key)
+        if view is None:
+            diff = ProfileDiff(before, after)
+            cutoff_time = int(max(before.duration, after.duration) *
+                              cutoff_percentage * CUTOFF_TIME_UNITS)
+            # Nodes below the cutoff are left out of the graph up front,
+            # rather than built and then pruned.
+            graph, root_nodes, removed_edges = prepare_graph(
+                diff.to_networkx(float(cutoff_time) / CUTOFF_TIME_UNITS),
+                cutoff_time, True)
+            view = DiffView(graph, root_nodes, removed_edges, cutoff_time,
+                            diff.top_functions(), diff.top_calls())
+            self._cache.set(key, view)
+        return view
+
+    def _forget_sessions(self, session_uuids):
+        """
+        Takes the stored sessions ``session_uuids`` out of the function index
+        and time series, before they are deleted.
+        """
+        if not (self._hotspots or self._timeseries):
+            return
+        for session_uuid in session_uuids:
+            session = self._backend.get(session_uuid)
+            if session is None:
+                continue
+            if self._hotspots:
+                self._hotspots.remove(session)
+            if self._timeseries:
+                self._timeseries.remove(session)
+
+    def _evict_sessions(self, session_uuids):
+        """
+        Forgets the sessions ``session_uuids``, which the backend is about to
+        evict.
+        """
+        self._forget_sessions(session_uuids)
+        self._uncache(session_uuids)
+
+    def _uncache(self, session_uuids=None):
+        """
+        Removes sessions, and their views, from the cache.  If
+        ``session_uuids`` is `None`, the entire cache is cleared.
+        """
+        if session_uuids is None:
+            self._cache.clear()
+        else:
+            session_uuids = set(session_uuids)
+            self._cache.discard_where(
+                lambda key: key[1] in session_uuids or
+                (key[0] == 'diff' and key[2] in session_uuids))
+
     def get_template(self, template):
         """
         Uses mako templating lookups to retrieve the template file.  If the
@@ -183,11 +580,300 @@ class ProfilingMiddleware(object):
                 raise
 
         resp = Response(charset='utf8')
-        session_history = self._backend.get_all()
         resp.unicode_body = self.get_template('list.tmpl').render_unicode(
-            history=session_history,
             path=req.path,
-            profiling_enabled=self.profiling_enabled)
+            profiling_enabled=self.profiling_enabled,
+            aggregates_enabled=bool(self._aggregates),
+            latency_enabled=bool(self._latencies),
+            hotspots_enabled=bool(self._hotspots))
+        return resp
+
+    def list_aggregates(self, req):
+        """
+        Displays the aggregate profiles of every endpoint, which link to the
+        same pages as sessions do.
+
+        ``req``:
+            :class:`webob.Request` containing the environment information from
+            the request itself.
+
+        Returns a WSGI application.
+        """
+        resp = Response(charset='utf8')
+        resp.unicode_body = self.get_template(
+            'aggregates.tmpl').render_unicode(
+                aggregates=self._aggregates.list())
+        return resp
+
+    def list_sessions(self, req):
+        """
+        Returns a single page of the session list as JSON, in the format
+        expected by DataTables' server-side processing.  Sessions are
+        filtered, sorted and paged by the backend, so that only the page
+        being displayed is ever loaded.
+
+        ``req``:
+            :class:`webob.Request` containing the DataTables parameters;
+            `iDisplayStart` and `iDisplayLength` select the page,
+            `iSortCol_0` and `sSortDir_0` its order, and the `sSearch_*`
+            parameters filter by URI prefix, minimum duration and earliest
+            timestamp.
+
+        Returns a WSGI application.
+        """
+        params = req.params
+        filters = _session_list_filters(params)
+
+        try:
+            sort_column = int(params.get('iSortCol_0', 4))
+            order_by = SESSION_LIST_ORDERS[sort_column] or "timestamp"
+        except (ValueError, IndexError):
+            order_by = "timestamp"
+        descending = params.get('sSortDir_0', "desc") != "asc"
+
+        try:
+            offset = max(int(params.get('iDisplayStart', 0)), 0)
+            limit = int(params.get('iDisplayLength', 20))
+        except ValueError:
+            offset, limit = 0, 20
+        if not 0 < limit <= MAX_SESSION_LIST_LENGTH:
+            limit = MAX_SESSION_LIST_LENGTH
+
+        # Link to the pages of the profiler wherever it is mounted, which is
+        # the script name without the `sessions' segment.
+        path = req.script_name.rsplit('/', 1)[0]
+
+        rows = []
+        for summary in self._backend.iter_summaries(
+                order_by=order_by, descending=descending, limit=limit,
+                offset=offset, **filters):
+            rows.append([
+                u'<a href="%s/profiles/%s">%s</a>' % (
+                    path, summary.uuid, escape(summary.path or u"")),
+                escape(summary.method or u""),
+                summary.status or u"",
+                summary.duration,
+                unicode(summary.timestamp),
+                u'<a href="%s/delete/%s" class="delete">delete</a>' % (
+                    path, summary.uuid),
+            ])
+
+        try:
+            echo = int(params.get('sEcho', 0))
+        except ValueError:
+            echo = 0
+
+        resp = Response(charset='utf8', content_type="application/json")
+        resp.cache_control = "no-cache"
+        resp.body = json.dumps({
+            "sEcho": echo,
+            "iTotalRecords": self._backend.count_summaries(),
+            "iTotalDisplayRecords": self._backend.count_summaries(**filters),
+            "aaData": rows,
+        })
+        return resp
+
+    def show_diff(self, req):
+        """
+        Displays the differences between two profiles, whose uuids are given
+        in the path as `diff/<before>/<after>`.  Either can be a session or
+        an aggregate profile.
+
+        The call hierarchy is expanded with `diff/<before>/<after>/children`,
+        like :meth:`show_children`.  If the `format` parameter is `json`, the
+        functions and calls that changed the most are returned as JSON
+        instead, ranked by the `order_by` parameter (one of
+        :data:`~linesman.diff.DIFF_ORDERS`) and limited to `limit` of each.
+
+        ``req``:
+            :class:`webob.Request` containing the environment information from
+            the request itself.
+
+        Returns a WSGI application.
+        """
+        before_uuid = req.path_info_pop()
+        after_uuid = req.path_info_pop()
+        before = self._get_session(before_uuid) if before_uuid else None
+        after = self._get_session(after_uuid) if after_uuid else None
+        if not before or not after:
+            resp = Response(charset='utf8', status="404 Not Found")
+            resp.text = u"Session `%s' not found." % (
+                after_uuid if before else before_uuid)
+            return resp
+
+        if req.params.get('format') == "json":
+            order_by = req.params.get('order_by', "totaltime")
+            if order_by not in DIFF_ORDERS:
+                order_by = "totaltime"
+            try:
+                limit = min(int(req.params.get('limit', 20)),
+                            MAX_SESSION_LIST_LENGTH)
+            except ValueError:
+                limit = 20
+            diff = ProfileDiff(before, after)
+            resp = Response(content_type="application/json")
+            resp.body = json.dumps({
+                'before': before.uuid,
+                'after': after.uuid,
+                'duration_delta': diff.duration_delta,
+                'functions': [_delta_dict(delta) for delta in
+                              diff.top_functions(order_by, limit)],
+                'calls': [_delta_dict(delta) for delta in
+                          diff.top_calls(order_by, limit)],
+            })
+            return resp
+
+        cutoff_percentage = _cutoff_percentage(req)
+        view = self._get_diff_view(before, after, cutoff_percentage)
+
+        if req.path_info_peek() == "children":
+            node = req.params.get('node')
+            if node not in view.graph:
+                resp = Response(charset='utf8', status="404 Not Found")
+                resp.text = u"Node `%s' not found." % node
+                return resp
+            resp = Response(content_type="application/json")
+            resp.body = json.dumps([
+                _diff_tree_node(view.graph, child)
+                for child in view.graph.neighbors(node)])
+            return resp
+
+        resp = Response(charset='utf8')
+        resp.unicode_body = self.get_template('diff.tmpl').render_unicode(
+            before=before,
+            after=after,
+            root_nodes=[_diff_tree_node(view.graph, node)
+                        for node in view.root_nodes],
+            top_functions=view.top_functions,
+            top_calls=view.top_calls,
+            removed_edges=view.removed_edges,
+            cutoff_percentage=cutoff_percentage,
+            cutoff_time=view.cutoff_time)
+        return resp
+
+    def show_latency(self, req):
+        """
+        Displays the percentiles of the duration of requests to every
+        endpoint.  If an `endpoint` parameter is given, the percentiles of
+        each window of time of that endpoint are shown instead.  The `hours`
+        parameter limits the durations included to those of the most recent
+        windows.
+
+        ``req``:
+            :class:`webob.Request` containing the environment information from
+            the request itself.
+
+        Returns a WSGI application.
+        """
+        since = None
+        try:
+            hours = float(req.params.get('hours') or 0)
+        except ValueError:
+            hours = 0
+        if hours > 0:
+            since = time.time() - hours * 3600
+
+        endpoint = req.params.get('endpoint')
+        if endpoint is None:
+            rows = sorted(self._latencies.merged(since).items())
+        else:
+            rows = [(histogram.timestamp, histogram) for histogram in
+                    self._latencies.list(endpoint=endpoint, since=since)]
+
+        resp = Response(charset='utf8')
+        resp.unicode_body = self.get_template('latency.tmpl').render_unicode(
+            rows=rows,
+            endpoint=endpoint,
+            hours=hours,
+            percentiles=DEFAULT_PERCENTILES)
+        return resp
+
+    def show_hotspots(self, req):
+        """
+        Displays the functions that took the most time across every stored
+        session, ranked by the `order_by` parameter (one of
+        :data:`~linesman.hotspots.HOTSPOT_ORDERS`) and limited to `limit`
+        functions.  The `hours` parameter limits the sessions included to
+        those of the most recent windows.  If the `format` parameter is
+        `json`, the functions are returned as JSON instead.
+
+        ``req``:
+            :class:`webob.Request` containing the environment information from
+            the request itself.
+
+        Returns a WSGI application.
+        """
+        order_by = req.params.get('order_by', "inlinetime")
+        if order_by not in HOTSPOT_ORDERS:
+            order_by = "inlinetime"
+        try:
+            limit = min(int(req.params.get('limit', 50)),
+                        MAX_SESSION_LIST_LENGTH)
+        except ValueError:
+            limit = 50
+        try:
+            hours = float(req.params.get('hours') or 0)
+        except ValueError:
+            hours = 0
+
+        totals = self._hotspots
+        if hours > 0:
+            totals = totals.totals(since=time.time() - hours * 3600)
+        hotspots = totals.top(order_by, limit)
+
+        if req.params.get('format') == "json":
+            resp = Response(content_type="application/json")
+            resp.body = json.dumps({
+                'session_count': totals.session_count,
+                'duration': totals.duration,
+                'functions': [hotspot._asdict() for hotspot in hotspots],
+            })
+            return resp
+
+        resp = Response(charset='utf8')
+        resp.unicode_body = self.get_template(
+            'hotspots.tmpl').render_unicode(
+                hotspots=hotspots,
+                session_count=totals.session_count,
+                duration=totals.duration,
+                order_by=order_by,
+                orders=HOTSPOT_ORDERS,
+                limit=limit,
+                hours=hours)
+        return resp
+
+    def show_timeseries(self, req):
+        """
+        Returns the time series of the functions given by the `key`
+        parameters as JSON, at the resolution in seconds given by the
+        `resolution` parameter.  Each point is a `[bucket start, callcount,
+        reccallcount, inlinetime, totaltime]` list, and `since` and `until`
+        give the range of time covered, all in seconds since the epoch.
+
+        ``req``:
+            :class:`webob.Request` containing the environment information from
+            the request itself.
+
+        Returns a WSGI application.
+        """
+        keys = req.params.getall('key')[:MAX_SESSION_LIST_LENGTH]
+        try:
+            resolution = int(req.params.get('resolution'))
+        except (TypeError, ValueError):
+            resolution = None
+        if resolution not in self._timeseries.resolutions:
+            resolution = self._timeseries.default_resolution
+
+        series = self._timeseries.series(keys, resolution)
+        resp = Response(content_type="application/json")
+        resp.body = json.dumps({
+            'resolution': resolution,
+            'since': self._timeseries.since(resolution),
+            'until': time.time(),
+            'series': dict((key, [[start] + values
+                                  for start, values in points])
+                           for key, points in series.iteritems()),
+        })
         return resp
 
     def media(self, req):
@@ -211,6 +897,11 @@ class ProfilingMiddleware(object):
         This also creates a thumbnail image, since some of these graphs can
         grow to be extremely large.
 
+        Rendering happens in the background; until it is done, a placeholder
+        image is returned with a `202 Accepted` status.  Graphs that failed
+        to render return a `500 Internal Server Error` status, and aren't
+        rendered again.
+
         ``req``:
             :class:`webob.Request` containing the environment information from
             the request itself.
@@ -232,34 +923,51 @@ class ProfilingMiddleware(object):
         cutoff_time = int(cutoff_time)
 
         # We now have the session_uuid
-        session = self._backend.get(session_uuid)
-        if session:
-            force_thumbnail_creation = False
-
-            filename = "%s.png" % fileid
-            path = os.path.join(GRAPH_DIR, filename)
-            if not os.path.exists(path):
-                graph, root_nodes, removed_edges = prepare_graph(
-                    session._graph, cutoff_time, False)
-                draw_graph(graph, path)
-                force_thumbnail_creation = True
-
-            thumbnail_filename = "thumb-%s.png" % fileid
-            thumbnail_path = os.path.join(GRAPH_DIR, thumbnail_filename)
-            if not os.path.exists(thumbnail_path) or force_thumbnail_creation:
-                log.debug("Creating thumbnail for %s at %s.", session_uuid,
-                                                              thumbnail_path)
-                im = Image.open(path, 'r')
-                im.thumbnail((600, 600), Image.ANTIALIAS)
-                im.save(thumbnail_path)
+        session = self._get_session(session_uuid)
+        if session and not self._graph_rendered(fileid):
+            if not self._render_pool.submit(fileid, _render_graph_files,
+                                            session, fileid, cutoff_time):
+                # Let the client know to try again, rather than making it
+                # wait for `dot' to finish.
+                resp = Response(body=placeholder_image(), status=202,
+                                content_type="image/png")
+                resp.cache_control = "no-cache"
+                resp.headers['Retry-After'] = "1"
+                return resp
+            if self._render_pool.has_failed(fileid):
+                resp = Response(charset='utf8',
+                                status="500 Internal Server Error")
+                resp.cache_control = "no-cache"
+                resp.text = u"Graph `%s' could not be rendered." % fileid
+                return resp
 
         return StaticURLParser(GRAPH_DIR)
 
+    def _graph_rendered(self, fileid):
+        """
+        Returns True if the graph and thumbnail for ``fileid`` exist.
+        """
+        path, thumbnail_path = _graph_paths(fileid)
+        return os.path.exists(path) and os.path.exists(thumbnail_path)
+
+    def _prerender_graph(self, session):
+        """
+        Schedules rendering of the graph shown by default on the profile page
+        of ``session``.
+        """
+        cutoff_time = int(session.duration * DEFAULT_CUTOFF_PERCENT / 100 *
+                          CUTOFF_TIME_UNITS)
+        fileid = "%s--%d" % (session.uuid, cutoff_time)
+        self._render_pool.submit(fileid, _render_graph_files, session,
+                                 fileid, cutoff_time)
+
     def delete_profile(self, req):
         """
         If the current path info refers to a specific ``session_uuid``, this
         session will be removed.  Otherwise, if it refers to `all`, then all
-        tracked session info will be removed.
+        tracked session info will be removed, and if it refers to `filtered`,
+        every session matching the session list filters in the request will
+        be removed.
 
         ``req``:
             :class:`webob.Request` containing the environment information from
@@ -271,13 +979,39 @@ class ProfilingMiddleware(object):
         session_uuid = req.path_info_pop()
         if session_uuid == "all":
             deleted_rows = self._backend.delete_all()
+            self._uncache()
+            if self._hotspots:
+                self._hotspots.clear()
+            if self._timeseries:
+                self._timeseries.clear()
+        elif session_uuid == "filtered":
+            # Deleted sessions no longer match, so each batch is the first
+            # page of what is left.
+            filters = _session_list_filters(req.params)
+            deleted_rows = 0
+            while True:
+                session_uuids = [summary.uuid for summary in
+                                 self._backend.iter_summaries(
+                                     limit=DELETE_BATCH_SIZE, **filters)]
+                if not session_uuids:
+                    break
+                self._forget_sessions(session_uuids)
+                deleted = self._backend.delete_many(session_uuids)
+                self._uncache(session_uuids)
+                deleted_rows += deleted
+                if not deleted or len(session_uuids) < DELETE_BATCH_SIZE:
+                    break
         elif session_uuid:
+            self._forget_sessions([session_uuid])
             deleted_rows = self._backend.delete(session_uuid)
+            self._uncache([session_uuid])
         else:
             deleted_rows = 0
             session_uuids = req.POST.getall('session_uuids[]')
             if session_uuids:
+                self._forget_sessions(session_uuids)
                 deleted_rows = self._backend.delete_many(session_uuids)
+                self._uncache(session_uuids)
 
         resp.text = u"%d row(s) deleted." % deleted_rows
 
@@ -296,35 +1030,345 @@ class ProfilingMiddleware(object):
         """
         resp = Response(charset='utf8')
         session_uuid = req.path_info_pop()
-        session = self._backend.get(session_uuid)
+        session = self._get_session(session_uuid)
 
         # If the Session doesn't exist, return an appropriate error
         if not session:
             resp.status = "404 Not Found"
             resp.text = u"Session `%s' not found." % session_uuid
-        else:
-            # Otherwise, prepare the graph for display!
-            cutoff_percentage = float(
-                req.params.get('cutoff_percent', 5) or 5) / 100
-            cutoff_time = int(
-                session.duration * cutoff_percentage * CUTOFF_TIME_UNITS)
-            graph, root_nodes, removed_edges = prepare_graph(
-                session._graph, cutoff_time, True)
-            chart_values = time_per_field(session._graph, root_nodes,
-                                        self.chart_packages)
-            resp.unicode_body = self.get_template('tree.tmpl').render_unicode(
-                session=session,
-                graph=graph,
-                root_nodes=root_nodes,
-                removed_edges=removed_edges,
-                application_url=self.profiler_path,
-                cutoff_percentage=cutoff_percentage,
-                cutoff_time=cutoff_time,
-                chart_values=chart_values
-            )
+            return resp
+
+        # Otherwise, prepare the graph for display!
+        cutoff_percentage = _cutoff_percentage(req)
+        view = self._get_view(session, cutoff_percentage)
+
+        if req.path_info_peek() == "children":
+            return self.show_children(req, session, view)
+
+        # Only the root nodes are rendered; their children are loaded from
+        # `show_children' as the tree is expanded.
+        resp.unicode_body = self.get_template('tree.tmpl').render_unicode(
+            session=session,
+            root_nodes=[_tree_node(view.graph, node, session.duration)
+                        for node in view.root_nodes],
+            removed_edges=view.removed_edges,
+            application_url=self.profiler_path,
+            cutoff_percentage=cutoff_percentage,
+            cutoff_time=view.cutoff_time,
+            chart_values=view.chart_values,
+            timeseries_resolution=self._timeseries.default_resolution
+                                  if self._timeseries else None
+        )
+        return resp
+
+    def show_children(self, req, session, view):
+        """
+        Returns the children of a single node of the call hierarchy as JSON,
+        so that the tree on the profile page can be expanded on demand.
+
+        ``req``:
+            :class:`webob.Request` whose `node` parameter is the name of the
+            node to expand.
+        ``session``:
+            The :class:`~linesman.ProfilingSession` being displayed.
+        ``view``:
+            The :class:`ProfileView` of ``session`` at the requested cutoff.
+
+        Returns a WSGI application.
+        """
+        node = req.params.get('node')
+        if node not in view.graph:
+            resp = Response(charset='utf8', status="404 Not Found")
+            resp.text = u"Node `%s' not found." % node
+            return resp
+
+        resp = Response(content_type="application/json")
+        resp.body = json.dumps([
+            _tree_node(view.graph, child, session.duration)
+            for child in view.graph.neighbors(node)])
         return resp
 
 
+def _cutoff_percentage(req):
+    """
+    Returns the fraction of the total time below which calls are hidden, as
+    given by the `cutoff_percent` parameter of ``req``.  The percentage is
+    rounded, so that near-identical cutoffs share a cached view.
+    """
+    return round(float(
+        req.params.get('cutoff_percent', DEFAULT_CUTOFF_PERCENT) or
+        DEFAULT_CUTOFF_PERCENT), 1) / 100
+
+
+def _session_list_filters(params):
+    """
+    Returns the keyword arguments for :meth:`Backend.iter_summaries` that
+    filter the session list, from the DataTables column filters in
+    ``params``.  Filters that can't be parsed are ignored.
+    """
+    filters = {}
+
+    path_prefix = params.get('sSearch_0', "").strip()
+    if path_prefix:
+        filters['path_prefix'] = path_prefix
+
+    min_duration = params.get('sSearch_3', "").strip()
+    if min_duration:
+        try:
+            filters['min_duration'] = float(min_duration)
+        except ValueError:
+            pass
+
+    since = params.get('sSearch_4', "").strip()
+    for timestamp_format in TIMESTAMP_FORMATS:
+        try:
+            filters['since'] = datetime.strptime(since, timestamp_format)
+            break
+        except ValueError:
+            continue
+
+    return filters
+
+
+def _tree_node(graph, node, duration):
+    """
+    Returns what the call hierarchy shows for ``node`` of ``graph``, as a
+    dictionary that can be rendered either by the template or, once it is
+    converted to JSON, by the tree on the profile page.
+    """
+    node_obj = graph.node[node]
+    totaltime = node_obj.get('totaltime', 0)
+    inlinetime = node_obj.get('inlinetime', 0)
+    return {
+        'node': node,
+        'callcount': node_obj.get('callcount'),
+        'totaltime': totaltime,
+        'inlinetime': inlinetime,
+        'totaltime_percent': round(totaltime / duration * 100, 2)
+                             if duration else 0,
+        'inlinetime_percent': round(inlinetime / duration * 100, 2)
+                              if duration else 0,
+        'has_children': bool(graph.succ[node]),
+    }
+
+
+def _diff_tree_node(graph, node):
+    """
+    Returns what the call hierarchy of a diff shows for ``node`` of
+    ``graph``, a graph created by :meth:`ProfileDiff.to_networkx`.
+    """
+    node_obj = graph.node[node]
+    return {
+        'node': node,
+        'before_totaltime': node_obj.get('before_totaltime', 0),
+        'after_totaltime': node_obj.get('after_totaltime', 0),
+        'delta_totaltime': node_obj.get('delta_totaltime', 0),
+        'delta_inlinetime': node_obj.get('delta_inlinetime', 0),
+        'delta_callcount': node_obj.get('delta_callcount', 0),
+        'has_children': bool(graph.succ[node]),
+    }
+
+
+def _delta_dict(delta):
+    """
+    Converts a :class:`~linesman.diff.Delta` into a dictionary that can be
+    returned as JSON.
+    """
+    result = {'key': delta.key}
+    for field in DIFF_ORDERS:
+        result['before_' + field] = delta.value(field, "before")
+        result['after_' + field] = delta.value(field, "after")
+        result['delta_' + field] = delta.delta(field)
+    return result
+
+
+def _status_code(status):
+    """
+    Returns the numeric code of a WSGI status line, such as `200 OK`.
+    """
+    try:
+        return int(status.split(None, 1)[0])
+    except (ValueError, IndexError):
+        return None
+
+
+def _graph_paths(fileid):
+    """
+    Returns the paths of the full-size graph and the thumbnail for ``fileid``.
+    """
+    return (os.path.join(GRAPH_DIR, "%s.png" % fileid),
+            os.path.join(GRAPH_DIR, "thumb-%s.png" % fileid))
+
+
+def _render_graph_files(session, fileid, cutoff_time):
+    """
+    Renders the graph of ``session`` with calls shorter than ``cutoff_time``
+    removed, along with its thumbnail.  Images are written to temporary
+    files first, so that a half-written image is never served.
+    """
+    path, thumbnail_path = _graph_paths(fileid)
+    tmp_path = "%s.%d.tmp.png" % (path, os.getpid())
+    tmp_thumbnail_path = "%s.%d.tmp.png" % (thumbnail_path, os.getpid())
+
+    try:
+        graph, root_nodes, removed_edges = prepare_graph(
+            session._callgraph.to_networkx(), cutoff_time, False)
+        draw_graph(graph, tmp_path)
+
+        log.debug("Creating thumbnail for %s at %s.", session.uuid,
+                                                      thumbnail_path)
+        im = Image.open(tmp_path, 'r')
+        im.thumbnail((600, 600), Image.ANTIALIAS)
+        im.save(tmp_thumbnail_path)
+
+        os.rename(tmp_path, path)
+        os.rename(tmp_thumbnail_path, thumbnail_path)
+    finally:
+        for leftover in (tmp_path, tmp_thumbnail_path):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+
+class ProfileView(object):
+    """
+    A session's callgraph, prepared for display by :func:`prepare_graph`.
+    """
+
+    def __init__(self, graph, root_nodes, removed_edges, cutoff_time,
+                 chart_values):
+        self.graph = graph
+        self.root_nodes = root_nodes
+        self.removed_edges = removed_edges
+        self.cutoff_time = cutoff_time
+        self.chart_values = chart_values
+
+
+class DiffView(ProfileView):
+    """
+    The differences between two profiles, prepared for display by
+    :func:`prepare_graph`, along with the functions and calls that changed
+    the most.
+    """
+
+    def __init__(self, graph, root_nodes, removed_edges, cutoff_time,
+                 top_functions, top_calls):
+        super(DiffView, self).__init__(graph, root_nodes, removed_edges,
+                                       cutoff_time, None)
+        self.top_functions = top_functions
+        self.top_calls = top_calls
+
+
+def _cached_size(value):
+    """
+    Estimates the memory used by a cached session or :class:`ProfileView`,
+    in bytes.
+    """
+    if isinstance(value, ProfileView):
+        graph = value.graph
+        return (graph.number_of_nodes() +
+                graph.number_of_edges()) * NX_BYTES_PER_ITEM
+    return value._callgraph.nbytes
+
+
+class ProfiledResponse(object):
+    """
+    Wraps the iterable returned by a WSGI application, so that the time spent
+    generating the response body--for example, by a generator or a lazily
+    rendered template--is profiled as well.  Profiling is finished once the
+    server calls :meth:`close`.
+
+    ``app_iter``:
+        The iterable returned by the WSGI application.
+    ``prof``:
+        The profiler used for the call to the WSGI application.
+    ``start_time``:
+        Value of :func:`time.time` when the request started.
+    ``callback``:
+        Called on :meth:`close` with the keyword arguments ``duration``, the
+        total profiled time; ``time_to_first_byte``, the time until the first
+        chunk of the body was produced (or `None` if the body was never
+        iterated); and ``body_time``, the time spent producing the body.
+    """
+
+    def __init__(self, app_iter, prof, start_time, callback):
+        self.app_iter = app_iter
+        self._prof = prof
+        self._start_time = start_time
+        self._callback = callback
+        self._iterator = None
+        self._closed = False
+
+        self._app_time = time.time() - start_time
+        self._body_time = 0.0
+        self._time_to_first_byte = None
+
+    def __iter__(self):
+        return self
+
+    def _profile(self, func):
+        """
+        Calls ``func`` with profiling enabled, and adds the time it took to
+        the body generation time.
+        """
+        start = time.time()
+        self._prof.enable()
+        try:
+            return func()
+        finally:
+            self._prof.disable()
+            self._body_time += time.time() - start
+
+    def next(self):
+        if self._iterator is None:
+            self._iterator = self._profile(lambda: iter(self.app_iter))
+
+        chunk = self._profile(self._iterator.next)
+        if self._time_to_first_byte is None:
+            self._time_to_first_byte = time.time() - self._start_time
+        return chunk
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+
+        try:
+            if hasattr(self.app_iter, "close"):
+                self._profile(self.app_iter.close)
+        finally:
+            self._callback(
+                duration=self._app_time + self._body_time,
+                time_to_first_byte=self._time_to_first_byte,
+                body_time=self._body_time)
+
+
+class TimedResponse(object):
+    """
+    Wraps the iterable returned by a WSGI application that isn't being
+    profiled, and calls ``callback`` once the server calls :meth:`close`, so
+    that the time until the response was sent can be recorded.
+    """
+
+    def __init__(self, app_iter, callback):
+        self.app_iter = app_iter
+        self._callback = callback
+        self._closed = False
+
+    def __iter__(self):
+        return iter(self.app_iter)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+
+        try:
+            if hasattr(self.app_iter, "close"):
+                self.app_iter.close()
+        finally:
+            self._callback()
+
+
 def time_per_field(full_graph, root_nodes, fields):
     """
     This function generates the fields used by the pie graph jQuery code on the
@@ -403,6 +1447,50 @@ def time_per_field(full_graph, root_nodes, fields):
     return values
 
 
+def remove_back_edges(graph):
+    """
+    Makes ``graph`` acyclic by removing every back edge found by a depth-first
+    search--that is, every edge that leads back to a node that is still being
+    visited.  The search starts from the root nodes, so that existing roots
+    stay roots.  This runs in O(V + E) time, no matter how many cycles there
+    are.
+
+    ``graph``:
+        :class:`networkx.DiGraph` to modify in place.
+
+    Returns the list of removed edges, as `(u, v)` tuples.
+    """
+    VISITING, VISITED = 1, 2
+    state = {}
+    back_edges = []
+
+    roots = [node for node, degree in graph.in_degree_iter() if degree == 0]
+    for start in roots + graph.nodes():
+        if start in state:
+            continue
+
+        # Iterative, so that deep call stacks don't hit the recursion limit.
+        state[start] = VISITING
+        stack = [(start, graph.successors_iter(start))]
+        while stack:
+            node, successors = stack[-1]
+            for successor in successors:
+                successor_state = state.get(successor)
+                if successor_state is None:
+                    state[successor] = VISITING
+                    stack.append(
+                        (successor, graph.successors_iter(successor)))
+                    break
+                elif successor_state == VISITING:
+                    back_edges.append((node, successor))
+            else:
+                state[node] = VISITED
+                stack.pop()
+
+    graph.remove_edges_from(back_edges)
+    return back_edges
+
+
 def prepare_graph(source_graph, cutoff_time, break_cycles=False):
     """
     Prepares a graph for display.  This includes:
@@ -420,11 +1508,13 @@ def prepare_graph(source_graph, cutoff_time, break_cycles=False):
         if not data:
             data['totaltime'] = 0
 
-    max_totaltime = max(data['totaltime']
-                        for node, data in graph.nodes(data=True))
+    # The graph can be empty, such as when a diff leaves out every function
+    # below the cutoff.
+    max_totaltime = max([data['totaltime']
+                         for node, data in graph.nodes(data=True)] or [0])
     for node, data in graph.nodes(data=True):
-        data['color'] = "%f 1.0 1.0" % (
-            (1 - (data['totaltime'] / max_totaltime)) / 3)
+        share = data['totaltime'] / max_totaltime if max_totaltime else 0
+        data['color'] = "%f 1.0 1.0" % ((1 - share) / 3)
         data['style'] = 'filled'
 
     cyclic_breaks = []
@@ -437,11 +1527,7 @@ def prepare_graph(source_graph, cutoff_time, break_cycles=False):
 
     # Break cycles
     if break_cycles:
-        for cycle in nx.simple_cycles(graph):
-            u, v = cycle[0], cycle[1]
-            if graph.has_edge(u, v):
-                graph.remove_edge(u, v)
-                cyclic_breaks.append((u, v))
+        cyclic_breaks = remove_back_edges(graph)
 
     root_nodes = [node
                   for node, degree in graph.in_degree_iter()
@@ -0,0 +1,240 @@
+# This file is part of linesman.
+#
+# linesman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# linesman is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with linesman.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Profiler engines that can be used in place of :class:`cProfile.Profile`.
+
+An engine only needs to provide ``enable()``, ``disable()`` and
+``getstats()``, where ``getstats()`` returns entries shaped like the ones
+returned by :meth:`cProfile.Profile.getstats`.
+"""
+import logging
+import sys
+import threading
+import time
+from collections import namedtuple
+
+
+log = logging.getLogger(__name__)
+
+# Mirrors the structure of `_lsprof.profiler_entry' and
+# `_lsprof.profiler_subentry', so that sampled stats can be fed directly into
+# :func:`~linesman.create_graph`.
+SampledEntry = namedtuple("SampledEntry", [
+    "code", "callcount", "reccallcount", "totaltime", "inlinetime", "calls"])
+SampledSubEntry = namedtuple("SampledSubEntry", [
+    "code", "callcount", "reccallcount", "totaltime", "inlinetime"])
+
+
+class _SamplerThread(threading.Thread):
+    """
+    Single background thread that periodically captures the stack of every
+    thread that currently has an active :class:`StackSampler`.  Using one
+    shared thread keeps the cost of enabling a sampler down to a dictionary
+    insert, regardless of how many requests are being profiled at once.
+
+    A timer thread is used instead of ``signal.setitimer``, since signals
+    are only ever delivered to the main thread, while most WSGI servers
+    handle requests on worker threads.
+    """
+
+    def __init__(self):
+        threading.Thread.__init__(self, name="linesman-sampler")
+        self.daemon = True
+        self._condition = threading.Condition()
+        self._active = {}
+
+    def register(self, thread_id, sampler):
+        with self._condition:
+            self._active[thread_id] = sampler
+            self._condition.notify()
+
+    def unregister(self, thread_id):
+        with self._condition:
+            self._active.pop(thread_id, None)
+
+    def run(self):
+        while True:
+            with self._condition:
+                while not self._active:
+                    self._condition.wait()
+                interval = min(s.interval for s in self._active.itervalues())
+
+            time.sleep(interval)
+
+            with self._condition:
+                if not self._active:
+                    continue
+                now = time.time()
+                frames = sys._current_frames()
+                for thread_id, sampler in self._active.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        sampler._sample(frame, now)
+                # Don't keep the frames of other threads alive.
+                del frames
+
+
+_sampler_thread = None
+_sampler_thread_lock = threading.Lock()
+
+
+def _get_sampler_thread():
+    """
+    Returns the shared :class:`_SamplerThread`, starting it if necessary.
+    """
+    global _sampler_thread
+    with _sampler_thread_lock:
+        if _sampler_thread is None:
+            _sampler_thread = _SamplerThread()
+            _sampler_thread.start()
+        return _sampler_thread
+
+
+class StackSampler(object):
+    """
+    Statistical profiler that periodically samples the call stack of the
+    thread that enabled it.  Instead of instrumenting every call, the time
+    between two samples is attributed to every function on the sampled stack,
+    so the overhead is bounded by the sampling ``interval`` rather than by the
+    number of calls made.
+
+    Because only samples are seen, the reported values are estimates:
+
+        - ``totaltime`` and ``inlinetime`` are accurate to roughly one
+          ``interval``.
+        - ``callcount`` counts the distinct frames that were observed, so
+          calls which complete between two samples are never seen.
+
+    ``interval``:
+        Number of seconds between samples.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = float(interval)
+        if self.interval <= 0:
+            raise ValueError("interval must be positive, not %r" % interval)
+
+        self._thread_id = None
+        self._stop_frame = None
+        self._last_sample = None
+        self._last_stack = ()
+
+        # code -> [callcount, reccallcount, totaltime, inlinetime]
+        self._nodes = {}
+        # (caller code, callee code) -> [callcount, reccallcount, totaltime,
+        #                                inlinetime]
+        self._edges = {}
+
+    def enable(self):
+        """
+        Starts sampling the calling thread.  Frames above (and including)
+        the frame that called this are not recorded.
+        """
+        self._thread_id = threading.current_thread().ident
+        self._stop_frame = sys._getframe(1)
+        self._last_sample = time.time()
+        self._last_stack = ()
+        _get_sampler_thread().register(self._thread_id, self)
+
+    def disable(self):
+        """
+        Stops sampling.  Collected samples are kept, so that a sampler can be
+        enabled and disabled multiple times.
+        """
+        if self._thread_id is not None:
+            _get_sampler_thread().unregister(self._thread_id)
+        self._stop_frame = None
+
+    def _sample(self, frame, now):
+        """
+        Attributes the time since the previous sample to ``frame`` and each
+        of its callers.  This is called from the sampler thread.
+        """
+        weight = max(now - self._last_sample, 0.0)
+        self._last_sample = now
+
+        stack = []
+        while frame is not None and frame is not self._stop_frame:
+            stack.append(frame)
+            frame = frame.f_back
+        stack.reverse()
+        if not stack:
+            return
+
+        # A frame is considered a new call if it wasn't at the same depth of
+        # the previous sample; once the stacks diverge, every deeper frame is
+        # new as well.  Since the memory of a finished frame is often reused
+        # for the next call, the position of the call within its caller is
+        # part of a frame's identity.
+        identities = tuple((id(f), f.f_back and f.f_back.f_lasti)
+                           for f in stack)
+        last_stack = self._last_stack
+        self._last_stack = identities
+        diverged = False
+
+        codes = [f.f_code for f in stack]
+        seen_codes = set()
+        seen_edges = set()
+        leaf = len(codes) - 1
+
+        for depth, code in enumerate(codes):
+            if not diverged and (depth >= len(last_stack) or
+                                 last_stack[depth] != identities[depth]):
+                diverged = True
+            recursive = code in seen_codes
+
+            node = self._nodes.get(code)
+            if node is None:
+                node = self._nodes[code] = [0, 0, 0.0, 0.0]
+            if diverged:
+                node[0] += 1
+                if recursive:
+                    node[1] += 1
+            if not recursive:
+                node[2] += weight
+            if depth == leaf:
+                node[3] += weight
+            seen_codes.add(code)
+
+            if depth == 0:
+                continue
+
+            edge_key = (codes[depth - 1], code)
+            edge = self._edges.get(edge_key)
+            if edge is None:
+                edge = self._edges[edge_key] = [0, 0, 0.0, 0.0]
+            if diverged:
+                edge[0] += 1
+                if recursive:
+                    edge[1] += 1
+            if edge_key not in seen_edges:
+                edge[2] += weight
+            if depth == leaf:
+                edge[3] += weight
+            seen_edges.add(edge_key)
+
+    def getstats(self):
+        """
+        Returns a list of :class:`SampledEntry` objects, in the same shape as
+        :meth:`cProfile.Profile.getstats`.
+        """
+        calls = {}
+        for (caller, callee), values in self._edges.iteritems():
+            calls.setdefault(caller, []).append(
+                SampledSubEntry(callee, *values))
+
+        return [SampledEntry(code, *(values + [calls.get(code)]))
+                for code, values in self._nodes.iteritems()]
@@ -0,0 +1,140 @@
+# This file is part of linesman.
+#
+# linesman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# linesman is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with linesman.  If not, see <http://www.gnu.org/licenses/>.
+#
+import logging
+import os
+import threading
+from collections import OrderedDict
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
+
+from PIL import Image, ImageDraw
+
+
+log = logging.getLogger(__name__)
+
+_placeholder = None
+
+# Most failed jobs remembered by a :class:`RenderPool`; the oldest are
+# forgotten, and can then be retried.
+MAX_FAILED_JOBS = 1000
+
+
+def placeholder_image():
+    """
+    Returns the PNG data of a small image telling the user that their graph
+    is still being rendered.
+    """
+    global _placeholder
+    if _placeholder is None:
+        im = Image.new("RGB", (200, 30), "white")
+        ImageDraw.Draw(im).text((10, 10), "Rendering graph...", fill="black")
+        buf = StringIO()
+        im.save(buf, "PNG")
+        _placeholder = buf.getvalue()
+    return _placeholder
+
+
+class RenderPool(object):
+    """
+    Runs rendering jobs on a pool of background threads.  Jobs are identified
+    by a key--usually the name of the file being rendered--and submitting a
+    job whose key is already pending does nothing, so that concurrent
+    requests for the same graph only ever render it once.  Jobs that fail
+    are remembered, and aren't run again; see :meth:`has_failed`.
+
+    ``workers``:
+        Number of rendering threads.  If `0`, jobs are run immediately by
+        the thread that submits them.
+    """
+
+    def __init__(self, workers=2):
+        self.workers = int(workers)
+        self._pool = None
+        self._pending = {}
+        self._failed = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = ThreadPool(self.workers)
+        return self._pool
+
+    def is_pending(self, key):
+        """
+        Returns True if the job for ``key`` has been submitted, but hasn't
+        finished yet.
+        """
+        return key in self._pending
+
+    def has_failed(self, key):
+        """
+        Returns True if the job for ``key`` raised an exception, in which
+        case it isn't run again when it is submitted.
+        """
+        return key in self._failed
+
+    def submit(self, key, func, *args):
+        """
+        Schedules ``func(*args)`` to be run, unless a job for ``key`` is
+        already pending or has failed.
+
+        Returns True if the job has finished by the time this returns, which
+        is only ever the case when there are no worker threads.
+        """
+        if key in self._failed:
+            return True
+
+        if not self.workers:
+            self._run(key, func, args)
+            return True
+
+        with self._lock:
+            if key in self._pending:
+                return False
+            self._pending[key] = self._get_pool().apply_async(
+                self._run, (key, func, args))
+        return False
+
+    def _run(self, key, func, args):
+        try:
+            func(*args)
+        except Exception:
+            log.exception("Failed to render `%s'.", key)
+            with self._lock:
+                self._failed[key] = True
+                if len(self._failed) > MAX_FAILED_JOBS:
+                    self._failed.popitem(last=False)
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+    def wait(self):
+        """
+        Blocks until every pending job has finished.
+        """
+        with self._lock:
+            results = self._pending.values()
+        for result in results:
+            result.wait()
+
+    def close(self):
+        """
+        Waits for pending jobs, and then stops the worker threads.
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
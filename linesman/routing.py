@@ -0,0 +1,65 @@
+# This file is part of linesman.
+#
+# linesman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# linesman is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with linesman.  If not, see <http://www.gnu.org/licenses/>.
+#
+import re
+
+
+# Path segments that look like identifiers, rather than part of a route.
+ID_SEGMENT = re.compile(r"""^(
+    \d+                                         # numbers
+    | [0-9a-fA-F]{8}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?
+      [0-9a-fA-F]{4}-?[0-9a-fA-F]{12}           # uuids
+    | [0-9a-fA-F]{16,}                          # hashes
+)$""", re.VERBOSE)
+ID_PLACEHOLDER = "{id}"
+
+
+class RouteNormalizer(object):
+    """
+    Maps request paths to the endpoint that served them, so that
+    `/users/42` and `/users/43` are both treated as `/users/{id}`.
+
+    ``patterns``:
+        Either a string with one `regex endpoint` pair per line, or a list of
+        `(regex, endpoint)` tuples.  The endpoint of a path is that of the
+        first regex which matches the start of it.  Paths that don't match
+        any pattern have their numeric, uuid and hash segments replaced with
+        `{id}`.
+    """
+
+    def __init__(self, patterns=""):
+        if isinstance(patterns, basestring):
+            patterns = [line.split(None, 1)
+                        for line in patterns.splitlines() if line.strip()]
+        self.patterns = []
+        for pattern in patterns:
+            if len(pattern) != 2:
+                raise ValueError("Route patterns must be given as "
+                                 "`regex endpoint', not %r" % (pattern,))
+            regex, endpoint = pattern
+            self.patterns.append((re.compile(regex), endpoint.strip()))
+
+    def __call__(self, path):
+        """
+        Returns the endpoint of ``path``.
+        """
+        if path is None:
+            return None
+        for regex, endpoint in self.patterns:
+            if regex.match(path):
+                return endpoint
+        return "/".join(ID_PLACEHOLDER if ID_SEGMENT.match(segment)
+                        else segment
+                        for segment in path.split("/"))
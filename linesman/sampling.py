@@ -0,0 +1,110 @@
+# This file is part of linesman.
+#
+# linesman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# linesman is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with linesman.  If not, see <http://www.gnu.org/licenses/>.
+#
+import random
+import threading
+import time
+
+
+class RequestSampler(object):
+    """
+    Decides which requests should be profiled.  All of the configured limits
+    must agree before a request is sampled, so that, for example, a ``rate``
+    of `0.5` combined with a ``max_per_second`` of `2` will profile roughly
+    half of all requests, but never more than two per second.
+
+    ``rate``:
+        Probability, between `0.0` and `1.0`, that any given request will be
+        profiled.
+    ``every``:
+        Only every Nth request is considered for profiling.  A value of `1`
+        considers every request.
+    ``max_per_second``:
+        Maximum number of profiles per second, enforced with a token bucket.
+        Bursts of up to ``max_per_second`` profiles, or a single profile for
+        rates below one per second, are allowed.  If `None`, no rate limit is
+        applied.
+    """
+
+    def __init__(self, rate=1.0, every=1, max_per_second=None,
+                 clock=time.time, rand=random.random):
+        rate = float(rate)
+        every = int(every)
+        if not 0.0 <= rate <= 1.0:
+            raise ValueError("rate must be between 0.0 and 1.0, not %r" % rate)
+        if every < 1:
+            raise ValueError("every must be at least 1, not %r" % every)
+
+        self.rate = rate
+        self.every = every
+        self.max_per_second = None
+        self._capacity = None
+        if max_per_second is not None:
+            self.max_per_second = float(max_per_second)
+            # A bucket holding less than one token would never sample.
+            self._capacity = 0.0
+            if self.max_per_second > 0:
+                self._capacity = max(1.0, self.max_per_second)
+
+        self._clock = clock
+        self._rand = rand
+        self._lock = threading.Lock()
+        self._counter = 0
+        self._tokens = self._capacity
+        self._last_refill = clock()
+
+    @property
+    def always(self):
+        """
+        Returns True if this sampler will profile every single request.
+        """
+        return (self.rate >= 1.0 and self.every == 1 and
+                self.max_per_second is None)
+
+    def _take_token(self):
+        """
+        Refills the token bucket based on the time elapsed since the last
+        refill, and then attempts to take a single token from it.
+        """
+        now = self._clock()
+        elapsed = max(now - self._last_refill, 0.0)
+        self._last_refill = now
+        self._tokens = min(self._capacity,
+                           self._tokens + elapsed * self.max_per_second)
+        if self._tokens >= 1.0:
+            self._tokens -= 1.0
+            return True
+        return False
+
+    def should_sample(self):
+        """
+        Returns True if the current request should be profiled.
+        """
+        if self.always:
+            return True
+
+        with self._lock:
+            self._counter += 1
+            if self._counter < self.every:
+                return False
+            self._counter = 0
+
+            if self.rate < 1.0 and self._rand() >= self.rate:
+                return False
+
+            if self.max_per_second is not None:
+                return self._take_token()
+
+            return True
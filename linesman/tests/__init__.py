@@ -5,6 +5,7 @@ import tempfile
 from mock import Mock, patch
 
 import linesman
+from linesman.callgraph import CallGraph
 
 
 __all__ = ['SPECIFIC_DATE_DATETIME', 'SPECIFIC_DATE_EPOCH',
@@ -14,7 +15,8 @@ SPECIFIC_DATE_DATETIME = datetime.datetime(2011, 1, 1, 0, 0, 0, 0)
 SPECIFIC_DATE_EPOCH = time.mktime(SPECIFIC_DATE_DATETIME.timetuple())
 
 
-@patch.object(linesman, "create_graph", Mock(return_value=["abc"]))
+@patch.object(linesman, "create_call_graph",
+              Mock(return_value=CallGraph.from_dicts({"abc": None}, {})))
 def create_mock_session(timestamp=SPECIFIC_DATE_DATETIME):
     class Stat(object):
         totaltime = 0
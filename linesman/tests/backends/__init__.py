@@ -17,6 +17,6 @@ class TestBackend(unittest.TestCase):
             session1.path == session2.path,
             session1.timestamp == session2.timestamp,
             session1.uuid == session2.uuid,
-            session1._graph == session2._graph,
+            session1._callgraph == session2._callgraph,
             session1._uuid == session2._uuid,
         ))
@@ -1,6 +1,10 @@
+import unittest
+
 from nose.tools import raises
 
-from linesman.backends.base import Backend
+from linesman import SessionSummary
+from linesman.backends.base import Backend, filter_summaries
+from linesman.tests import SPECIFIC_DATE_DATETIME
 from linesman.tests.backends import TestBackend
 
 
@@ -43,3 +47,85 @@ class TestBaseBackend(TestBackend):
     def test_get_all_not_implemented(self):
         """ Test that get_all raises NotImplementedError. """
         self.backend.get_all()
+
+    @raises(NotImplementedError)
+    def test_get_summaries_not_implemented(self):
+        """ Test that get_summaries relies on get_all by default. """
+        self.backend.get_summaries()
+
+    def test_iter_summaries(self):
+        """ Test that summaries are filtered from get_summaries by default. """
+        summaries = [SessionSummary(str(i), "/a/%d" % i, float(i),
+                                    SPECIFIC_DATE_DATETIME)
+                     for i in range(5)]
+        self.backend.get_summaries = lambda: summaries
+
+        actual = self.backend.iter_summaries(
+            order_by="duration", descending=True, path_prefix="/a/",
+            min_duration=1, limit=2, offset=1)
+        self.assertEquals([summary.uuid for summary in actual], ["3", "2"])
+        self.assertEquals(self.backend.count_summaries(min_duration=3), 2)
+
+    @raises(ValueError)
+    def test_iter_summaries_invalid_order(self):
+        """ Test that summaries can only be ordered by known fields. """
+        self.backend.get_summaries = lambda: []
+        self.backend.iter_summaries(order_by="session")
+
+    def test_state(self):
+        """ Test that state is kept in memory by default """
+        self.backend.save_state("a:1", 1)
+        self.backend.save_state("b:1", 2)
+        self.backend.save_state("a:2", 3)
+
+        self.assertEquals(self.backend.load_state("a:1"), 1)
+        self.assertEquals(self.backend.load_state("c", 4), 4)
+        self.assertEquals(list(self.backend.iter_states("a:")),
+                          [("a:1", 1), ("a:2", 3)])
+        self.assertEquals(self.backend.delete_state("a:1"), 1)
+        self.assertEquals(self.backend.delete_state("a:1"), 0)
+
+
+class TestFilterSummaries(unittest.TestCase):
+
+    def setUp(self):
+        self.summaries = [
+            SessionSummary("a", "/users/1", 1.0,
+                           SPECIFIC_DATE_DATETIME.replace(day=3)),
+            SessionSummary("b", "/users/2", 3.0,
+                           SPECIFIC_DATE_DATETIME.replace(day=1)),
+            SessionSummary("c", "/posts/1", 2.0,
+                           SPECIFIC_DATE_DATETIME.replace(day=2)),
+            SessionSummary("d", "/posts/2", 2.0,
+                           SPECIFIC_DATE_DATETIME.replace(day=4)),
+        ]
+
+    def uuids(self, **kwargs):
+        return [summary.uuid
+                for summary in filter_summaries(self.summaries, **kwargs)]
+
+    def test_order(self):
+        """ Test that summaries are ordered, with ties ordered by uuid """
+        self.assertEquals(self.uuids(), ["b", "c", "a", "d"])
+        self.assertEquals(self.uuids(order_by="duration"),
+                          ["a", "c", "d", "b"])
+        self.assertEquals(self.uuids(order_by="duration", descending=True),
+                          ["b", "d", "c", "a"])
+
+    def test_filters(self):
+        """ Test filtering by path, duration and time range """
+        self.assertEquals(self.uuids(path_prefix="/users/"), ["b", "a"])
+        self.assertEquals(self.uuids(min_duration=2), ["b", "c", "d"])
+        self.assertEquals(self.uuids(min_duration="2"), ["b", "c", "d"])
+        self.assertEquals(
+            self.uuids(since=SPECIFIC_DATE_DATETIME.replace(day=2),
+                       until=SPECIFIC_DATE_DATETIME.replace(day=4)),
+            ["c", "a"])
+
+    def test_keyset_pagination(self):
+        """ Test that pages continue after the last session of a page """
+        self.assertEquals(
+            self.uuids(order_by="duration", after=(2.0, "c")), ["d", "b"])
+        self.assertEquals(
+            self.uuids(order_by="duration", descending=True,
+                       after=(2.0, "d"), limit=1), ["c"])
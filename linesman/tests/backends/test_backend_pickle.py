@@ -1,13 +1,18 @@
+import cPickle
 import os
-from cPickle import HIGHEST_PROTOCOL
 from nose.tools import raises
-from mock import MagicMock, Mock, patch
-from tempfile import TemporaryFile
 
 import linesman.backends.pickle
-from linesman.tests import get_temporary_filename
+from linesman.tests import create_mock_session, get_temporary_filename
 from linesman.tests.backends import TestBackend
 
+try:
+    # Python 2.7+
+    from collections import OrderedDict
+except ImportError:
+    # Python 2.4+
+    from ordereddict import OrderedDict
+
 MOCK_SESSION_UUID = "abcd1234"
 
 
@@ -15,158 +20,356 @@ class TestBackendPickle(TestBackend):
 
     def setUp(self):
         self.filename = get_temporary_filename()
-        self.backend = linesman.backends.pickle.PickleBackend(self.filename)
+        self.backend = linesman.backends.pickle.PickleBackend(
+            self.filename, compact_interval=0)
 
     def tearDown(self):
+        self.backend.close()
+        for filename in (self.filename, self.filename + ".lock"):
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def reopen(self):
+        """ Closes the backend and sets up a new one on the same log. """
+        self.backend.close()
+        self.backend = linesman.backends.pickle.PickleBackend(
+            self.filename, compact_interval=0)
+        self.backend.setup()
+
+    def test_setup(self):
+        """ Test that setup creates a new, empty log. """
         os.remove(self.filename)
+        self.backend.setup()
 
-    @patch("cPickle.dump")
-    def test_flush(self, mock_dump):
-        """ Test that the file is opened by cPickle. """
-        test_fd = TemporaryFile()
-        with patch("__builtin__.open", Mock(side_effect=IOError())):
-            self.backend.setup()
-
-        with patch("__builtin__.open") as mock_open:
-            mock_open.return_value = test_fd
-            self.backend._flush()
-            mock_open.assert_called_once_with(
-                self.backend.filename, "w+b")
-
-        mock_dump.assert_called_once_with(
-            self.backend._session_history,
-            test_fd,
-            HIGHEST_PROTOCOL)
-
-    @patch("__builtin__.open")
-    @patch("cPickle.load")
-    def test_setup(self, mock_load, mock_open):
-        """ Test that setup will load pickled data. """
-        mock_open.return_value = MagicMock(spec=file)
-        self.backend.setup()
-        mock_open.assert_called_once_with(self.filename, "rb")
-        mock_load.assert_called_once()
-
-    @patch("__builtin__.open")
-    @patch("linesman.backends.pickle.OrderedDict")
-    def test_setup_ioerror(self, mock_ordered_dict, mock_open):
-        """ Test that setup will create a new ordered dict if no file exists
-        """
-        mock_open.side_effect = IOError()
-        self.backend.setup()
-        mock_ordered_dict.assert_called_once_with()
-
-    @raises(ValueError)
-    @patch("__builtin__.open")
-    def test_setup_value_error(self, mock_open):
-        """ Test that bad pickled data raises a ValueError. """
-        mock_open.side_effect = ValueError("Could not unpickle!")
-        self.backend.setup()
-
-    @patch("__builtin__.open", Mock(side_effect=IOError()))
-    @patch("linesman.backends.pickle.PickleBackend._flush")
-    def test_add(self, mock_flush):
-        """ Test that add creates a new entry in the session. """
-        mock_session = MagicMock()
-        mock_session.uuid = MOCK_SESSION_UUID
-
-        self.backend.setup()
-        self.backend.add(mock_session)
-
-        self.assertTrue(mock_session.uuid in self.backend._session_history)
-        mock_flush.assert_called_once()
-
-    @patch("__builtin__.open", Mock(side_effect=IOError()))
-    @patch("linesman.backends.pickle.PickleBackend._flush")
-    def test_delete(self, mock_flush):
-        """ Test that deleting an existing UUID returns 0. """
-        mock_session = MagicMock()
-        mock_session.uuid = MOCK_SESSION_UUID
-
-        self.backend.setup()
-        self.backend.add(mock_session)
-        self.assertEquals(self.backend.delete(mock_session.uuid), 1)
-        mock_flush.assert_called_once()
-
-    @patch("__builtin__.open", Mock(side_effect=IOError()))
-    @patch("linesman.backends.pickle.PickleBackend._flush")
-    def test_delete_non_existent_uuid(self, mock_flush):
-        """ Test that deleting a non-existing UUID returns 0. """
-        mock_session = MagicMock()
-        mock_session.uuid = MOCK_SESSION_UUID
+        with open(self.filename, "rb") as fd:
+            self.assertEquals(fd.read(), linesman.backends.pickle.MAGIC)
+        self.assertEquals(self.backend.get_all(), {})
+
+    def test_setup_rebuilds_index(self):
+        """ Test that sessions are found again after reopening the log. """
+        self.backend.setup()
+        sessions = [create_mock_session() for i in range(3)]
+        for session in sessions:
+            self.backend.add(session)
+        self.backend.delete(sessions[1].uuid)
+
+        self.reopen()
+        self.assertEquals(list(self.backend.get_all()),
+                          [sessions[0].uuid, sessions[2].uuid])
+        self.assertSessionsEqual(self.backend.get(sessions[2].uuid),
+                                 sessions[2])
+
+    def test_setup_truncated_record(self):
+        """ Test that a partly written record at the end is discarded. """
+        self.backend.setup()
+        session = create_mock_session()
+        self.backend.add(session)
+        size = os.path.getsize(self.filename)
+        self.backend.add(create_mock_session())
+        self.backend.close()
+
+        with open(self.filename, "r+b") as fd:
+            fd.truncate(size + 10)
+
+        self.reopen()
+        self.assertEquals(list(self.backend.get_all()), [session.uuid])
+        self.assertEquals(os.path.getsize(self.filename), size)
+
+    def test_setup_corrupt_record(self):
+        """ Test that a record that can't be unpickled is discarded. """
+        self.backend.setup()
+        session = create_mock_session()
+        self.backend.add(session)
+        size = os.path.getsize(self.filename)
+        self.backend.close()
+
+        with open(self.filename, "ab") as fd:
+            fd.write(linesman.backends.pickle.RECORD_HEADER.pack(
+                linesman.backends.pickle.SESSION_RECORD, 4, 0) + "\xff\xff..")
+
+        self.reopen()
+        self.assertEquals(list(self.backend.get_all()), [session.uuid])
+        self.assertEquals(os.path.getsize(self.filename), size)
 
+    def test_setup_converts_legacy_file(self):
+        """ Test that a pickled dictionary of sessions is converted. """
+        session = create_mock_session()
+        with open(self.filename, "wb") as fd:
+            cPickle.dump(OrderedDict([(session.uuid, session)]), fd, -1)
+
+        self.backend.setup()
+        self.assertSessionsEqual(self.backend.get(session.uuid), session)
+        with open(self.filename, "rb") as fd:
+            magic = fd.read(len(linesman.backends.pickle.MAGIC))
+        self.assertEquals(magic, linesman.backends.pickle.MAGIC)
+
+    @raises(cPickle.UnpicklingError)
+    def test_setup_unpickling_error(self):
+        """ Test that bad pickled data raises an error. """
+        with open(self.filename, "wb") as fd:
+            fd.write("\xffThis isn't a pickle.")
+        self.backend.setup()
+
+    def test_add(self):
+        """ Test that add appends a single record to the log. """
+        self.backend.setup()
+        self.backend.add(create_mock_session())
+        size = os.path.getsize(self.filename)
+
+        session = create_mock_session()
+        self.backend.add(session)
+        with open(self.filename, "rb") as fd:
+            fd.seek(size)
+            record_type, key_size, body_size = \
+                linesman.backends.pickle.RECORD_HEADER.unpack(
+                    fd.read(linesman.backends.pickle.RECORD_HEADER.size))
+            uuid, summary = cPickle.loads(fd.read(key_size))
+            self.assertEquals(len(fd.read()), body_size)
+
+        self.assertEquals(record_type, linesman.backends.pickle.SESSION_RECORD)
+        self.assertEquals(uuid, session.uuid)
+        self.assertEquals(summary.uuid, session.uuid)
+
+    def test_delete(self):
+        """ Test that deleting an existing UUID returns 1. """
+        session = create_mock_session()
         self.backend.setup()
-        self.backend.add(mock_session)
+        self.backend.add(session)
+        self.assertEquals(self.backend.delete(session.uuid), 1)
+        self.assertEquals(self.backend.get(session.uuid), None)
+
+    def test_delete_non_existent_uuid(self):
+        """ Test that deleting a non-existing UUID returns 0. """
+        self.backend.setup()
+        self.backend.add(create_mock_session())
+        size = os.path.getsize(self.filename)
         self.assertEquals(self.backend.delete("basb3144"), 0)
-        mock_flush.assert_called_once()
+        self.assertEquals(os.path.getsize(self.filename), size)
 
-    @patch("__builtin__.open", Mock(side_effect=IOError()))
-    @patch("linesman.backends.pickle.PickleBackend._flush")
-    def test_delete_many(self, mock_flush):
+    def test_delete_many(self):
         """ Test that delete_many does the right thing. """
         self.backend.setup()
-        mock_sessions = []
+        sessions = []
         for i in range(10):
-            mock_session = MagicMock()
-            mock_session.uuid = str(i)
-            mock_sessions.append(mock_session)
-            self.backend.add(mock_session)
-
-        self.assertEquals(self.backend.delete_many(session.uuid for session in mock_sessions[0:5]), 5)
-        self.assertEquals(self.backend.delete_many(['11','12','13','14']), 0)
-        self.assertEquals(len(self.backend._session_history), 5)
-        mock_flush.assert_called_once()
-
-    @patch("__builtin__.open", Mock(side_effect=IOError()))
-    @patch("linesman.backends.pickle.PickleBackend._flush")
-    def test_delete_all(self, mock_flush):
-        """ Test that deleting a non-existing UUID returns 0. """
-        mock_session1 = MagicMock()
-        mock_session1.uuid = MOCK_SESSION_UUID
+            session = create_mock_session()
+            sessions.append(session)
+            self.backend.add(session)
 
-        mock_session2 = MagicMock()
-        mock_session2.uuid = "something else"
+        self.assertEquals(self.backend.delete_many(
+            session.uuid for session in sessions[0:5]), 5)
+        self.assertEquals(self.backend.delete_many(['11', '12', '13']), 0)
+        self.assertEquals(len(self.backend.get_all()), 5)
 
+    def test_delete_all(self):
+        """ Test that delete_all removes every session and truncates. """
         self.backend.setup()
-        self.backend.add(mock_session1)
-        self.backend.add(mock_session2)
+        self.backend.add(create_mock_session())
+        self.backend.add(create_mock_session())
         self.assertEquals(self.backend.delete_all(), 2)
-        self.assertEquals(len(self.backend._session_history), 0)
-        mock_flush.assert_called_once()
+        self.assertEquals(len(self.backend.get_all()), 0)
+        self.assertEquals(os.path.getsize(self.filename),
+                          len(linesman.backends.pickle.MAGIC))
 
-    @patch("__builtin__.open", Mock(side_effect=IOError()))
-    @patch("linesman.backends.pickle.PickleBackend._flush")
-    def test_delete_all_empty(self, mock_flush):
-        """ Test that callign delete all on an empty dict returns 0. """
+        self.reopen()
+        self.assertEquals(len(self.backend.get_all()), 0)
+
+    def test_delete_all_empty(self):
+        """ Test that calling delete all on an empty log returns 0. """
         self.backend.setup()
         self.assertEquals(self.backend.delete_all(), 0)
-        mock_flush.assert_called_once()
 
-    @patch("__builtin__.open", Mock(side_effect=IOError()))
-    @patch("linesman.backends.pickle.PickleBackend._flush", Mock())
     def test_get(self):
         """ Test that retrieving an existing UUID succeeds. """
-        mock_session = MagicMock()
-        mock_session.uuid = MOCK_SESSION_UUID
-
+        session = create_mock_session()
         self.backend.setup()
-        self.backend.add(mock_session)
-        self.assertEquals(self.backend.get(MOCK_SESSION_UUID), mock_session)
+        self.backend.add(session)
+        self.assertSessionsEqual(self.backend.get(session.uuid), session)
 
-    @patch("__builtin__.open", Mock(side_effect=IOError()))
     def test_get_non_existent_uuid(self):
         """ Test that retrieving an non-existent UUID returns None. """
         self.backend.setup()
         self.assertEquals(self.backend.get(MOCK_SESSION_UUID), None)
 
-    @patch("__builtin__.open", Mock(side_effect=IOError()))
-    @patch("linesman.backends.pickle.PickleBackend._flush", Mock())
     def test_get_all(self):
-        """ Test that getting all results returns a copy. """
-        mock_session = MagicMock()
-        mock_session.uuid = MOCK_SESSION_UUID
+        """ Test that all sessions are returned, oldest first. """
+        sessions = [create_mock_session() for i in range(3)]
+        self.backend.setup()
+        for session in sessions:
+            self.backend.add(session)
+
+        self.assertEquals(list(self.backend.get_all()),
+                          [session.uuid for session in sessions])
 
+    def test_get_summaries(self):
+        """ Test that summaries are read from the index. """
+        sessions = [create_mock_session() for i in range(3)]
         self.backend.setup()
-        self.backend.add(mock_session)
-        session_history_copy = self.backend.get_all()
-        assert self.backend._session_history is not session_history_copy
+        for session in sessions:
+            self.backend.add(session)
+
+        self.reopen()
+        self.assertEquals(
+            [summary.uuid for summary in self.backend.get_summaries()],
+            [session.uuid for session in sessions])
+
+    def test_compression(self):
+        """ Test that compressed sessions are read back after reopening. """
+        self.backend = linesman.backends.pickle.PickleBackend(
+            self.filename, compact_interval=0, compression="bz2")
+        self.backend.setup()
+        session = create_mock_session()
+        self.backend.add(session)
+
+        self.reopen()
+        self.assertSessionsEqual(self.backend.get(session.uuid), session)
+
+    def test_max_sessions(self):
+        """ Test that the oldest sessions are evicted on add. """
+        self.backend = linesman.backends.pickle.PickleBackend(
+            self.filename, compact_interval=0, max_sessions=2)
+        self.backend.setup()
+        sessions = [create_mock_session() for i in range(3)]
+        for session in sessions:
+            self.backend.add(session)
+
+        self.assertEquals(list(self.backend.get_all()),
+                          [sessions[1].uuid, sessions[2].uuid])
+
+    def test_keep_slowest(self):
+        """ Test that only the slowest sessions per endpoint are stored. """
+        self.backend = linesman.backends.pickle.PickleBackend(
+            self.filename, compact_interval=0, keep_slowest=1)
+        self.backend.setup()
+        sessions = [create_mock_session() for i in range(3)]
+        for session, duration in zip(sessions, (1.0, 0.5, 2.0)):
+            session.duration = duration
+            self.backend.add(session)
+
+        self.assertEquals(list(self.backend.get_all()), [sessions[2].uuid])
+
+    def test_compact(self):
+        """ Test that compaction removes deleted sessions from the log. """
+        self.backend.setup()
+        sessions = [create_mock_session() for i in range(4)]
+        for session in sessions:
+            self.backend.add(session)
+        size = os.path.getsize(self.filename)
+        self.backend.delete_many([sessions[0].uuid, sessions[2].uuid])
+        self.assertTrue(self.backend.needs_compaction())
+
+        self.backend.compact()
+        self.assertFalse(self.backend.needs_compaction())
+        self.assertTrue(os.path.getsize(self.filename) < size)
+        self.assertSessionsEqual(self.backend.get(sessions[3].uuid),
+                                 sessions[3])
+
+        self.reopen()
+        self.assertEquals(list(self.backend.get_all()),
+                          [sessions[1].uuid, sessions[3].uuid])
+
+    def test_needs_compaction(self):
+        """ Test that compaction waits for enough deleted sessions. """
+        self.backend.setup()
+        sessions = [create_mock_session() for i in range(4)]
+        for session in sessions:
+            self.backend.add(session)
+        self.assertFalse(self.backend.needs_compaction())
+
+        self.backend.delete(sessions[0].uuid)
+        self.assertFalse(self.backend.needs_compaction())
+        self.backend.delete(sessions[1].uuid)
+        self.assertTrue(self.backend.needs_compaction())
+
+    def test_background_compaction(self):
+        """ Test that the log is compacted by the background thread. """
+        self.backend = linesman.backends.pickle.PickleBackend(
+            self.filename, compact_interval=0.01)
+        self.backend.setup()
+        session = create_mock_session()
+        self.backend.add(session)
+        self.backend.delete(session.uuid)
+
+        for i in range(100):
+            if not self.backend.needs_compaction():
+                break
+            self.backend._stop_compacting.wait(0.01)
+        self.assertEquals(os.path.getsize(self.filename),
+                          len(linesman.backends.pickle.MAGIC))
+
+    def test_iter_summaries(self):
+        """ Test that summaries are filtered and ordered from the index. """
+        sessions = [create_mock_session() for i in range(3)]
+        self.backend.setup()
+        for session, duration in zip(sessions, (1.0, 3.0, 2.0)):
+            session.duration = duration
+            self.backend.add(session)
+
+        self.assertEquals(
+            [summary.uuid for summary in self.backend.iter_summaries(
+                order_by="duration", descending=True, limit=2)],
+            [sessions[1].uuid, sessions[2].uuid])
+        self.assertEquals(self.backend.count_summaries(min_duration=2), 2)
+
+    def open_other(self):
+        """ Sets up a second backend on the same log. """
+        other = linesman.backends.pickle.PickleBackend(self.filename,
+                                                       compact_interval=0)
+        other.setup()
+        self.addCleanup(other.close)
+        return other
+
+    def test_shared_log(self):
+        """ Test that backends sharing a log see each other's changes. """
+        self.backend.setup()
+        other = self.open_other()
+        sessions = [create_mock_session() for i in range(3)]
+        self.backend.add(sessions[0])
+        other.add(sessions[1])
+        self.backend.add(sessions[2])
+        other.delete(sessions[0].uuid)
+
+        uuids = [sessions[1].uuid, sessions[2].uuid]
+        self.assertEquals(list(self.backend.get_all()), uuids)
+        self.assertEquals(list(other.get_all()), uuids)
+
+        # Compacting or clearing the log replaces it, and the other backend
+        # reloads it.
+        other.compact()
+        self.assertSessionsEqual(self.backend.get(sessions[2].uuid),
+                                 sessions[2])
+        self.assertFalse(self.backend.needs_compaction())
+        self.backend.delete_all()
+        self.assertEquals(other.get_all(), {})
+
+        self.reopen()
+        self.assertEquals(self.backend.get_all(), {})
+
+    def test_compact_concurrent_changes(self):
+        """ Test that changes made while compacting are kept. """
+        self.backend.setup()
+        other = self.open_other()
+        sessions = [create_mock_session() for i in range(4)]
+        for session in sessions[:3]:
+            self.backend.add(session)
+        self.backend.delete(sessions[0].uuid)
+        copy_records = self.backend._copy_records
+
+        def _copy_records(*args):
+            copied = copy_records(*args)
+            other.delete(sessions[1].uuid)
+            other.add(sessions[2])
+            other.add(sessions[3])
+            return copied
+
+        self.backend._copy_records = _copy_records
+        self.backend.compact()
+
+        uuids = [sessions[2].uuid, sessions[3].uuid]
+        self.assertEquals(list(self.backend.get_all()), uuids)
+        self.assertEquals(list(other.get_all()), uuids)
+        garbage = self.backend._garbage
+        self.reopen()
+        self.assertEquals(list(self.backend.get_all()), uuids)
+        self.assertEquals(self.backend._garbage, garbage)
+        self.assertSessionsEqual(self.backend.get(sessions[3].uuid),
+                                 sessions[3])
@@ -1,8 +1,16 @@
+import cPickle
 import os
+import sqlite3
+import threading
+from datetime import datetime
 
-from linesman.backends.sqlite import SqliteBackend
+from mock import patch
+
+from linesman.backends.retention import RetentionPolicy
+from linesman.backends.sqlite import SqliteBackend, _retry_if_locked
+from linesman.callgraph import CallGraph
 from linesman.tests import (create_mock_session, get_temporary_filename, \
-                            SPECIFIC_DATE_EPOCH)
+                            SPECIFIC_DATE_DATETIME, SPECIFIC_DATE_EPOCH)
 from linesman.tests.backends import TestBackend
 
 
@@ -14,14 +22,25 @@ class TestBackendSqlite(TestBackend):
         self.backend.setup()
 
     def tearDown(self):
-        os.remove(self.filename)
+        self.backend.close()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.filename + suffix):
+                os.remove(self.filename + suffix)
 
     def test_setup(self):
         """ Test that setup() creates a new table with the correct columns. """
         expected_columns = [
             (u"uuid",       u"",        1),
             (u"timestamp",  u"FLOAT",    0),
-            (u"session",    u"PICKLE",   0)
+            (u"session",    u"PICKLE",   0),
+            (u"path",       u"TEXT",     0),
+            (u"duration",   u"FLOAT",    0),
+            (u"method",     u"TEXT",     0),
+            (u"status",     u"INTEGER",  0),
+            (u"node_count", u"INTEGER",  0),
+            (u"endpoint",   u"TEXT",     0),
+            (u"size",       u"INTEGER",  0),
+            (u"structure",  u"TEXT",     0),
         ]
 
         # Verify that setup created the correct tables
@@ -85,6 +104,18 @@ class TestBackendSqlite(TestBackend):
         c.execute("SELECT COUNT(*) FROM sessions;")
         self.assertEquals(c.fetchone(), (5,))
 
+    @patch("linesman.backends.sqlite.DELETE_CHUNK_SIZE", 2)
+    def test_delete_many_chunks(self):
+        """ Test that many sessions are deleted a chunk at a time """
+        sessions = []
+        for i in range(5):
+            mock_session = create_mock_session()
+            self.backend.add(mock_session)
+            sessions.append(mock_session.uuid)
+
+        self.assertEquals(self.backend.delete_many(sessions + ["missing"]), 5)
+        self.assertEquals(self.backend.get_summaries(), [])
+
     def test_delete_all(self):
         """ Test that deleting all session removes them all from the DB """
         # Add a few new session profiles
@@ -135,3 +166,544 @@ class TestBackendSqlite(TestBackend):
         """ Test that an empty dict is returned when no sessions exist. """
         actual_sessions = self.backend.get_all()
         self.assertFalse(len(actual_sessions))
+
+    def test_setup_upgrades_old_table(self):
+        """ Test that setup() adds and fills summary columns in old tables """
+        mock_session = create_mock_session()
+        c = self.backend.conn.cursor()
+        c.execute("DROP TABLE sessions;")
+        c.execute("CREATE TABLE sessions "
+                  "(uuid PRIMARY KEY, timestamp FLOAT, session PICKLE);")
+        c.execute("INSERT INTO sessions VALUES (?, ?, ?);", (
+            mock_session.uuid, SPECIFIC_DATE_EPOCH,
+            sqlite3.Binary(cPickle.dumps(mock_session, -1))))
+
+        self.backend.setup()
+
+        summary, = self.backend.get_summaries()
+        self.assertEquals(summary.uuid, mock_session.uuid)
+        self.assertEquals(summary.duration, mock_session.duration)
+        self.assertEquals(summary.node_count, 1)
+
+    def test_get_summaries(self):
+        """ Test that summaries are listed oldest first """
+        sessions = [create_mock_session(SPECIFIC_DATE_DATETIME.replace(day=d))
+                    for d in (3, 1, 2)]
+        sessions[0].path = "/some/path"
+        sessions[0].method = "GET"
+        sessions[0].status = 200
+        for session in sessions:
+            self.backend.add(session)
+
+        summaries = self.backend.get_summaries()
+        self.assertEquals([summary.uuid for summary in summaries],
+                          [sessions[i].uuid for i in (1, 2, 0)])
+
+        summary = summaries[-1]
+        self.assertEquals(summary.path, "/some/path")
+        self.assertEquals(summary.method, "GET")
+        self.assertEquals(summary.status, 200)
+        self.assertEquals(summary.timestamp, sessions[0].timestamp)
+        self.assertEquals(summary.node_count, 1)
+
+    def add_sessions(self):
+        """ Adds sessions on three different days, with varying paths """
+        sessions = []
+        for day, path, duration in ((3, "/users/1", 1.0),
+                                    (1, "/users/2", 3.0),
+                                    (2, "/posts/1", 2.0),
+                                    (4, "/posts/2", 2.0)):
+            session = create_mock_session(
+                SPECIFIC_DATE_DATETIME.replace(day=day))
+            session.path = path
+            session.duration = duration
+            self.backend.add(session)
+            sessions.append(session)
+        return sessions
+
+    def test_iter_summaries(self):
+        """ Test that summaries can be filtered, ordered and paged """
+        sessions = self.add_sessions()
+        uuids = lambda summaries: [summary.uuid for summary in summaries]
+
+        self.assertEquals(
+            uuids(self.backend.iter_summaries(path_prefix="/users/")),
+            [sessions[1].uuid, sessions[0].uuid])
+        self.assertEquals(
+            uuids(self.backend.iter_summaries(
+                order_by="duration", descending=True, min_duration=2,
+                limit=2)),
+            [sessions[1].uuid] + sorted([sessions[2].uuid,
+                                         sessions[3].uuid])[-1:])
+        self.assertEquals(
+            uuids(self.backend.iter_summaries(
+                since=SPECIFIC_DATE_DATETIME.replace(day=2),
+                until=SPECIFIC_DATE_DATETIME.replace(day=4), offset=1)),
+            [sessions[0].uuid])
+
+    def test_iter_summaries_keyset(self):
+        """ Test that paging with `after' visits every session once """
+        self.add_sessions()
+        seen = []
+        after = None
+        while True:
+            page = list(self.backend.iter_summaries(
+                order_by="duration", limit=1, after=after))
+            if not page:
+                break
+            seen.append(page[0].uuid)
+            after = (page[0].duration, page[0].uuid)
+
+        self.assertEquals(seen, [summary.uuid for summary in
+                                 self.backend.iter_summaries("duration")])
+        self.assertEquals(len(seen), 4)
+
+        summary = list(self.backend.iter_summaries())[1]
+        self.assertEquals(
+            len(list(self.backend.iter_summaries(
+                after=(summary.timestamp, summary.uuid)))), 2)
+
+    def test_state(self):
+        """ Test that state is persisted, listed by prefix and deleted """
+        self.backend.save_state("a:1", {"value": 1})
+        self.backend.save_state("a:2", [2])
+        self.backend.save_state("b:1", "three")
+        self.backend.save_state("a:1", {"value": 4})
+
+        self.backend.close()
+        self.backend = SqliteBackend(self.filename, compression="zlib")
+        self.backend.setup()
+
+        self.assertEquals(self.backend.load_state("a:1"), {"value": 4})
+        self.assertEquals(self.backend.load_state("c", "default"), "default")
+        self.assertEquals(list(self.backend.iter_states("a:")),
+                          [("a:1", {"value": 4}), ("a:2", [2])])
+        self.assertEquals(self.backend.delete_state("a:1"), 1)
+        self.assertEquals(self.backend.delete_state("a:1"), 0)
+        self.assertEquals([key for key, value in self.backend.iter_states()],
+                          ["a:2", "b:1"])
+
+    def test_count_summaries(self):
+        """ Test that filtered sessions are counted in SQL """
+        self.add_sessions()
+        self.assertEquals(self.backend.count_summaries(), 4)
+        self.assertEquals(self.backend.count_summaries(path_prefix="/posts"),
+                          2)
+
+    def test_summary_indexes(self):
+        """ Test that the summary columns used for listing are indexed """
+        c = self.backend.conn.cursor()
+        c.execute("PRAGMA index_list(sessions);")
+        index_names = set(row[1] for row in c.fetchall())
+        for column in ("timestamp", "path", "duration", "endpoint"):
+            self.assertTrue("sessions_%s" % column in index_names)
+
+    def test_connection_per_thread(self):
+        """ Test that each thread reuses its own connection """
+        conn = self.backend.conn
+        self.assertTrue(self.backend.conn is conn)
+
+        other_conns = []
+        thread = threading.Thread(
+            target=lambda: other_conns.append(self.backend.conn))
+        thread.start()
+        thread.join()
+        self.assertFalse(other_conns[0] is conn)
+
+    def test_wal_mode(self):
+        """ Test that connections use the configured journal mode """
+        c = self.backend.conn.cursor()
+        c.execute("PRAGMA journal_mode;")
+        self.assertEquals(c.fetchone(), (u"wal",))
+
+    def test_invalid_journal_mode(self):
+        """ Test that unknown journal modes are rejected """
+        self.assertRaises(ValueError, SqliteBackend, self.filename,
+                          journal_mode="sometimes")
+
+    def test_invalid_synchronous(self):
+        """ Test that unknown synchronous levels are rejected """
+        self.assertRaises(ValueError, SqliteBackend, self.filename,
+                          synchronous="sometimes")
+
+    def test_close(self):
+        """ Test that close() closes the connection of every thread """
+        conn = self.backend.conn
+        self.backend.close()
+        self.assertRaises(sqlite3.ProgrammingError, conn.execute,
+                          "SELECT 1;")
+        self.assertFalse(self.backend.conn is conn)
+
+    def test_retry_if_locked(self):
+        """ Test that queries are retried while the database is locked """
+        attempts = []
+
+        def locked(*args):
+            attempts.append(args)
+            if len(attempts) < 3:
+                raise sqlite3.OperationalError("database is locked")
+            return "result"
+
+        with patch("time.sleep"):
+            result = _retry_if_locked(locked)(self.backend)
+        self.assertEquals(result, "result")
+        self.assertEquals(len(attempts), 3)
+
+    def test_retry_gives_up(self):
+        """ Test that the error is raised once the retries are used up """
+        def locked(*args):
+            raise sqlite3.OperationalError("database is locked")
+
+        self.backend.retries = 1
+        with patch("time.sleep"):
+            self.assertRaises(sqlite3.OperationalError,
+                              _retry_if_locked(locked),
+                              self.backend)
+
+    def test_compression(self):
+        """ Test that compressed and uncompressed sessions can be read """
+        plain_session = create_mock_session()
+        self.backend.add(plain_session)
+
+        self.backend.close()
+        self.backend = SqliteBackend(self.filename, compression="zlib")
+        compressed_session = create_mock_session()
+        self.backend.add(compressed_session)
+
+        c = self.backend.conn.cursor()
+        c.execute("SELECT CAST(session AS BLOB) FROM sessions "
+                  "WHERE uuid = ?;", (compressed_session.uuid,))
+        self.assertEquals(c.fetchone()[0][:2], "\0z")
+
+        self.assertSessionsEqual(self.backend.get(plain_session.uuid),
+                                 plain_session)
+        self.assertSessionsEqual(self.backend.get(compressed_session.uuid),
+                                 compressed_session)
+
+    def test_auto_vacuum(self):
+        """ Test that new databases can give free space back """
+        c = self.backend.conn.cursor()
+        c.execute("PRAGMA auto_vacuum;")
+        self.assertEquals(c.fetchone(), (2,))
+
+    def test_size_column(self):
+        """ Test that the size of each stored session is recorded """
+        self.backend.add(create_mock_session())
+        c = self.backend.conn.cursor()
+        c.execute("SELECT size = LENGTH(session) FROM sessions;")
+        self.assertEquals(c.fetchone(), (1,))
+
+    def test_totals(self):
+        """ Test that the count and size of sessions are kept up to date """
+        sessions = [create_mock_session() for i in range(3)]
+        for session in sessions:
+            self.backend.add(session)
+        self.backend.delete(sessions[0].uuid)
+
+        c = self.backend.conn.cursor()
+        c.execute("SELECT COUNT(*), SUM(size) FROM sessions;")
+        expected = c.fetchone()
+        c.execute("SELECT count, size FROM totals;")
+        self.assertEquals(c.fetchone(), expected)
+
+        # Databases without totals are counted once, on setup.
+        c.execute("DROP TABLE totals;")
+        self.backend.setup()
+        c.execute("SELECT count, size FROM totals;")
+        self.assertEquals(c.fetchone(), expected)
+
+        self.backend.delete_all()
+        c.execute("SELECT count, size FROM totals;")
+        self.assertEquals(c.fetchone(), (0, 0))
+
+    def test_max_sessions(self):
+        """ Test that the oldest sessions are evicted on add """
+        self.backend.close()
+        self.backend = SqliteBackend(self.filename, max_sessions="2")
+        sessions = [create_mock_session(SPECIFIC_DATE_DATETIME.replace(day=d))
+                    for d in (1, 3, 2)]
+        for session in sessions:
+            self.backend.add(session)
+
+        self.assertEquals(
+            sorted(summary.uuid for summary in self.backend.get_summaries()),
+            sorted([sessions[1].uuid, sessions[2].uuid]))
+
+    def test_max_age(self):
+        """ Test that expired sessions are evicted on add """
+        self.backend.close()
+        self.backend = SqliteBackend(self.filename, max_age="3600")
+        self.backend.add(create_mock_session())
+        session = create_mock_session(datetime.now())
+        self.backend.add(session)
+
+        self.assertEquals(
+            [summary.uuid for summary in self.backend.get_summaries()],
+            [session.uuid])
+
+    def test_max_size_reclaims_space(self):
+        """ Test that evicting sessions shrinks the database file """
+        self.backend.close()
+        self.backend = SqliteBackend(self.filename)
+        for i in range(20):
+            session = create_mock_session()
+            session.path = "x" * 100000
+            self.backend.add(session)
+        full_size = os.path.getsize(self.filename)
+
+        self.backend.retention = RetentionPolicy(max_size_mb=0.5)
+        self.assertEquals(self.backend.enforce_retention(), 15)
+        self.backend.conn.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+        self.assertTrue(os.path.getsize(self.filename) < full_size / 2)
+
+    def test_keep_slowest(self):
+        """ Test that only the slowest sessions per endpoint are stored """
+        self.backend.close()
+        self.backend = SqliteBackend(self.filename, keep_slowest="1")
+        sessions = [create_mock_session() for i in range(3)]
+        for session, duration in zip(sessions, (1.0, 0.5, 2.0)):
+            session.endpoint = "/users/{id}"
+            session.duration = duration
+
+        self.assertTrue(self.backend.add(sessions[0]))
+        self.assertFalse(self.backend.add(sessions[1]))
+        self.assertTrue(self.backend.add(sessions[2]))
+
+        summary, = self.backend.get_summaries()
+        self.assertEquals(summary.uuid, sessions[2].uuid)
+        self.assertEquals(summary.endpoint, "/users/{id}")
+
+    def test_keep_slowest_setup(self):
+        """ Test that the kept sessions are rebuilt on setup """
+        sessions = [create_mock_session() for i in range(3)]
+        for session, duration in zip(sessions, (1.0, 0.5, 2.0)):
+            session.duration = duration
+            self.backend.add(session)
+
+        self.backend.close()
+        self.backend = SqliteBackend(self.filename, keep_slowest="2")
+        self.backend.setup()
+        self.assertEquals(
+            sorted(summary.uuid for summary in self.backend.get_summaries()),
+            sorted([sessions[0].uuid, sessions[2].uuid]))
+
+    def test_reservoir_seen_saved(self):
+        """ Test that the sessions offered to the reservoir are remembered """
+        self.backend.close()
+        self.backend = SqliteBackend(self.filename, reservoir_size="1")
+        self.backend.setup()
+        for i in range(3):
+            self.backend.add(create_mock_session())
+        seen = self.backend.reservoir.seen_counts()
+        self.assertEquals(sum(seen.values()), 3)
+
+        self.backend.close()
+        self.backend = SqliteBackend(self.filename, reservoir_size="1")
+        self.backend.setup()
+        self.assertEquals(self.backend.reservoir.seen_counts(), seen)
+
+
+class TestBackendSqliteNormalized(TestBackend):
+
+    def setUp(self):
+        self.filename = get_temporary_filename()
+        self.backend = SqliteBackend(self.filename, normalized="true")
+        self.backend.setup()
+
+    def tearDown(self):
+        self.backend.close()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.filename + suffix):
+                os.remove(self.filename + suffix)
+
+    def create_session(self, endpoint="/x", scale=1):
+        session = create_mock_session()
+        session.endpoint = endpoint
+        session._callgraph = CallGraph.from_dicts(
+            {"a": (1, 0, 0.5 * scale, 2.0 * scale),
+             "b": (2, 1, 1.5 * scale, 1.5 * scale)},
+            {("a", "b"): (2, 1, 1.5 * scale, 1.5 * scale),
+             ("b", "c"): (1, 0, 0.0, 0.0)})
+        return session
+
+    def test_rows(self):
+        """ Test that callgraphs are stored as rows, not in the pickle """
+        session = self.create_session()
+        self.backend.add(session)
+
+        c = self.backend.conn.cursor()
+        c.execute("SELECT key FROM functions ORDER BY key;")
+        self.assertEquals(c.fetchall(), [(u"a",), (u"b",), (u"c",)])
+        c.execute("SELECT COUNT(*) FROM nodes;")
+        self.assertEquals(c.fetchone(), (3,))
+        c.execute("SELECT COUNT(*) FROM edges;")
+        self.assertEquals(c.fetchone(), (2,))
+
+        c.execute("SELECT session FROM sessions;")
+        self.assertEquals(c.fetchone()[0]._callgraph, None)
+        self.assertEquals(session._callgraph.keys, ["a", "b", "c"])
+
+    def test_get(self):
+        """ Test that get() rebuilds the callgraph from the rows """
+        session = self.create_session()
+        self.backend.add(session)
+
+        actual_session = self.backend.get(session.uuid)
+        self.assertEquals(sorted(actual_session._graph.edges(data=True)),
+                          sorted(session._graph.edges(data=True)))
+        self.assertEquals(sorted(actual_session._graph.nodes(data=True)),
+                          sorted(session._graph.nodes(data=True)))
+        self.assertEquals(
+            self.backend.get_all()[session.uuid]._callgraph.index,
+            actual_session._callgraph.index)
+
+    def test_delete_removes_rows(self):
+        """ Test that deleting a session deletes its rows """
+        session = self.create_session()
+        self.backend.add(session)
+        self.backend.add(self.create_session())
+        self.backend.delete(session.uuid)
+
+        c = self.backend.conn.cursor()
+        c.execute("SELECT COUNT(*) FROM nodes WHERE session = ?;",
+                  (session.uuid,))
+        self.assertEquals(c.fetchone(), (0,))
+        c.execute("SELECT COUNT(*) FROM edges;")
+        self.assertEquals(c.fetchone(), (2,))
+
+    def test_add_after_failed_add(self):
+        """ Test that a failed add doesn't leave its transaction open """
+        session = self.create_session()
+        self.backend.add(session)
+        self.assertRaises(sqlite3.IntegrityError, self.backend.add, session)
+
+        other_session = self.create_session()
+        self.backend.add(other_session)
+        self.assertNotEqual(self.backend.get(other_session.uuid), None)
+
+    def test_function_ids_cached_after_commit(self):
+        """ Test that ids of rolled back functions aren't cached """
+        insert_callgraph = self.backend._insert_callgraph
+
+        def failing_insert_callgraph(*args):
+            insert_callgraph(*args)
+            raise sqlite3.OperationalError("disk I/O error")
+
+        failed_session = self.create_session()
+        failed_session._callgraph = CallGraph.from_dicts(
+            {"rolled_back": (1, 0, 1.0, 1.0)}, {})
+        with patch.object(self.backend, "_insert_callgraph",
+                          failing_insert_callgraph):
+            self.assertRaises(sqlite3.OperationalError, self.backend.add,
+                              failed_session)
+        self.assertFalse("rolled_back" in self.backend._function_ids)
+
+        # The rolled back id is reused by the next function added.
+        session = self.create_session()
+        session._callgraph = CallGraph.from_dicts({"d": (1, 0, 1.0, 1.0)}, {})
+        self.backend.add(session)
+        self.assertEquals(self.backend.get(session.uuid)._callgraph.keys,
+                          ["d"])
+
+    def test_top_functions(self):
+        """ Test that function stats are totalled across sessions """
+        self.backend.add(self.create_session("/x", 1))
+        self.backend.add(self.create_session("/x", 2))
+        self.backend.add(self.create_session("/y", 10))
+
+        top = self.backend.top_functions(limit=2, endpoint="/x")
+        self.assertEquals([stats.key for stats in top], [u"b", u"a"])
+        self.assertEquals(top[0].inlinetime, 4.5)
+        self.assertEquals(top[0].callcount, 4)
+        self.assertEquals(top[0].sessions, 2)
+
+        top = self.backend.top_functions(order_by="totaltime")
+        self.assertEquals(top[0].key, u"a")
+        self.assertEquals(top[0].totaltime, 26.0)
+
+    def test_top_functions_time_range(self):
+        """ Test that only sessions within the time range are totalled """
+        self.backend.add(self.create_session())
+        top = self.backend.top_functions(
+            since=SPECIFIC_DATE_DATETIME.replace(day=2))
+        self.assertEquals(top, [])
+
+    def test_top_functions_invalid_order(self):
+        """ Test that only known columns can be ordered by """
+        self.assertRaises(ValueError, self.backend.top_functions,
+                          order_by="key; DROP TABLE sessions")
+
+
+class TestBackendSqliteDedup(TestBackend):
+
+    def setUp(self):
+        self.filename = get_temporary_filename()
+        self.backend = SqliteBackend(self.filename, dedup_structures="true")
+        self.backend.setup()
+
+    def tearDown(self):
+        self.backend.close()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.filename + suffix):
+                os.remove(self.filename + suffix)
+
+    def create_session(self, scale=1):
+        keys = ["/usr/lib/python2.7/site-packages/package/module.py:"
+                "%d(function_%d)" % (i * 10, i) for i in range(50)]
+        session = create_mock_session()
+        session._callgraph = CallGraph.from_dicts(
+            dict((key, (1, 0, 0.1 * scale, 0.2 * scale)) for key in keys),
+            dict(((keys[i], keys[i + 1]), (1, 0, 0.1 * scale, 0.2 * scale))
+                 for i in range(49)))
+        return session
+
+    def count_structures(self):
+        c = self.backend.conn.cursor()
+        c.execute("SELECT COUNT(*) FROM structures;")
+        return c.fetchone()[0]
+
+    def test_structures_are_shared(self):
+        """ Test that identical structures are only stored once """
+        sessions = [self.create_session(scale) for scale in (1, 2)]
+        for session in sessions:
+            self.backend.add(session)
+        self.assertEquals(self.count_structures(), 1)
+
+        c = self.backend.conn.cursor()
+        c.execute("SELECT size FROM sessions;")
+        size = c.fetchone()[0]
+        self.assertTrue(size * 2 < len(cPickle.dumps(sessions[0], -1)))
+
+    def test_get(self):
+        """ Test that sessions are loaded with their shared structure """
+        sessions = [self.create_session(scale) for scale in (1, 2)]
+        for session in sessions:
+            self.backend.add(session)
+
+        actual_sessions = [self.backend.get(session.uuid)
+                           for session in sessions]
+        for session, actual_session in zip(sessions, actual_sessions):
+            self.assertEquals(actual_session._callgraph, session._callgraph)
+        self.assertTrue(actual_sessions[0]._callgraph.structure is
+                        actual_sessions[1]._callgraph.structure)
+
+        all_sessions = self.backend.get_all()
+        self.assertEquals(all_sessions[sessions[1].uuid]._callgraph,
+                          sessions[1]._callgraph)
+
+    def test_delete_removes_unused_structures(self):
+        """ Test that structures are deleted with their last session """
+        sessions = [self.create_session(scale) for scale in (1, 2)]
+        for session in sessions:
+            self.backend.add(session)
+
+        self.backend.delete(sessions[0].uuid)
+        self.assertEquals(self.count_structures(), 1)
+        self.backend.delete(sessions[1].uuid)
+        self.assertEquals(self.count_structures(), 0)
+
+        # Adding the structure again stores it again
+        self.backend.add(sessions[0])
+        self.assertEquals(self.count_structures(), 1)
+        self.assertEquals(self.backend.get(sessions[0].uuid)._callgraph,
+                          sessions[0]._callgraph)
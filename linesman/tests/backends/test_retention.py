@@ -0,0 +1,128 @@
+import unittest
+from datetime import datetime, timedelta
+
+from nose.tools import assert_equals
+
+from linesman import SessionSummary
+from linesman.backends.retention import EndpointReservoir, RetentionPolicy
+
+
+NOW = datetime(2011, 1, 1, 12, 0, 0)
+
+
+def make_sessions(count, size=100):
+    """ Returns `count' sessions, one minute apart and oldest first. """
+    return [(str(i), NOW - timedelta(minutes=count - i), size)
+            for i in range(count)]
+
+
+class TestRetentionPolicy(unittest.TestCase):
+
+    def test_disabled(self):
+        """ Test that nothing is evicted without limits """
+        policy = RetentionPolicy()
+        self.assertFalse(policy.enabled)
+        assert_equals(policy.select(make_sessions(5), 5, 500, NOW), [])
+
+    def test_max_sessions(self):
+        """ Test that the oldest sessions beyond the limit are evicted """
+        policy = RetentionPolicy(max_sessions="3")
+        self.assertTrue(policy.enabled)
+        assert_equals(policy.select(make_sessions(5), 5, 500, NOW),
+                      ["0", "1"])
+
+    def test_max_size(self):
+        """ Test that the oldest sessions are evicted to fit the size """
+        policy = RetentionPolicy(max_size_mb=250 / 1024.0 / 1024.0)
+        assert_equals(policy.select(make_sessions(5), 5, 500, NOW),
+                      ["0", "1", "2"])
+
+    def test_max_age(self):
+        """ Test that sessions older than max_age are evicted """
+        policy = RetentionPolicy(max_age="150")
+        assert_equals(policy.select(make_sessions(5), 5, 500, NOW),
+                      ["0", "1", "2"])
+
+    def test_max_age_without_timestamp(self):
+        """ Test that sessions without a timestamp don't stop eviction """
+        sessions = [("none", None, 100)] + make_sessions(5)
+        policy = RetentionPolicy(max_age="150")
+        assert_equals(policy.select(sessions, 6, 600, NOW),
+                      ["none", "0", "1", "2"])
+
+    def test_stops_early(self):
+        """ Test that sessions are only read until the limits are met """
+        sessions = iter(make_sessions(5))
+        policy = RetentionPolicy(max_sessions=4)
+        assert_equals(policy.select(sessions, 5, 500, NOW), ["0"])
+        assert_equals(next(sessions)[0], "2")
+
+
+class TestEndpointReservoir(unittest.TestCase):
+
+    def test_disabled(self):
+        """ Test that the reservoir is off by default """
+        self.assertFalse(EndpointReservoir().enabled)
+        self.assertTrue(EndpointReservoir(keep_slowest="1").enabled)
+
+    def test_keep_slowest(self):
+        """ Test that only the slowest sessions of an endpoint are kept """
+        reservoir = EndpointReservoir(keep_slowest=2)
+        assert_equals(reservoir.offer("a", "/x", 1.0), (True, []))
+        assert_equals(reservoir.offer("b", "/x", 3.0), (True, []))
+        assert_equals(reservoir.offer("c", "/x", 0.5), (False, []))
+        assert_equals(reservoir.offer("d", "/x", 2.0), (True, ["a"]))
+
+    def test_endpoints_are_separate(self):
+        """ Test that every endpoint keeps its own sessions """
+        reservoir = EndpointReservoir(keep_slowest=1)
+        assert_equals(reservoir.offer("a", "/x", 1.0), (True, []))
+        assert_equals(reservoir.offer("b", "/y", 0.5), (True, []))
+        assert_equals(reservoir.offer("c", "/y", 0.1), (False, []))
+
+    def test_reservoir(self):
+        """ Test that sessions are sampled into the reservoir """
+        picks = iter([5, 0])
+        reservoir = EndpointReservoir(keep_slowest=1, reservoir_size=2,
+                                      randrange=lambda n: next(picks))
+        assert_equals(reservoir.offer("a", "/x", 9.0), (True, []))
+        assert_equals(reservoir.offer("b", "/x", 1.0), (True, []))
+        assert_equals(reservoir.offer("c", "/x", 1.0), (True, []))
+        # The third session offered to the reservoir is only kept if the
+        # random pick falls within it
+        assert_equals(reservoir.offer("d", "/x", 1.0), (False, []))
+        assert_equals(reservoir.offer("e", "/x", 1.0), (True, ["b"]))
+
+    def test_demoted_session_goes_to_reservoir(self):
+        """ Test that sessions pushed out of the slowest go to the reservoir
+        """
+        reservoir = EndpointReservoir(keep_slowest=1, reservoir_size=1)
+        reservoir.offer("a", "/x", 1.0)
+        assert_equals(reservoir.offer("b", "/x", 2.0), (True, []))
+        assert_equals(reservoir._endpoints["/x"].reservoir, ["a"])
+
+    def test_discard(self):
+        """ Test that deleted sessions make room for new ones """
+        reservoir = EndpointReservoir(keep_slowest=1)
+        reservoir.offer("a", "/x", 1.0)
+        reservoir.discard(["a", "unknown"])
+        assert_equals(reservoir.offer("b", "/x", 0.1), (True, []))
+
+    def test_load(self):
+        """ Test that loading summaries returns those no longer kept """
+        summaries = [SessionSummary(str(i), "/x", i, NOW, endpoint="/x")
+                     for i in range(4)]
+        reservoir = EndpointReservoir(keep_slowest=2)
+        assert_equals(sorted(reservoir.load(summaries)), ["0", "1"])
+
+    def test_load_seen(self):
+        """ Test that saved counts of sessions offered are restored """
+        summaries = [SessionSummary(str(i), "/x", 1.0, NOW, endpoint="/x")
+                     for i in range(2)]
+        reservoir = EndpointReservoir(reservoir_size=2)
+        reservoir.load(summaries, {"/x": 10, "/y": 3})
+        assert_equals(reservoir.seen_counts(), {"/x": 10, "/y": 3})
+
+        # The stored sessions are still counted if nothing was saved.
+        reservoir.load(summaries)
+        assert_equals(reservoir.seen_counts(), {"/x": 2})
@@ -0,0 +1,65 @@
+import cPickle
+import unittest
+
+from nose.tools import assert_equals, raises
+
+from linesman.backends import serialization
+
+
+class TestSerialization(unittest.TestCase):
+
+    def setUp(self):
+        self.obj = {"package.module.function": range(100)}
+
+    def test_uncompressed(self):
+        """ Test that data without a codec is a plain pickle """
+        data = serialization.dumps(self.obj)
+        assert_equals(cPickle.loads(data), self.obj)
+        assert_equals(serialization.loads(data), self.obj)
+
+    def test_codecs(self):
+        """ Test that every codec round trips and shrinks repetitive data """
+        plain = serialization.dumps(self.obj)
+        for name in serialization.CODECS:
+            codec = serialization.get_codec(name)
+            data = serialization.dumps(self.obj, codec)
+            self.assertTrue(len(data) < len(plain))
+            assert_equals(serialization.loads(data), self.obj)
+
+    def test_compression_level(self):
+        """ Test that the compression level is passed to the codec """
+        codec = serialization.get_codec("zlib")
+        fast = serialization.dumps(self.obj, codec, "0")
+        best = serialization.dumps(self.obj, codec, 9)
+        self.assertTrue(len(best) < len(fast))
+        assert_equals(serialization.loads(fast), self.obj)
+
+    def test_get_codec_none(self):
+        """ Test that `none' means no compression """
+        assert_equals(serialization.get_codec("none"), None)
+        assert_equals(serialization.get_codec(None), None)
+
+    @raises(ValueError)
+    def test_get_codec_unknown(self):
+        """ Test that unknown codecs are rejected """
+        serialization.get_codec("zip")
+
+    @raises(ValueError)
+    def test_loads_unknown_codec(self):
+        """ Test that data tagged with an unknown codec can't be loaded """
+        serialization.loads(serialization.CODEC_MARKER + "?" + "data")
+
+    def test_persistent_objects(self):
+        """ Test that objects can be stored outside of the pickle """
+        shared = {}
+
+        def persistent_id(obj):
+            if obj == "shared":
+                shared["id"] = obj
+                return "id"
+
+        data = serialization.dumps(["shared", "other"], None, None,
+                                   persistent_id)
+        self.assertTrue("shared" not in data)
+        assert_equals(serialization.loads(data, shared.__getitem__),
+                      ["shared", "other"])
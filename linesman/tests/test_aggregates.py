@@ -0,0 +1,184 @@
+import time
+import unittest
+import uuid
+from datetime import timedelta
+
+from mock import Mock, patch
+
+import linesman.windows
+from linesman import ProfilingSession
+from linesman.aggregates import (AggregateProfile, AggregateStore,
+                                 aggregate_id, is_aggregate_id)
+from linesman.backends.base import Backend
+from linesman.callgraph import CallGraph
+from linesman.tests import SPECIFIC_DATE_DATETIME, SPECIFIC_DATE_EPOCH
+
+
+def create_session(duration, endpoint="/search",
+                   timestamp=SPECIFIC_DATE_DATETIME):
+    """ Creates a session calling `b' from `a', taking ``duration``. """
+    session = ProfilingSession.__new__(ProfilingSession)
+    session._uuid = uuid.uuid1()
+    session._callgraph = CallGraph.from_dicts(
+        {"a": (1, 0, 0.1, duration), "b": (2, 0, duration - 0.1,
+                                           duration - 0.1)},
+        {("a", "b"): (2, 0, duration - 0.1, duration - 0.1)})
+    session.duration = duration
+    session.endpoint = endpoint
+    session.path = endpoint
+    session.timestamp = timestamp
+    return session
+
+
+class TestAggregateProfile(unittest.TestCase):
+
+    def test_add(self):
+        """ Test that the stats of every node and edge are summed """
+        aggregate = AggregateProfile("/search", SPECIFIC_DATE_EPOCH, 3600)
+        aggregate.add(create_session(1.0))
+        aggregate.add(create_session(3.0))
+
+        self.assertEqual(aggregate.session_count, 2)
+        self.assertEqual(aggregate.duration, 4.0)
+        self.assertEqual(aggregate.max_duration, 3.0)
+        self.assertEqual(aggregate.mean_duration, 2.0)
+        self.assertEqual(aggregate.nodes["b"], [4, 0, 3.8, 3.8])
+        self.assertEqual(aggregate.edges[("a", "b")], [4, 0, 3.8, 3.8])
+
+        graph = aggregate._graph
+        self.assertEqual(graph.node["a"]["totaltime"], 4.0)
+        self.assertEqual(graph.edge["a"]["b"]["callcount"], 4)
+
+    def test_uuid(self):
+        """ Test that the uuid of an aggregate changes as it is updated """
+        aggregate = AggregateProfile("/search", SPECIFIC_DATE_EPOCH, 3600)
+        uuid = aggregate.uuid
+        aggregate.add(create_session(1.0))
+
+        self.assertNotEqual(aggregate.uuid, uuid)
+        self.assertTrue(aggregate.uuid.startswith(aggregate.id))
+        self.assertTrue(is_aggregate_id(aggregate.uuid))
+        self.assertEqual(aggregate.timestamp, SPECIFIC_DATE_DATETIME)
+
+
+class TestAggregateStore(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = Backend()
+        self.store = AggregateStore(self.backend, bucket_seconds=3600,
+                                    max_buckets=2, flush_interval=3600)
+
+    def test_buckets(self):
+        """ Test that sessions are summed per endpoint and window """
+        hour = timedelta(hours=1)
+        self.store.add(create_session(1.0))
+        self.store.add(create_session(2.0, timestamp=SPECIFIC_DATE_DATETIME +
+                                      timedelta(minutes=30)))
+        self.store.add(create_session(4.0, timestamp=SPECIFIC_DATE_DATETIME +
+                                      hour))
+        self.store.add(create_session(8.0, endpoint="/other"))
+
+        aggregates = self.store.list()
+        self.assertEqual(
+            [(aggregate.endpoint, aggregate.timestamp, aggregate.duration)
+             for aggregate in aggregates],
+            [("/other", SPECIFIC_DATE_DATETIME, 8.0),
+             ("/search", SPECIFIC_DATE_DATETIME + hour, 4.0),
+             ("/search", SPECIFIC_DATE_DATETIME, 3.0)])
+
+    def test_max_buckets(self):
+        """ Test that the oldest windows of an endpoint are removed """
+        for hours in range(3):
+            self.store.add(create_session(
+                1.0, timestamp=SPECIFIC_DATE_DATETIME +
+                timedelta(hours=hours)))
+        self.store.flush()
+        # A session older than every window kept is ignored.
+        self.store.add(create_session(1.0))
+
+        self.assertEqual(
+            [aggregate.timestamp for aggregate in self.store.list()],
+            [SPECIFIC_DATE_DATETIME + timedelta(hours=2),
+             SPECIFIC_DATE_DATETIME + timedelta(hours=1)])
+        self.assertEqual(len(list(self.backend.iter_states())), 2)
+
+    def test_flush_and_load(self):
+        """ Test that aggregates are persisted using the backend's state """
+        self.backend.save_state = Mock(wraps=self.backend.save_state)
+        self.store.add(create_session(1.0))
+        self.store.add(create_session(2.0))
+        self.assertEqual(self.backend.save_state.call_count, 0)
+
+        self.store.flush()
+        self.store.flush()
+        self.assertEqual(self.backend.save_state.call_count, 1)
+
+        store = AggregateStore(self.backend)
+        store.load()
+        aggregate = store.get(aggregate_id("/search", SPECIFIC_DATE_EPOCH))
+        self.assertEqual(aggregate.session_count, 2)
+
+    def test_flush_interval(self):
+        """ Test that aggregates are flushed as sessions are added """
+        store = AggregateStore(self.backend, flush_interval=0)
+        store.add(create_session(1.0))
+        self.assertEqual(len(list(self.backend.iter_states())), 1)
+
+    def test_background_flush(self):
+        """ Test that aggregates are flushed by a background thread """
+        with patch.object(linesman.windows._flusher, "register") as register:
+            store = AggregateStore(self.backend)
+            store._last_flush = 0
+            store.flush = Mock()
+            store.add(create_session(1.0))
+            self.assertFalse(store.flush.called)
+            register.assert_called_once_with(store)
+
+        store = AggregateStore(self.backend, flush_interval=0.01)
+        self.addCleanup(store.close)
+        store.add(create_session(1.0))
+        for i in range(100):
+            if list(self.backend.iter_states()):
+                break
+            time.sleep(0.01)
+        self.assertEqual(len(list(self.backend.iter_states())), 1)
+
+        # Closing the store writes what's left, and stops the flushes.
+        store.add(create_session(1.0))
+        store.close()
+        self.assertEqual(list(self.backend.iter_states())[0][1]
+                         .session_count, 2)
+        self.assertFalse(store in linesman.windows._flusher._stores)
+
+    def test_get(self):
+        """ Test that aggregates are found by id or uuid, as snapshots """
+        self.store.add(create_session(1.0))
+        aggregate = self.store.list()[0]
+
+        copy = self.store.get(aggregate.uuid)
+        self.assertEqual(copy.uuid, aggregate.uuid)
+        self.store.add(create_session(1.0))
+        self.assertEqual(copy.session_count, 1)
+        self.assertEqual(self.store.get(aggregate.id).session_count, 2)
+        self.assertEqual(self.store.get("agg-notanid"), None)
+
+        # Older revisions aren't found by their uuid.
+        self.assertEqual(self.store.get(aggregate.uuid), None)
+
+    def test_copy_on_write(self):
+        """ Test that aggregates are only copied when changed once shared """
+        self.store.add(create_session(1.0))
+        aggregate = self.store.get(self.store.list()[0].id)
+        self.assertTrue(self.store.get(aggregate.id) is aggregate)
+
+        self.store.add(create_session(2.0))
+        latest = self.store.get(aggregate.id)
+        self.assertEqual(aggregate.nodes["a"][0], 1)
+        self.assertEqual(latest.nodes["a"][0], 2)
+
+        # Saved aggregates aren't changed either.
+        self.store.flush()
+        self.store.add(create_session(2.0))
+        saved = dict(self.backend.iter_states()).values()[0]
+        self.assertEqual(saved.session_count, 2)
+        self.assertEqual(self.store.get(aggregate.id).session_count, 3)
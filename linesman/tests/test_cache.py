@@ -0,0 +1,75 @@
+import unittest
+
+from nose.tools import assert_equals
+
+from linesman.cache import LRUCache
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_get_set(self):
+        """ Test that cached values can be retrieved """
+        cache = LRUCache(10)
+        cache.set("a", 1)
+        assert_equals(cache.get("a"), 1)
+        assert_equals(cache.get("b"), None)
+        assert_equals(cache.get("b", 2), 2)
+
+    def test_evicts_least_recently_used(self):
+        """ Test that the least recently used entries are evicted first """
+        cache = LRUCache(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+
+        self.assertTrue("a" in cache)
+        self.assertFalse("b" in cache)
+        self.assertTrue("c" in cache)
+
+    def test_size_based_eviction(self):
+        """ Test that eviction is based on the size of the values """
+        cache = LRUCache(10, sizeof=len)
+        cache.set("a", "x" * 4)
+        cache.set("b", "x" * 4)
+        cache.set("c", "x" * 4)
+
+        assert_equals(len(cache), 2)
+        assert_equals(cache.size, 8)
+        self.assertFalse("a" in cache)
+
+    def test_oversized_values_not_cached(self):
+        """ Test that values larger than the cache are never stored """
+        cache = LRUCache(10, sizeof=len)
+        cache.set("a", "x" * 4)
+        cache.set("b", "x" * 11)
+
+        self.assertTrue("a" in cache)
+        self.assertFalse("b" in cache)
+
+    def test_replace(self):
+        """ Test that replacing a value updates the total size """
+        cache = LRUCache(10, sizeof=len)
+        cache.set("a", "x" * 4)
+        cache.set("a", "x" * 2)
+        assert_equals(cache.size, 2)
+
+    def test_discard(self):
+        """ Test that entries can be removed individually or by predicate """
+        cache = LRUCache(10)
+        for key in [("session", "1"), ("view", "1", 0.05), ("session", "2")]:
+            cache.set(key, key)
+
+        cache.discard(("session", "2"))
+        assert_equals(len(cache), 2)
+        cache.discard_where(lambda key: key[1] == "1")
+        assert_equals(len(cache), 0)
+        assert_equals(cache.size, 0)
+
+    def test_clear(self):
+        """ Test that clear empties the cache """
+        cache = LRUCache(10)
+        cache.set("a", 1)
+        cache.clear()
+        assert_equals(len(cache), 0)
+        assert_equals(cache.size, 0)
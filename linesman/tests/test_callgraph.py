@@ -0,0 +1,152 @@
+import cPickle
+import unittest
+from collections import OrderedDict
+from cProfile import Profile
+
+from nose.tools import assert_equals, assert_true
+
+import linesman
+from linesman.callgraph import CallGraph
+
+
+def generate_profiler_entry():
+    def func():
+        a = 1 + 2
+        return a
+
+    prof = Profile()
+    prof.runctx("func()", locals(), globals())
+    return prof.getstats()
+
+
+class TestCallGraph(unittest.TestCase):
+
+    def setUp(self):
+        self.nodes = {
+            'a': (1, 0, 0.5, 2.0),
+            'b': (2, 1, 1.5, 1.5),
+        }
+        self.edges = {
+            ('a', 'b'): (2, 1, 1.5, 1.5),
+            ('b', 'c'): (1, 0, 0.0, 0.0),
+        }
+        self.graph = CallGraph.from_dicts(self.nodes, self.edges)
+
+    def test_from_dicts(self):
+        """ Test that nodes only known as callees have no stats """
+        assert_equals(len(self.graph), 3)
+        self.assertTrue('c' in self.graph)
+        assert_equals(self.graph.node_data(self.graph.index['c']), {})
+        assert_equals(self.graph.node_data(self.graph.index['a']), {
+            'callcount': 1, 'reccallcount': 0,
+            'inlinetime': 0.5, 'totaltime': 2.0})
+
+    def test_to_networkx(self):
+        """ Test that the networkx graph has the expected attributes """
+        g = self.graph.to_networkx()
+        assert_equals(sorted(g.nodes()), ['a', 'b', 'c'])
+        assert_equals(sorted(g.edges()), [('a', 'b'), ('b', 'c')])
+        assert_equals(g.node['c'], {})
+        assert_equals(g.node['b']['reccallcount'], 1)
+        assert_equals(g['a']['b'], {
+            'callcount': 2, 'reccallcount': 1, 'inlinetime': 1.5,
+            'totaltime': 1.5, 'weight': 1.5, 'label': 1.5})
+
+    def test_from_networkx(self):
+        """ Test that converting to networkx and back is lossless """
+        graph = CallGraph.from_networkx(self.graph.to_networkx())
+        assert_equals(graph.to_networkx().edges(data=True),
+                      self.graph.to_networkx().edges(data=True))
+        assert_equals(graph.to_networkx().nodes(data=True),
+                      self.graph.to_networkx().nodes(data=True))
+
+    def test_pickle(self):
+        """ Test that graphs survive being pickled """
+        graph = cPickle.loads(cPickle.dumps(self.graph, -1))
+        assert_equals(graph, self.graph)
+        assert_equals(graph.index, self.graph.index)
+
+    def test_pickle_legacy_state(self):
+        """ Test that graphs pickled before the structure was split load """
+        structure_state = self.graph.structure.__getstate__()
+        state = self.graph.__getstate__()
+        legacy_state = (structure_state[0], structure_state[1], state[1],
+                        structure_state[2], structure_state[3], state[2])
+
+        graph = CallGraph.__new__(CallGraph)
+        graph.__setstate__(legacy_state)
+        assert_equals(graph, self.graph)
+
+    def test_structure_digest(self):
+        """ Test that graphs with the same edges have the same digest """
+        other = CallGraph.from_dicts(
+            dict((key, (5, 5, 5.0, 5.0)) for key in self.nodes),
+            dict((key, (5, 5, 5.0, 5.0)) for key in self.edges))
+        assert_equals(other.structure.digest, self.graph.structure.digest)
+        self.assertNotEqual(other, self.graph)
+
+        del self.edges[('b', 'c')]
+        self.edges[('b', 'a')] = (1, 0, 0.0, 0.0)
+        different = CallGraph.from_dicts(self.nodes, self.edges)
+        self.assertNotEqual(different.structure.digest,
+                            self.graph.structure.digest)
+
+    def test_structure_digest_ignores_order(self):
+        """ Test that the digest doesn't depend on the order of the dicts """
+        keys = ["module%d.function%d" % (i % 7, i) for i in range(200)]
+        edges = [((caller, callee), (1, 0, 0.1, 0.1))
+                 for caller, callee in zip(keys, keys[1:])]
+        graph = CallGraph.from_dicts(
+            OrderedDict((key, (1, 0, 0.1, 0.1)) for key in keys),
+            OrderedDict(edges))
+        reversed_graph = CallGraph.from_dicts(
+            OrderedDict((key, (1, 0, 0.1, 0.1)) for key in reversed(keys)),
+            OrderedDict(reversed(edges)))
+        assert_equals(reversed_graph.keys, graph.keys)
+        assert_equals(reversed_graph.structure.digest, graph.structure.digest)
+
+    def test_pickle_empty(self):
+        """ Test that an empty graph survives being pickled """
+        empty = CallGraph.from_dicts({}, {})
+        graph = cPickle.loads(cPickle.dumps(empty, -1))
+        assert_equals(len(graph), 0)
+        assert_equals(graph, empty)
+
+    def test_smaller_than_networkx(self):
+        """ Test that graphs pickle smaller than their networkx graphs """
+        keys = ["package.module.function_%d" % i for i in range(100)]
+        nodes = dict((key, (1, 0, 0.1, 0.2)) for key in keys)
+        edges = dict(((keys[i], keys[i + 1]), (1, 0, 0.1, 0.2))
+                     for i in range(99))
+        graph = CallGraph.from_dicts(nodes, edges)
+
+        compact = len(cPickle.dumps(graph, -1))
+        full = len(cPickle.dumps(graph.to_networkx(), -1))
+        self.assertTrue(compact < full)
+
+    def test_session_graph(self):
+        """ Test that the networkx graph is kept, but not pickled """
+        session = linesman.ProfilingSession(generate_profiler_entry())
+        graph = session._graph
+        assert_true(session._graph is graph)
+        assert_true('_graph_cache' not in cPickle.loads(
+            cPickle.dumps(session, -1)).__dict__)
+
+        # Assigning a graph replaces the callgraph.
+        graph = graph.copy()
+        graph.remove_node(graph.nodes()[0])
+        session._graph = graph
+        assert_true(session._graph is graph)
+        assert_equals(len(session._callgraph), len(graph))
+
+    def test_unpickle_networkx_session(self):
+        """ Test that sessions storing a networkx graph are converted """
+        session = linesman.ProfilingSession(generate_profiler_entry())
+        state = session.__dict__.copy()
+        state['_graph'] = state.pop('_callgraph').to_networkx()
+
+        old_session = linesman.ProfilingSession.__new__(
+            linesman.ProfilingSession)
+        old_session.__setstate__(state)
+        assert_equals(sorted(old_session._graph.edges(data=True)),
+                      sorted(session._graph.edges(data=True)))
@@ -0,0 +1,75 @@
+import unittest
+
+from nose.tools import raises
+
+from linesman.callgraph import CallGraph
+from linesman.diff import ProfileDiff
+from linesman.middleware import prepare_graph
+
+
+class Profile(object):
+    """ The parts of a session used by a diff. """
+
+    def __init__(self, nodes, edges):
+        self._callgraph = CallGraph.from_dicts(nodes, edges)
+        self.duration = max(values[3] for values in nodes.values())
+
+
+BEFORE = Profile(
+    {"main": (1, 0, 0.1, 1.0), "query": (2, 0, 0.6, 0.6),
+     "render": (1, 0, 0.3, 0.3)},
+    {("main", "query"): (2, 0, 0.6, 0.6), ("main", "render"): (1, 0, 0.3, 0.3)})
+AFTER = Profile(
+    {"main": (1, 0, 0.1, 2.0), "query": (5, 0, 1.7, 1.7),
+     "cache": (1, 0, 0.2, 0.2)},
+    {("main", "query"): (5, 0, 1.7, 1.7), ("main", "cache"): (1, 0, 0.2, 0.2)})
+
+
+class TestProfileDiff(unittest.TestCase):
+
+    def setUp(self):
+        self.diff = ProfileDiff(BEFORE, AFTER)
+
+    def test_alignment(self):
+        """ Test that functions are matched by key """
+        self.assertEqual(sorted(self.diff.functions),
+                         ["cache", "main", "query", "render"])
+        self.assertEqual(self.diff.functions["render"].after, None)
+        self.assertEqual(self.diff.functions["cache"].before, None)
+        self.assertAlmostEqual(
+            self.diff.functions["query"].delta("totaltime"), 1.1)
+        self.assertEqual(self.diff.functions["query"].delta("callcount"), 3)
+        self.assertAlmostEqual(
+            self.diff.functions["render"].delta("inlinetime"), -0.3)
+        self.assertEqual(self.diff.duration_delta, 1.0)
+
+    def test_top_functions(self):
+        """ Test that functions are ranked by the size of their change """
+        self.assertEqual(
+            [delta.key for delta in self.diff.top_functions(limit=3)],
+            ["query", "main", "render"])
+        self.assertEqual(
+            [delta.key for delta in self.diff.top_functions("callcount",
+                                                            limit=1)],
+            ["query"])
+        self.assertEqual(
+            [delta.key for delta in self.diff.top_calls(limit=None)],
+            [("main", "query"), ("main", "render"), ("main", "cache")])
+
+    @raises(ValueError)
+    def test_top_functions_invalid_order(self):
+        """ Test that only known fields can be ranked """
+        self.diff.top_functions("reccallcount")
+
+    def test_to_networkx(self):
+        """ Test that the graph holds both profiles and can be pruned """
+        graph, root_nodes, removed_edges = prepare_graph(
+            self.diff.to_networkx(), int(0.25 * 1e9), True)
+
+        self.assertEqual(root_nodes, ["main"])
+        self.assertEqual(sorted(graph.neighbors("main")),
+                         ["query", "render"])
+        render = graph.node["render"]
+        self.assertEqual(render["before_totaltime"], 0.3)
+        self.assertEqual(render["after_totaltime"], 0)
+        self.assertEqual(render["delta_totaltime"], -0.3)
@@ -1,14 +1,21 @@
+import time
 import unittest
 from cProfile import Profile
 
+import networkx as nx
+
 from mock import Mock, patch
 from nose.tools import assert_equals
 
 import linesman
+import linesman.middleware
 
 
 class TestGraphUtils(unittest.TestCase):
 
+    def setUp(self):
+        linesman.clear_key_cache()
+
     @patch("networkx.to_agraph")
     def test_draw_graph(self, mock_to_agraph):
         """ Test that the graph gets converted to an agraph """
@@ -54,6 +61,37 @@ class TestGraphUtils(unittest.TestCase):
         key = linesman._generate_key(stat)
         assert_equals(key, expected_key)
 
+    @patch("linesman.getmodule")
+    def test_generate_key_cached(self, mock_getmodule):
+        """ Test that keys are only resolved once per code object """
+        def test_func():
+            pass
+
+        mock_getmodule.return_value = None
+        stat = Mock()
+        stat.code = test_func.__code__
+
+        expected_key = "%s.%s" % (stat.code.co_filename, stat.code.co_name)
+        assert_equals(linesman._generate_key(stat), expected_key)
+        assert_equals(linesman._generate_key(stat), expected_key)
+        assert_equals(mock_getmodule.call_count, 1)
+
+    @patch("linesman.getmodule")
+    def test_generate_key_cache_invalidation(self, mock_getmodule):
+        """ Test that the key cache is cleared when modules are loaded """
+        def test_func():
+            pass
+
+        mock_getmodule.return_value = None
+        stat = Mock()
+        stat.code = test_func.__code__
+        linesman._generate_key(stat)
+
+        with patch.dict("sys.modules", {"linesman_fake_module": Mock()}):
+            linesman._generate_key(stat)
+
+        assert_equals(mock_getmodule.call_count, 2)
+
     def test_create_graph(self):
         """ Test that a graph gets generated for a test function """
         def test_func():
@@ -75,3 +113,57 @@ class TestGraphUtils(unittest.TestCase):
         assert_equals(
             [('<string>.<module>', 'linesman.tests.test_graphs.test_func')],
             graph.edges())
+
+
+class TestCycleBreaking(unittest.TestCase):
+
+    def test_remove_back_edges(self):
+        """ Test that a simple cycle is broken below the root """
+        graph = nx.DiGraph()
+        graph.add_edges_from([('root', 'a'), ('a', 'b'), ('b', 'a'),
+                              ('b', 'b')])
+        removed = linesman.middleware.remove_back_edges(graph)
+
+        assert_equals(sorted(removed), [('b', 'a'), ('b', 'b')])
+        assert_equals(sorted(graph.edges()), [('a', 'b'), ('root', 'a')])
+
+    def test_remove_back_edges_without_roots(self):
+        """ Test that graphs where every node is in a cycle are handled """
+        graph = nx.DiGraph()
+        graph.add_cycle(range(10))
+        removed = linesman.middleware.remove_back_edges(graph)
+
+        assert_equals(len(removed), 1)
+        self.assertTrue(nx.is_directed_acyclic_graph(graph))
+
+    def test_remove_back_edges_many_cycles(self):
+        """ Test that graphs with a huge number of cycles are fast """
+        # A complete graph of 60 nodes has more elementary cycles than could
+        # ever be enumerated, and the chain of 2-cycles adds thousands more.
+        graph = nx.complete_graph(60, create_using=nx.DiGraph())
+        for i in range(5000):
+            graph.add_edge(("chain", i), ("chain", i + 1))
+            graph.add_edge(("chain", i + 1), ("chain", i))
+        graph.add_edge(0, ("chain", 0))
+
+        start = time.time()
+        removed = linesman.middleware.remove_back_edges(graph)
+        elapsed = time.time() - start
+
+        self.assertTrue(nx.is_directed_acyclic_graph(graph))
+        assert_equals(len(removed), 60 * 59 / 2 + 5000)
+        self.assertTrue(elapsed < 5, "Took %fs to break cycles." % elapsed)
+
+    def test_prepare_graph_break_cycles(self):
+        """ Test that prepare_graph reports the edges it removed """
+        graph = nx.DiGraph()
+        for node in ('a', 'b', 'c'):
+            graph.add_node(node, totaltime=1.0)
+        graph.add_edges_from([('a', 'b'), ('b', 'c'), ('c', 'b')])
+
+        new_graph, root_nodes, removed = linesman.middleware.prepare_graph(
+            graph, 0, True)
+
+        assert_equals(root_nodes, ['a'])
+        assert_equals(removed, [('c', 'b')])
+        self.assertTrue(graph.has_edge('c', 'b'))
@@ -0,0 +1,135 @@
+import random
+import unittest
+
+from nose.tools import raises
+
+from linesman.backends.base import Backend
+from linesman.histograms import HistogramStore, LatencyHistogram, MAX_VALUE
+from linesman.tests import SPECIFIC_DATE_DATETIME, SPECIFIC_DATE_EPOCH
+from linesman.windows import OTHER_ENDPOINT
+
+
+class TestLatencyHistogram(unittest.TestCase):
+
+    def test_percentiles(self):
+        """ Test that percentiles are within the relative accuracy """
+        rand = random.Random(42)
+        values = sorted(rand.lognormvariate(-3, 1) for i in range(10000))
+        histogram = LatencyHistogram(relative_accuracy=0.01)
+        for value in values:
+            histogram.add(value)
+
+        percentiles = (0, 50, 90, 99, 99.9, 100)
+        for percentile, estimate in zip(percentiles,
+                                        histogram.percentiles(percentiles)):
+            actual = values[int(percentile / 100.0 * (len(values) - 1))]
+            self.assertTrue(abs(estimate - actual) <= actual * 0.01,
+                            (percentile, estimate, actual))
+        self.assertEqual(histogram.count, 10000)
+        self.assertAlmostEqual(histogram.mean, sum(values) / len(values))
+
+    def test_empty(self):
+        """ Test that empty histograms have no percentiles """
+        histogram = LatencyHistogram()
+        self.assertEqual(histogram.percentiles((50, 99)), [None, None])
+        self.assertEqual(histogram.mean, None)
+
+    def test_zero_and_bounds(self):
+        """ Test that tiny and huge durations don't add buckets """
+        histogram = LatencyHistogram()
+        histogram.add(0)
+        histogram.add(0)
+        histogram.add(MAX_VALUE * 10)
+        histogram.add(MAX_VALUE * 100)
+
+        self.assertEqual(histogram.percentile(0), 0.0)
+        self.assertEqual(len(histogram.buckets), 1)
+        self.assertTrue(abs(histogram.percentile(100) - MAX_VALUE) <=
+                        MAX_VALUE * 0.01)
+        self.assertEqual(histogram.max, MAX_VALUE * 100)
+
+    def test_merge(self):
+        """ Test that merged histograms count the durations of both """
+        first, second, both = (LatencyHistogram() for i in range(3))
+        for i in range(1, 100):
+            (first if i % 2 else second).add(i / 100.0)
+            both.add(i / 100.0)
+        first.merge(second)
+
+        self.assertEqual(first.buckets, both.buckets)
+        self.assertEqual(first.count, both.count)
+        self.assertEqual((first.min, first.max), (both.min, both.max))
+        self.assertEqual(first.percentiles(), both.percentiles())
+
+    @raises(ValueError)
+    def test_merge_different_accuracy(self):
+        """ Test that histograms of different accuracies can't be merged """
+        LatencyHistogram(relative_accuracy=0.01).merge(
+            LatencyHistogram(relative_accuracy=0.05))
+
+    @raises(ValueError)
+    def test_invalid_accuracy(self):
+        """ Test that the relative accuracy must be a fraction """
+        LatencyHistogram(relative_accuracy=1)
+
+
+class TestHistogramStore(unittest.TestCase):
+
+    def test_merged(self):
+        """ Test that windows are merged per endpoint """
+        backend = Backend()
+        store = HistogramStore(backend, bucket_seconds=60)
+        store.add("/search", 0.1, SPECIFIC_DATE_EPOCH)
+        store.add("/search", 0.3, SPECIFIC_DATE_EPOCH + 60)
+        store.add("/users", 0.2, SPECIFIC_DATE_EPOCH + 60)
+
+        histograms = store.merged()
+        self.assertEqual(sorted(histograms), ["/search", "/users"])
+        self.assertEqual(histograms["/search"].count, 2)
+        self.assertEqual(histograms["/search"].max, 0.3)
+
+        histograms = store.merged(since=SPECIFIC_DATE_EPOCH + 60)
+        self.assertEqual(histograms["/search"].count, 1)
+        self.assertEqual(
+            [histogram.timestamp for histogram in store.list("/search")],
+            [SPECIFIC_DATE_DATETIME.replace(minute=1),
+             SPECIFIC_DATE_DATETIME])
+
+        store.flush()
+        store = HistogramStore(backend, bucket_seconds=60)
+        store.load()
+        self.assertEqual(store.merged()["/search"].count, 2)
+
+    def test_max_buckets(self):
+        """ Test that the oldest windows of an endpoint are removed """
+        backend = Backend()
+        store = HistogramStore(backend, bucket_seconds=60, max_buckets=2)
+        for minutes in (1, 0, 2):
+            store.add("/search", 0.1, SPECIFIC_DATE_EPOCH + 60 * minutes)
+        store.add("/users", 0.1, SPECIFIC_DATE_EPOCH)
+        store.flush()
+
+        store = HistogramStore(backend, bucket_seconds=60, max_buckets=2)
+        store.load()
+        store.add("/search", 0.1, SPECIFIC_DATE_EPOCH + 60 * 3)
+        self.assertEqual(
+            [histogram.bucket_start for histogram in store.list("/search")],
+            [SPECIFIC_DATE_EPOCH + 60 * 3, SPECIFIC_DATE_EPOCH + 60 * 2])
+        self.assertEqual(len(store.list("/users")), 1)
+        self.assertEqual(len(list(backend.iter_states())), 2)
+
+        # Values older than every window kept are dropped.
+        store.add("/search", 0.1, SPECIFIC_DATE_EPOCH)
+        self.assertEqual(len(store.list("/search")), 2)
+
+    def test_max_endpoints(self):
+        """ Test that endpoints past the maximum are counted as one """
+        store = HistogramStore(Backend(), bucket_seconds=60, max_endpoints=2)
+        for endpoint in ("/search", "/users", "/a", "/b", "/search"):
+            store.add(endpoint, 0.1, SPECIFIC_DATE_EPOCH)
+
+        histograms = store.merged()
+        self.assertEqual(sorted(histograms),
+                         ["/search", "/users", OTHER_ENDPOINT])
+        self.assertEqual(histograms["/search"].count, 2)
+        self.assertEqual(histograms[OTHER_ENDPOINT].count, 2)
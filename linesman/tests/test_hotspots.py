@@ -0,0 +1,177 @@
+import unittest
+from datetime import datetime, timedelta
+
+from mock import Mock
+
+from linesman import SessionSummary
+from linesman.backends.base import Backend
+from linesman.hotspots import FunctionTotals, HotspotStore, SessionRebuilder
+from linesman.tests import SPECIFIC_DATE_DATETIME
+from linesman.tests.test_aggregates import create_session
+
+
+class TestFunctionTotals(unittest.TestCase):
+
+    def test_add_and_top(self):
+        """ Test that functions are summed and ranked by any field """
+        totals = FunctionTotals()
+        totals.add(create_session(1.0))
+        totals.add(create_session(3.0))
+
+        self.assertEqual(totals.session_count, 2)
+        self.assertEqual(totals.duration, 4.0)
+        self.assertEqual([hotspot.key for hotspot in totals.top("totaltime")],
+                         ["a", "b"])
+        top = totals.top("inlinetime", limit=1)
+        self.assertEqual(len(top), 1)
+        self.assertEqual(top[0].key, "b")
+        self.assertAlmostEqual(top[0].inlinetime, 3.8)
+        self.assertEqual(top[0].callcount, 4)
+
+    def test_merge(self):
+        """ Test that totals can be added and subtracted """
+        totals = FunctionTotals()
+        totals.add(create_session(1.0))
+        other = FunctionTotals()
+        other.add(create_session(2.0))
+
+        totals.merge(other)
+        self.assertEqual(totals.functions["a"], [2, 0, 0.2, 3.0])
+        totals.merge(other, -1)
+        self.assertEqual(totals.session_count, 1)
+        self.assertEqual(totals.functions["a"], [1, 0, 0.1, 1.0])
+
+        # Functions without any calls left are removed.
+        totals.merge(other, -1)
+        self.assertEqual(totals.session_count, 0)
+        self.assertEqual(totals.functions, {})
+
+    def test_invalid_order(self):
+        """ Test that functions can't be ranked by other fields """
+        self.assertRaises(ValueError, FunctionTotals().top, "reccallcount")
+
+
+class TestSessionRebuilder(unittest.TestCase):
+
+    def test_apply(self):
+        """ Test that sessions given to the index while rebuilding count once """
+        added = []
+        removed = []
+        one = create_session(1.0)
+        two = create_session(2.0)
+        rebuilder = SessionRebuilder(Backend(), added.append)
+        rebuilder._seen = set()
+
+        # Added as it's stored, and then found by the rebuild.
+        rebuilder.apply(one, added.append)
+        self.assertFalse(rebuilder.apply(one, added.append))
+        # Removed before the rebuild finds it.
+        self.assertFalse(rebuilder.apply(two, removed.append, adding=False))
+        self.assertFalse(rebuilder.apply(two, added.append))
+        rebuilder.apply(one, removed.append, adding=False)
+
+        self.assertEqual(added, [one])
+        self.assertEqual(removed, [one])
+
+
+class TestHotspotStore(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = Backend()
+        self.store = HotspotStore(self.backend, bucket_seconds=3600,
+                                  max_buckets=2, flush_interval=3600)
+
+    def test_top(self):
+        """ Test that functions are ranked across every window kept """
+        hour = timedelta(hours=1)
+        self.store.add(create_session(1.0))
+        self.store.add(create_session(2.0, endpoint="/other"))
+        self.store.add(create_session(4.0, timestamp=SPECIFIC_DATE_DATETIME +
+                                      hour))
+
+        top = self.store.top("totaltime")
+        self.assertEqual(self.store.session_count, 3)
+        self.assertEqual((top[0].key, top[0].totaltime), ("a", 7.0))
+        self.assertEqual(len(self.store.list()), 2)
+
+        # The oldest window is removed from the totals along with it.
+        self.store.add(create_session(8.0, timestamp=SPECIFIC_DATE_DATETIME +
+                                      2 * hour))
+        top = self.store.top("totaltime")
+        self.assertEqual(self.store.session_count, 2)
+        self.assertEqual((top[0].key, top[0].totaltime), ("a", 12.0))
+
+    def test_top_range(self):
+        """ Test that functions can be ranked within a range of time """
+        hour = timedelta(hours=1)
+        self.store.add(create_session(1.0))
+        self.store.add(create_session(4.0, timestamp=SPECIFIC_DATE_DATETIME +
+                                      hour))
+        start = self.store.list()[0].bucket_start
+
+        top = self.store.top("totaltime", since=start)
+        self.assertEqual(top[0].totaltime, 4.0)
+        top = self.store.top("totaltime", until=start)
+        self.assertEqual(top[0].totaltime, 1.0)
+        self.assertEqual(self.store.totals(until=start).session_count, 1)
+
+    def test_remove_and_clear(self):
+        """ Test that deleted sessions can be taken out of the index """
+        session = create_session(1.0)
+        self.store.add(session)
+        self.store.add(create_session(2.0))
+        self.store.flush()
+
+        self.store.remove(session)
+        top = self.store.top("totaltime")
+        self.assertEqual(self.store.session_count, 1)
+        self.assertEqual((top[0].key, top[0].totaltime), ("a", 2.0))
+        self.assertEqual(self.store.list()[0].session_count, 1)
+
+        # Sessions outside of the windows kept are ignored.
+        self.assertFalse(self.store.remove(create_session(
+            4.0, timestamp=SPECIFIC_DATE_DATETIME - timedelta(hours=1))))
+        self.assertEqual(self.store.session_count, 1)
+
+        self.store.clear()
+        self.assertEqual(self.store.session_count, 0)
+        self.assertEqual(self.store.list(), [])
+        self.assertEqual(list(self.backend.iter_states()), [])
+
+    def test_flush_and_load(self):
+        """ Test that the totals are persisted using the backend's state """
+        self.store.add(create_session(1.0))
+        self.store.add(create_session(2.0))
+        self.store.flush()
+
+        store = HotspotStore(self.backend, max_buckets=0)
+        store.load()
+        self.assertEqual(store.session_count, 2)
+        self.assertEqual(store.top("totaltime")[0].totaltime, 3.0)
+
+    def test_rebuild(self):
+        """ Test that the index is rebuilt from stored sessions if missing """
+        now = datetime.now()
+        sessions = {"one": create_session(1.0, timestamp=now),
+                    "two": create_session(2.0, timestamp=now)}
+        self.backend.iter_summaries = Mock(
+            return_value=[SessionSummary(uuid, "/search", 1.0, now)
+                          for uuid in sorted(sessions)])
+        self.backend.get = Mock(side_effect=sessions.get)
+
+        # The index is rebuilt in the background.
+        self.store.load()
+        self.store._rebuilder.join()
+        self.assertEqual(self.store.session_count, 2)
+        self.assertEqual(len(list(self.backend.iter_states())), 1)
+        since = self.backend.iter_summaries.call_args[1]['since']
+        self.assertTrue(now - timedelta(hours=2) < since <= now)
+        until = self.backend.iter_summaries.call_args[1]['until']
+        self.assertTrue(now < until <= datetime.now() + timedelta(seconds=1))
+
+        # Once it has been stored, the index is loaded instead.
+        self.backend.iter_summaries.reset_mock()
+        store = HotspotStore(self.backend)
+        store.load()
+        self.assertEqual(store.session_count, 2)
+        self.assertFalse(self.backend.iter_summaries.called)
@@ -22,7 +22,7 @@ class TestProfilingSession(unittest.TestCase):
     def setUp(self):
         self.stats = generate_profiler_entry()
 
-    @patch("linesman.create_graph")
+    @patch("linesman.create_call_graph")
     def test_init_default_args(self, mock_create_graph):
         """ Test ProfilingSession initialization with default args """
         session = linesman.ProfilingSession(self.stats)
@@ -31,7 +31,7 @@ class TestProfilingSession(unittest.TestCase):
         assert_equals(session.timestamp, None)
         assert_equals(str(session._uuid), session.uuid)
 
-    @patch("linesman.create_graph")
+    @patch("linesman.create_call_graph")
     def test_init_environ(self, mock_create_graph):
         """ Test ProfilingSession initialization with an environ args """
         environ = {'PATH_INFO': '/some/path'}
@@ -41,7 +41,7 @@ class TestProfilingSession(unittest.TestCase):
         assert_equals(session.timestamp, None)
         assert_equals(str(session._uuid), session.uuid)
 
-    @patch("linesman.create_graph")
+    @patch("linesman.create_call_graph")
     def test_init_environ_timestamp(self, mock_create_graph):
         """ Test ProfilingSession initialization with all args """
         environ = {'PATH_INFO': '/some/path'}
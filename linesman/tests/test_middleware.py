@@ -1,14 +1,16 @@
+import json
 import os
 from cProfile import Profile
 from unittest import TestCase
 
+from PIL import Image
 from mock import Mock, patch
 from nose.tools import raises
 from paste.urlmap import URLMap
 from webtest import TestApp
 
 import linesman.middleware
-from linesman.tests import get_temporary_filename
+from linesman.tests import SPECIFIC_DATE_DATETIME, get_temporary_filename
 
 
 try:
@@ -83,7 +85,8 @@ class TestProfilingMiddleware(TestCase):
 
             app.get('/__profiler__/media/js/accordian.js')
             app.get('/__profiler__/profiles/%s' % session.uuid)
-            resp = app.get('/__profiler__')
+            app.get('/__profiler__')
+            resp = app.get('/__profiler__/sessions')
             assert(session.uuid in resp.body)
 
             resp = app.get('/__profiler__/delete/%s' % session.uuid)
@@ -98,3 +101,531 @@ class TestProfilingMiddleware(TestCase):
                 os.remove(temp_filename)
             except:
                 pass
+
+    @patch("os.path.exists", Mock(return_value=True))
+    @patch("linesman.middleware.Profile")
+    def test_unsampled_request_skips_profiler(self, mock_profile):
+        """ Test that requests rejected by the sampler are not profiled """
+        app = Mock(return_value=["body"])
+        pm = linesman.middleware.ProfilingMiddleware(app, sample_every="2")
+        pm.sampler.should_sample = Mock(return_value=False)
+
+        environ = {'PATH_INFO': '/some/path', 'SCRIPT_NAME': ''}
+        start_response = Mock()
+        result = pm(environ, start_response)
+
+        self.assertEqual(result, ["body"])
+        app.assert_called_once_with(environ, start_response)
+        self.assertFalse(mock_profile.called)
+
+    @patch("os.path.exists", Mock(return_value=True))
+    def test_background_ingest(self):
+        """ Test that sessions are stored by the worker when enabled """
+        app = Mock(return_value=["body"])
+        pm = linesman.middleware.ProfilingMiddleware(
+            app, ingest_queue_size="10")
+        pm._backend = Mock()
+
+        environ = {'PATH_INFO': '/some/path', 'SCRIPT_NAME': ''}
+        result = pm(environ, Mock())
+        self.assertEqual(list(result), ["body"])
+        result.close()
+        pm.close()
+
+        self.assertEqual(pm._backend.add.call_count, 1)
+        session = pm._backend.add.call_args[0][0]
+        self.assertEqual(session.path, '/some/path')
+
+    @patch("os.path.exists", Mock(return_value=True))
+    def test_session_endpoint(self):
+        """ Test that sessions record the normalized route of the request """
+        pm = linesman.middleware.ProfilingMiddleware(
+            Mock(return_value=["body"]),
+            route_patterns=r"^/users/\w+$ /users/{name}")
+        pm._backend = Mock()
+
+        environ = {'PATH_INFO': '/users/bob', 'SCRIPT_NAME': ''}
+        pm(environ, Mock()).close()
+
+        session = pm._backend.add.call_args[0][0]
+        self.assertEqual(session.path, '/users/bob')
+        self.assertEqual(session.endpoint, '/users/{name}')
+
+    @patch("os.path.exists", Mock(return_value=True))
+    def test_close_closes_backend(self):
+        """ Test that closing the middleware closes the backend """
+        pm = linesman.middleware.ProfilingMiddleware(Mock())
+        pm._backend = Mock()
+        pm.close()
+
+        pm._backend.close.assert_called_once_with()
+
+    @patch("os.path.exists", Mock(return_value=True))
+    def test_response_body_is_profiled(self):
+        """ Test that generating the response body is profiled """
+        def body():
+            yield "a"
+            yield "b"
+
+        def app(environ, start_response):
+            start_response("200 OK", [])
+            return body()
+
+        pm = linesman.middleware.ProfilingMiddleware(app)
+        pm._backend = Mock()
+
+        environ = {'PATH_INFO': '/some/path', 'SCRIPT_NAME': '',
+                   'REQUEST_METHOD': 'POST'}
+        result = pm(environ, Mock())
+        self.assertFalse(pm._backend.add.called)
+
+        self.assertEqual(list(result), ["a", "b"])
+        result.close()
+        result.close()
+
+        self.assertEqual(pm._backend.add.call_count, 1)
+        session = pm._backend.add.call_args[0][0]
+        self.assertTrue(
+            'linesman.tests.test_middleware.body' in session._graph)
+        self.assertTrue(session.time_to_first_byte is not None)
+        self.assertTrue(session.body_time <= session.duration)
+        self.assertEqual(session.method, 'POST')
+        self.assertEqual(session.status, 200)
+
+    def test_profiled_response_close(self):
+        """ Test that closing the response closes the wrapped iterable """
+        app_iter = Mock()
+        callback = Mock()
+        response = linesman.middleware.ProfiledResponse(
+            app_iter, Mock(), 0, callback)
+        response.close()
+
+        app_iter.close.assert_called_once_with()
+        self.assertEqual(callback.call_count, 1)
+        self.assertEqual(callback.call_args[1]['time_to_first_byte'], None)
+
+    def test_show_profile_cached(self):
+        """ Test that sessions and views are cached between page views """
+        pm = linesman.middleware.ProfilingMiddleware(Mock())
+        session = linesman.ProfilingSession(generate_profiler_entry())
+        pm._backend = Mock()
+        pm._backend.get.return_value = session
+        pm._backend.delete.return_value = 1
+
+        app = TestApp(pm)
+        with patch("linesman.middleware.prepare_graph",
+                   Mock(wraps=linesman.middleware.prepare_graph)) as prepare:
+            app.get('/__profiler__/profiles/%s' % session.uuid)
+            app.get('/__profiler__/profiles/%s' % session.uuid)
+            app.get('/__profiler__/profiles/%s?cutoff_percent=5.01' %
+                    session.uuid)
+            self.assertEqual(pm._backend.get.call_count, 1)
+            self.assertEqual(prepare.call_count, 1)
+
+            app.get('/__profiler__/profiles/%s?cutoff_percent=10' %
+                    session.uuid)
+            self.assertEqual(prepare.call_count, 2)
+
+        # Deleting the session removes it from the cache.
+        app.get('/__profiler__/delete/%s' % session.uuid)
+        pm._backend.get.return_value = None
+        app.get('/__profiler__/profiles/%s' % session.uuid, status=404)
+
+    def test_list_sessions(self):
+        """ Test that the session list is paged and filtered by the backend """
+        pm = linesman.middleware.ProfilingMiddleware(Mock())
+        summary = linesman.SessionSummary(
+            "abcd", "/some/<path>", 1.5, SPECIFIC_DATE_DATETIME,
+            method="<GET>", status=200)
+        pm._backend = Mock()
+        pm._backend.iter_summaries.return_value = iter([summary])
+        pm._backend.count_summaries.return_value = 1
+
+        app = TestApp(pm)
+        resp = app.get('/__profiler__/sessions', params={
+            'sEcho': '3', 'iDisplayStart': '40', 'iDisplayLength': '20',
+            'iSortCol_0': '3', 'sSortDir_0': 'asc',
+            'sSearch_0': '/some/', 'sSearch_3': '1',
+            'sSearch_4': '2011-01-02'},
+            extra_environ={'SCRIPT_NAME': '/someapp'})
+        data = json.loads(resp.body)
+
+        self.assertEqual(resp.content_type, "application/json")
+        pm._backend.iter_summaries.assert_called_once_with(
+            order_by="duration", descending=False, limit=20, offset=40,
+            path_prefix="/some/", min_duration=1.0,
+            since=SPECIFIC_DATE_DATETIME.replace(day=2))
+        self.assertEqual(data['sEcho'], 3)
+        self.assertEqual(data['iTotalDisplayRecords'], 1)
+        self.assertEqual(len(data['aaData']), 1)
+        self.assertTrue('href="/someapp/__profiler__/profiles/abcd"' in
+                        data['aaData'][0][0])
+        self.assertTrue('href="/someapp/__profiler__/delete/abcd"' in
+                        data['aaData'][0][5])
+        self.assertTrue("&lt;path&gt;" in data['aaData'][0][0])
+        self.assertEqual(data['aaData'][0][1:5],
+                         ["&lt;GET&gt;", 200, 1.5,
+                          unicode(SPECIFIC_DATE_DATETIME)])
+
+    def test_list_sessions_bad_params(self):
+        """ Test that invalid paging parameters fall back to defaults """
+        pm = linesman.middleware.ProfilingMiddleware(Mock())
+        pm._backend = Mock()
+        pm._backend.iter_summaries.return_value = iter([])
+        pm._backend.count_summaries.return_value = 0
+
+        app = TestApp(pm)
+        app.get('/__profiler__/sessions', params={
+            'iDisplayLength': '-1', 'iSortCol_0': '1', 'sSearch_3': 'slow',
+            'sSearch_4': 'yesterday'})
+        pm._backend.iter_summaries.assert_called_once_with(
+            order_by="timestamp", descending=True, offset=0,
+            limit=linesman.middleware.MAX_SESSION_LIST_LENGTH)
+
+    @patch.object(linesman.middleware, 'DELETE_BATCH_SIZE', 2)
+    def test_delete_filtered(self):
+        """ Test that sessions matching the filters are deleted in batches """
+        pm = linesman.middleware.ProfilingMiddleware(Mock())
+        pm._backend = Mock()
+        pages = [["abcd", "efgh"], ["ijkl"]]
+        pm._backend.iter_summaries.side_effect = lambda **kwargs: iter([
+            linesman.SessionSummary(uuid, "/some/path", 1.0,
+                                    SPECIFIC_DATE_DATETIME)
+            for uuid in pages.pop(0)])
+        pm._backend.delete_many.side_effect = len
+
+        app = TestApp(pm)
+        resp = app.post('/__profiler__/delete/filtered',
+                        params={'sSearch_0': '/some/'})
+        self.assertTrue('3 row(s) deleted' in resp.body)
+        self.assertEqual(pm._backend.iter_summaries.call_args_list,
+                         [((), {'path_prefix': "/some/", 'limit': 2})] * 2)
+        self.assertEqual(pm._backend.delete_many.call_args_list,
+                         [((["abcd", "efgh"],), {}), ((["ijkl"],), {})])
+
+    def test_show_profile_root_nodes(self):
+        """ Test that only the root nodes of the call tree are rendered """
+        pm = linesman.middleware.ProfilingMiddleware(Mock())
+        session = linesman.ProfilingSession(generate_profiler_entry())
+        pm._backend = Mock()
+        pm._backend.get.return_value = session
+
+        app = TestApp(pm)
+        resp = app.get('/__profiler__/profiles/%s?cutoff_percent=0' %
+                       session.uuid)
+        view = pm._get_view(session, 0)
+        self.assertEqual(resp.body.count('class="profile-stats'),
+                         len(view.root_nodes))
+
+    def test_show_children(self):
+        """ Test that the children of a node are returned as JSON """
+        pm = linesman.middleware.ProfilingMiddleware(Mock())
+        session = linesman.ProfilingSession(generate_profiler_entry())
+        pm._backend = Mock()
+        pm._backend.get.return_value = session
+
+        app = TestApp(pm)
+        url = '/__profiler__/profiles/%s/children' % session.uuid
+        view = pm._get_view(session, 0)
+        root_node = view.root_nodes[0]
+        resp = app.get(url, params={'node': root_node, 'cutoff_percent': 0})
+        children = json.loads(resp.body)
+
+        self.assertEqual(resp.content_type, "application/json")
+        self.assertEqual(sorted(child['node'] for child in children),
+                         sorted(view.graph.neighbors(root_node)))
+        for child in children:
+            self.assertEqual(child['has_children'],
+                             bool(view.graph.neighbors(child['node'])))
+
+        app.get(url, params={'node': 'not a node'}, status=404)
+
+    @patch("os.path.exists", Mock(return_value=True))
+    def test_aggregate_profiles(self):
+        """ Test that aggregates are shown by the profile pages """
+        filename = get_temporary_filename()
+        self.addCleanup(os.remove, filename)
+        pm = linesman.middleware.ProfilingMiddleware(
+            Mock(return_value=["body"]), aggregate_window="3600",
+            filename=filename)
+        self.addCleanup(pm.close)
+        pm._backend.add = Mock()
+
+        environ = {'PATH_INFO': '/users/42', 'SCRIPT_NAME': ''}
+        pm(environ, Mock()).close()
+        pm(environ, Mock()).close()
+
+        aggregate = pm._aggregates.list()[0]
+        self.assertEqual(aggregate.endpoint, '/users/{id}')
+        self.assertEqual(aggregate.session_count, 2)
+
+        app = TestApp(pm)
+        resp = app.get('/__profiler__/aggregates')
+        self.assertTrue('profiles/%s' % aggregate.id in resp.body)
+        self.assertTrue('<a href=".">Back to all sessions</a>' in resp.body)
+        resp = app.get('/__profiler__/profiles/%s' % aggregate.id)
+        self.assertTrue('Aggregate of /users/{id}' in resp.body)
+
+        # Revisions are cached by uuid, without copying them.
+        session = pm._get_session(aggregate.uuid)
+        self.assertTrue(pm._get_session(aggregate.id) is session)
+        pm(environ, Mock()).close()
+        self.assertEqual(session.session_count, 2)
+        self.assertEqual(pm._get_session(aggregate.id).session_count, 3)
+        self.assertTrue(pm._get_session(aggregate.uuid) is session)
+
+        # Revisions that are no longer cached aren't served as the current
+        # one.
+        pm._uncache()
+        app.get('/__profiler__/profiles/%s/children' % aggregate.uuid,
+                status=404)
+        app.get('/__profiler__/profiles/%s' % aggregate.uuid, status=404)
+
+    def test_latency_histograms(self):
+        """ Test that unprofiled requests are recorded in the histograms """
+        body = Mock()
+        body.__iter__ = Mock(return_value=iter(["body"]))
+        filename = get_temporary_filename()
+        self.addCleanup(os.remove, filename)
+        pm = linesman.middleware.ProfilingMiddleware(
+            Mock(return_value=body), latency_window="3600",
+            filename=filename)
+        self.addCleanup(pm.close)
+
+        environ = {'PATH_INFO': '/users/42', 'SCRIPT_NAME': ''}
+        with patch("os.path.exists", Mock(return_value=False)):
+            result = pm(environ, Mock())
+        self.assertEqual(list(result), ["body"])
+        self.assertEqual(pm._latencies.merged(), {})
+        result.close()
+        body.close.assert_called_once_with()
+
+        histograms = pm._latencies.merged()
+        self.assertEqual(histograms['/users/{id}'].count, 1)
+
+        resp = TestApp(pm).get('/__profiler__/latency')
+        self.assertTrue('/users/{id}' in resp.body)
+        resp = TestApp(pm).get('/__profiler__/latency',
+                               params={'endpoint': '/users/{id}'})
+        self.assertTrue('Latency of /users/{id}' in resp.body)
+
+    @patch("os.path.exists", Mock(return_value=True))
+    def test_hot_functions(self):
+        """ Test that the functions of every session are ranked """
+        filename = get_temporary_filename()
+        self.addCleanup(os.remove, filename)
+        pm = linesman.middleware.ProfilingMiddleware(
+            Mock(return_value=["body"]), hotspot_window="3600",
+            filename=filename)
+        self.addCleanup(pm.close)
+
+        environ = {'PATH_INFO': '/users/42', 'SCRIPT_NAME': ''}
+        pm(environ, Mock()).close()
+        self.assertEqual(pm._hotspots.session_count, 1)
+
+        app = TestApp(pm)
+        resp = app.get('/__profiler__/hotspots',
+                       params={'order_by': 'totaltime', 'hours': '1'})
+        self.assertTrue('1 sessions' in resp.body)
+        resp = app.get('/__profiler__/hotspots',
+                       params={'format': 'json', 'limit': '1'})
+        self.assertEqual(resp.json['session_count'], 1)
+        self.assertEqual(len(resp.json['functions']), 1)
+        self.assertEqual(sorted(resp.json['functions'][0]),
+                         ['callcount', 'inlinetime', 'key', 'reccallcount',
+                          'totaltime'])
+
+        # A new middleware rebuilds the index from the stored session.
+        self.assertEqual(list(pm._backend.iter_states()), [])
+        hotspots = linesman.middleware.HotspotStore(pm._backend)
+        hotspots.load()
+        hotspots._rebuilder.join()
+        self.assertEqual(hotspots.session_count, 1)
+
+    @patch("os.path.exists", Mock(return_value=True))
+    def test_function_timeseries(self):
+        """ Test that the series of each function are shown as sparklines """
+        filename = get_temporary_filename()
+        self.addCleanup(os.remove, filename)
+        pm = linesman.middleware.ProfilingMiddleware(
+            Mock(return_value=["body"]),
+            timeseries_resolutions="60:120 3600:168", filename=filename)
+        self.addCleanup(pm.close)
+
+        environ = {'PATH_INFO': '/users/42', 'SCRIPT_NAME': ''}
+        pm(environ, Mock()).close()
+        session = pm._backend.get_all().values()[0]
+        key = session._callgraph.keys[0]
+
+        app = TestApp(pm)
+        resp = app.get('/__profiler__/profiles/%s' % session.uuid)
+        self.assertTrue('timeseries?resolution=3600' in resp.body)
+        self.assertTrue('class="sparkline"' in resp.body)
+
+        resp = app.get('/__profiler__/timeseries',
+                       params=[('key', key), ('key', 'missing'),
+                               ('resolution', 'bad')])
+        self.assertEqual(resp.json['resolution'], 3600)
+        self.assertEqual(resp.json['series']['missing'], [])
+        points = resp.json['series'][key]
+        self.assertEqual(len(points), 1)
+        self.assertEqual(len(points[0]), 5)
+
+    @patch("os.path.exists", Mock(return_value=True))
+    def test_forget_deleted_sessions(self):
+        """ Test that deleted and evicted sessions leave the function index """
+        filename = get_temporary_filename()
+        self.addCleanup(os.remove, filename)
+        pm = linesman.middleware.ProfilingMiddleware(
+            Mock(return_value=["body"]), hotspot_window="3600",
+            timeseries_resolutions="60:120", max_sessions="1",
+            filename=filename)
+        self.addCleanup(pm.close)
+
+        environ = {'PATH_INFO': '/users/42', 'SCRIPT_NAME': ''}
+        pm(environ.copy(), Mock()).close()
+        pm(environ.copy(), Mock()).close()
+        self.assertEqual(len(pm._backend.get_all()), 1)
+        self.assertEqual(pm._hotspots.session_count, 1)
+        self.assertEqual(pm._timeseries.levels[0].list()[0].session_count, 1)
+
+        app = TestApp(pm)
+        session_uuid = pm._backend.get_all().keys()[0]
+        app.get('/__profiler__/delete/%s' % session_uuid)
+        self.assertEqual(pm._hotspots.session_count, 0)
+        self.assertEqual(pm._timeseries.levels[0].list()[0].session_count, 0)
+
+        pm(environ.copy(), Mock()).close()
+        app.get('/__profiler__/delete/all')
+        self.assertEqual(pm._hotspots.list(), [])
+        self.assertEqual(pm._timeseries.levels[0].list(), [])
+
+    @patch("os.path.exists", Mock(return_value=True))
+    def test_uncache_evicted_sessions(self):
+        """ Test that sessions evicted by the backend leave the cache """
+        filename = get_temporary_filename()
+        self.addCleanup(os.remove, filename)
+        pm = linesman.middleware.ProfilingMiddleware(
+            Mock(return_value=["body"]), max_sessions="1", filename=filename)
+        self.addCleanup(pm.close)
+
+        environ = {'PATH_INFO': '/users/42', 'SCRIPT_NAME': ''}
+        pm(environ.copy(), Mock()).close()
+        session_uuid = pm._backend.get_all().keys()[0]
+        self.assertTrue(pm._get_session(session_uuid) is not None)
+
+        pm(environ.copy(), Mock()).close()
+        self.assertEqual(pm._cache.get(('session', session_uuid)), None)
+        self.assertEqual(pm._get_session(session_uuid), None)
+
+    def test_show_diff(self):
+        """ Test that the differences between two sessions are shown """
+        pm = linesman.middleware.ProfilingMiddleware(Mock())
+        before = linesman.ProfilingSession(generate_profiler_entry())
+        after = linesman.ProfilingSession(generate_profiler_entry())
+        sessions = {before.uuid: before, after.uuid: after}
+        pm._backend = Mock()
+        pm._backend.get = sessions.get
+
+        app = TestApp(pm)
+        url = '/__profiler__/diff/%s/%s' % (before.uuid, after.uuid)
+        resp = app.get(url, params={'cutoff_percent': 0})
+        view = pm._get_diff_view(before, after, 0)
+        self.assertEqual(resp.body.count('class="profile-stats '),
+                         len(view.root_nodes))
+
+        root_node = view.root_nodes[0]
+        resp = app.get(url + '/children',
+                       params={'node': root_node, 'cutoff_percent': 0})
+        self.assertEqual(
+            sorted(child['node'] for child in json.loads(resp.body)),
+            sorted(view.graph.neighbors(root_node)))
+
+        resp = app.get(url, params={'format': 'json', 'limit': 2,
+                                    'order_by': 'callcount'})
+        data = json.loads(resp.body)
+        self.assertEqual(data['before'], before.uuid)
+        self.assertEqual(len(data['functions']), 2)
+        self.assertTrue('delta_callcount' in data['functions'][0])
+
+        # Every function can be below the cutoff.
+        app.get(url, params={'cutoff_percent': 100})
+        resp = app.get(url, params={'cutoff_percent': 200})
+        self.assertEqual(pm._get_diff_view(before, after, 2.0).root_nodes, [])
+        self.assertEqual(resp.body.count('class="profile-stats '), 0)
+
+        app.get('/__profiler__/diff/%s/notauuid' % before.uuid, status=404)
+
+    @patch("linesman.middleware._render_graph_files")
+    def test_render_graph_placeholder(self, mock_render):
+        """ Test that unrendered graphs return a placeholder """
+        pm = linesman.middleware.ProfilingMiddleware(Mock())
+        session = linesman.ProfilingSession(generate_profiler_entry())
+        pm._backend = Mock()
+        pm._backend.get.return_value = session
+        pm._render_pool = Mock()
+        pm._render_pool.submit.return_value = False
+        pm._render_pool.has_failed.return_value = False
+
+        app = TestApp(pm)
+        fileid = "%s--%d" % (session.uuid, 12345)
+        resp = app.get('/__profiler__/graph/thumb-%s.png' % fileid,
+                       status=202)
+        self.assertEqual(resp.content_type, "image/png")
+        pm._render_pool.submit.assert_called_once_with(
+            fileid, mock_render, session, fileid, 12345)
+
+    @patch("linesman.middleware._render_graph_files")
+    def test_render_graph_failed(self, mock_render):
+        """ Test that graphs that failed to render aren't retried """
+        pm = linesman.middleware.ProfilingMiddleware(Mock(), render_workers=0)
+        session = linesman.ProfilingSession(generate_profiler_entry())
+        pm._backend = Mock()
+        pm._backend.get.return_value = session
+        mock_render.side_effect = OSError("dot is missing")
+
+        app = TestApp(pm)
+        fileid = "%s--%d" % (session.uuid, 12345)
+        app.get('/__profiler__/graph/thumb-%s.png' % fileid, status=500)
+        app.get('/__profiler__/graph/%s.png' % fileid, status=500)
+        self.assertEqual(mock_render.call_count, 1)
+
+    @patch("os.path.exists", Mock(return_value=True))
+    def test_prerender_graphs(self):
+        """ Test that graphs are scheduled for rendering when stored """
+        app = Mock(return_value=["body"])
+        pm = linesman.middleware.ProfilingMiddleware(
+            app, prerender_graphs="true")
+        pm._backend = Mock()
+        pm._render_pool = Mock()
+
+        environ = {'PATH_INFO': '/some/path', 'SCRIPT_NAME': ''}
+        pm(environ, Mock()).close()
+
+        session = pm._backend.add.call_args[0][0]
+        fileid = pm._render_pool.submit.call_args[0][0]
+        self.assertTrue(fileid.startswith(session.uuid + "--"))
+
+    def test_render_graph_files(self):
+        """ Test that the graph and its thumbnail are written atomically """
+        def draw(graph, path):
+            Image.new("RGB", (1200, 300)).save(path)
+
+        session = linesman.ProfilingSession(generate_profiler_entry())
+        fileid = "%s--0" % session.uuid
+        path, thumbnail_path = linesman.middleware._graph_paths(fileid)
+        if not os.path.exists(linesman.middleware.GRAPH_DIR):
+            os.makedirs(linesman.middleware.GRAPH_DIR)
+        try:
+            with patch("linesman.middleware.draw_graph", Mock(wraps=draw)):
+                linesman.middleware._render_graph_files(session, fileid, 0)
+
+            self.assertEqual(Image.open(thumbnail_path).size, (600, 150))
+            self.assertEqual(Image.open(path).size, (1200, 300))
+            leftovers = [name for name in os.listdir(os.path.dirname(path))
+                         if name.startswith(fileid) and "tmp" in name]
+            self.assertEqual(leftovers, [])
+        finally:
+            for filename in (path, thumbnail_path):
+                if os.path.exists(filename):
+                    os.remove(filename)
@@ -0,0 +1,101 @@
+import sys
+import time
+import unittest
+
+from nose.tools import assert_equals, raises
+
+import linesman
+from linesman.profilers import StackSampler
+
+
+class TestStackSampler(unittest.TestCase):
+
+    @raises(ValueError)
+    def test_invalid_interval(self):
+        """ Test that a non-positive interval is rejected """
+        StackSampler(0)
+
+    def test_sample_attribution(self):
+        """ Test that samples are attributed to the leaf and its callers """
+        sampler = StackSampler()
+        sampler._stop_frame = sys._getframe()
+        sampler._last_sample = 0.0
+
+        def leaf():
+            sampler._sample(sys._getframe(), 1.0)
+            sampler._sample(sys._getframe(), 2.0)
+
+        def caller():
+            leaf()
+
+        caller()
+
+        stats = dict((entry.code.co_name, entry)
+                     for entry in sampler.getstats())
+        assert_equals(sorted(stats.keys()), ["caller", "leaf"])
+
+        # The same frames were seen twice, so they only count as one call.
+        assert_equals(stats["leaf"].callcount, 1)
+        assert_equals(stats["leaf"].totaltime, 2.0)
+        assert_equals(stats["leaf"].inlinetime, 2.0)
+        assert_equals(stats["caller"].totaltime, 2.0)
+        assert_equals(stats["caller"].inlinetime, 0.0)
+
+        calls = stats["caller"].calls
+        assert_equals(len(calls), 1)
+        assert_equals(calls[0].code.co_name, "leaf")
+        assert_equals(calls[0].totaltime, 2.0)
+        assert_equals(stats["leaf"].calls, None)
+
+    def test_new_frames_count_as_calls(self):
+        """ Test that distinct frames of the same function count as calls """
+        sampler = StackSampler()
+        sampler._stop_frame = sys._getframe()
+        sampler._last_sample = 0.0
+
+        def leaf(now):
+            sampler._sample(sys._getframe(), now)
+
+        leaf(1.0)
+        leaf(2.0)
+
+        entry, = sampler.getstats()
+        assert_equals(entry.callcount, 2)
+        assert_equals(entry.totaltime, 2.0)
+
+    def test_recursion(self):
+        """ Test that recursive frames aren't double counted in totaltime """
+        sampler = StackSampler()
+        sampler._stop_frame = sys._getframe()
+        sampler._last_sample = 0.0
+
+        def recurse(depth):
+            if depth:
+                return recurse(depth - 1)
+            sampler._sample(sys._getframe(), 1.0)
+
+        recurse(2)
+
+        entry, = sampler.getstats()
+        assert_equals(entry.callcount, 3)
+        assert_equals(entry.reccallcount, 2)
+        assert_equals(entry.totaltime, 1.0)
+
+    def test_enable_disable(self):
+        """ Test that a busy function is sampled into a valid call graph """
+        def busy():
+            end = time.time() + 0.05
+            while time.time() < end:
+                pass
+
+        sampler = StackSampler(0.001)
+        sampler.enable()
+        try:
+            busy()
+        finally:
+            sampler.disable()
+
+        stats = sampler.getstats()
+        self.assertTrue(stats)
+        graph = linesman.create_graph(stats)
+        self.assertTrue('linesman.tests.test_profilers.busy' in graph)
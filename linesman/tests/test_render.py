@@ -0,0 +1,64 @@
+import threading
+import unittest
+
+from mock import Mock
+from nose.tools import assert_equals
+
+from linesman.render import RenderPool, placeholder_image
+
+
+class TestRenderPool(unittest.TestCase):
+
+    def test_inline(self):
+        """ Test that jobs run immediately without worker threads """
+        func = Mock()
+        pool = RenderPool(0)
+        self.assertTrue(pool.submit("a", func, 1, 2))
+        func.assert_called_once_with(1, 2)
+
+    def test_single_flight(self):
+        """ Test that a pending job isn't submitted a second time """
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def render(value):
+            calls.append(value)
+            started.set()
+            release.wait()
+
+        pool = RenderPool(2)
+        self.assertFalse(pool.submit("a", render, 1))
+        started.wait()
+        self.assertTrue(pool.is_pending("a"))
+        self.assertFalse(pool.submit("a", render, 2))
+        release.set()
+        pool.wait()
+
+        assert_equals(calls, [1])
+        self.assertFalse(pool.is_pending("a"))
+
+        # Once finished, the job can be submitted again.
+        pool.submit("a", render, 3)
+        pool.close()
+        assert_equals(calls, [1, 3])
+
+    def test_failing_job(self):
+        """ Test that failing jobs are remembered and not run again """
+        fail = Mock(side_effect=RuntimeError("dot is missing"))
+
+        pool = RenderPool(1)
+        pool.submit("a", fail)
+        pool.wait()
+        self.assertFalse(pool.is_pending("a"))
+        self.assertTrue(pool.has_failed("a"))
+        self.assertFalse(pool.has_failed("b"))
+
+        self.assertTrue(pool.submit("a", fail))
+        self.assertFalse(pool.is_pending("a"))
+        pool.close()
+        self.assertEqual(fail.call_count, 1)
+
+    def test_placeholder_image(self):
+        """ Test that the placeholder is a PNG image """
+        self.assertTrue(placeholder_image().startswith("\x89PNG"))
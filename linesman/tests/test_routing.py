@@ -0,0 +1,41 @@
+import unittest
+
+from nose.tools import assert_equals, raises
+
+from linesman.routing import RouteNormalizer
+
+
+class TestRouteNormalizer(unittest.TestCase):
+
+    def test_default_normalization(self):
+        """ Test that id-like path segments are replaced """
+        normalize = RouteNormalizer()
+        assert_equals(normalize("/users/42/posts"), "/users/{id}/posts")
+        assert_equals(
+            normalize("/files/0123456789abcdef0123/"), "/files/{id}/")
+        assert_equals(
+            normalize("/s/7e15fb2a-cb32-11f1-852b-02fc00000001"), "/s/{id}")
+        assert_equals(normalize("/about"), "/about")
+        assert_equals(normalize(None), None)
+
+    def test_patterns(self):
+        """ Test that the first matching pattern decides the endpoint """
+        normalize = RouteNormalizer("""
+            ^/static/          /static
+            ^/users/[^/]+$     /users/{name}
+            ^/users/           /users
+        """)
+        assert_equals(normalize("/static/css/site.css"), "/static")
+        assert_equals(normalize("/users/bob"), "/users/{name}")
+        assert_equals(normalize("/users/bob/edit"), "/users")
+        assert_equals(normalize("/posts/1"), "/posts/{id}")
+
+    def test_pattern_tuples(self):
+        """ Test that patterns can be given as tuples """
+        normalize = RouteNormalizer([(r"^/a", "/A")])
+        assert_equals(normalize("/abc"), "/A")
+
+    @raises(ValueError)
+    def test_invalid_pattern(self):
+        """ Test that patterns without an endpoint are rejected """
+        RouteNormalizer("^/users/")
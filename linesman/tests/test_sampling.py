@@ -0,0 +1,66 @@
+import unittest
+
+from nose.tools import assert_equals, raises
+
+from linesman.sampling import RequestSampler
+
+
+class TestRequestSampler(unittest.TestCase):
+
+    def test_default_always_samples(self):
+        """ Test that the default sampler profiles every request """
+        sampler = RequestSampler()
+        self.assertTrue(sampler.always)
+        self.assertTrue(all(sampler.should_sample() for i in range(100)))
+
+    def test_every_nth(self):
+        """ Test that only every Nth request is sampled """
+        sampler = RequestSampler(every="3")
+        results = [sampler.should_sample() for i in range(9)]
+        assert_equals(results, [False, False, True] * 3)
+
+    def test_rate(self):
+        """ Test that the probability is checked against the random source """
+        values = iter([0.1, 0.9, 0.49, 0.5])
+        sampler = RequestSampler(rate="0.5", rand=lambda: next(values))
+        results = [sampler.should_sample() for i in range(4)]
+        assert_equals(results, [True, False, True, False])
+
+    def test_max_per_second(self):
+        """ Test that the token bucket limits bursts and refills over time """
+        now = [100.0]
+        sampler = RequestSampler(max_per_second=2, clock=lambda: now[0])
+        results = [sampler.should_sample() for i in range(4)]
+        assert_equals(results, [True, True, False, False])
+
+        now[0] += 0.5
+        assert_equals(sampler.should_sample(), True)
+        assert_equals(sampler.should_sample(), False)
+
+    def test_max_per_second_fraction(self):
+        """ Test that rate limits below one per second still sample """
+        now = [100.0]
+        sampler = RequestSampler(max_per_second="0.1", clock=lambda: now[0])
+        assert_equals(sampler.should_sample(), True)
+        assert_equals(sampler.should_sample(), False)
+
+        now[0] += 5
+        assert_equals(sampler.should_sample(), False)
+        now[0] += 5
+        assert_equals(sampler.should_sample(), True)
+        assert_equals(sampler.should_sample(), False)
+
+    def test_max_per_second_zero(self):
+        """ Test that a rate limit of zero never samples """
+        sampler = RequestSampler(max_per_second=0)
+        self.assertFalse(any(sampler.should_sample() for i in range(10)))
+
+    @raises(ValueError)
+    def test_invalid_rate(self):
+        """ Test that a rate above 1.0 is rejected """
+        RequestSampler(rate=1.5)
+
+    @raises(ValueError)
+    def test_invalid_every(self):
+        """ Test that sampling every 0th request is rejected """
+        RequestSampler(every=0)
@@ -0,0 +1,133 @@
+import unittest
+from datetime import datetime, timedelta
+
+from mock import Mock
+
+from linesman import SessionSummary
+from linesman.backends.base import Backend
+from linesman.tests import SPECIFIC_DATE_DATETIME, SPECIFIC_DATE_EPOCH
+from linesman.tests.test_aggregates import create_session
+from linesman.timeseries import TimeSeriesStore, parse_resolutions
+
+
+def session_at(duration, minutes):
+    return create_session(duration, timestamp=SPECIFIC_DATE_DATETIME +
+                          timedelta(minutes=minutes))
+
+
+class TestParseResolutions(unittest.TestCase):
+
+    def test_parse(self):
+        """ Test that `seconds:count' pairs are parsed """
+        self.assertEqual(parse_resolutions(" 60:120\n3600:0 "),
+                         ((60, 120), (3600, 0)))
+        self.assertEqual(parse_resolutions(""), ())
+
+    def test_invalid(self):
+        """ Test that malformed resolutions are rejected """
+        self.assertRaises(ValueError, parse_resolutions, "60")
+        self.assertRaises(ValueError, parse_resolutions, "60:a")
+
+
+class TestTimeSeriesStore(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = Backend()
+        # Minutes for 3 minutes, and hours for 2 hours.
+        self.store = TimeSeriesStore(self.backend, ((60, 3), (3600, 2)),
+                                     flush_interval=3600)
+        self.store.since = Mock(return_value=None)
+
+    def test_invalid_resolutions(self):
+        """ Test that each resolution must contain the previous one """
+        self.assertRaises(ValueError, TimeSeriesStore, self.backend, ())
+        self.assertRaises(ValueError, TimeSeriesStore, self.backend,
+                          ((60, 3), (90, 2)))
+        self.assertRaises(ValueError, self.store.series, ["a"], 120)
+
+    def test_series(self):
+        """ Test that each window of a function is a point of its series """
+        self.store.add(session_at(1.0, 0))
+        self.store.add(session_at(2.0, 0.5))
+        self.store.add(session_at(4.0, 1))
+
+        series = self.store.series(["a", "missing"], 60)
+        self.assertEqual(series["missing"], [])
+        self.assertEqual(series["a"], [
+            (SPECIFIC_DATE_EPOCH, [2, 0, 0.2, 3.0]),
+            (SPECIFIC_DATE_EPOCH + 60, [1, 0, 0.1, 4.0])])
+
+    def test_rollup(self):
+        """ Test that old windows are rolled up into coarser ones """
+        for minutes in range(5):
+            self.store.add(session_at(1.0, minutes))
+
+        minutes, hours = self.store.levels
+        self.assertEqual([window.bucket_start for window in minutes.list()],
+                         [SPECIFIC_DATE_EPOCH + 60 * 4,
+                          SPECIFIC_DATE_EPOCH + 60 * 3,
+                          SPECIFIC_DATE_EPOCH + 60 * 2])
+        self.assertEqual(hours.list()[0].session_count, 2)
+        self.assertEqual(len(list(self.backend.iter_states())), 0)
+
+        # Coarse series include the windows that haven't been rolled up.
+        self.assertEqual(self.store.series(["a"], 3600)["a"],
+                         [(SPECIFIC_DATE_EPOCH, [5, 0, 0.5, 5.0])])
+        self.assertEqual(len(self.store.series(["a"], 60)["a"]), 3)
+
+        # Windows older than the coarsest resolution keeps are dropped.
+        self.store.add(session_at(1.0, 60 * 3))
+        self.store.add(session_at(1.0, 60 * 3 + 5))
+        self.assertEqual([(window.bucket_start, window.session_count)
+                          for window in hours.list()],
+                         [(SPECIFIC_DATE_EPOCH + 3600 * 3, 1)])
+
+    def test_remove_and_clear(self):
+        """ Test that deleted sessions are taken out of the series """
+        sessions = [session_at(1.0, minutes) for minutes in range(5)]
+        for session in sessions:
+            self.store.add(session)
+
+        # Sessions are taken out of the window they were rolled up into.
+        minutes, hours = self.store.levels
+        self.store.remove(sessions[0])
+        self.store.remove(sessions[4])
+        self.assertEqual(hours.list()[0].session_count, 1)
+        series = self.store.series(["a"], 3600)["a"]
+        self.assertEqual(len(series), 1)
+        self.assertEqual(series[0][1][0], 3)
+        self.assertAlmostEqual(series[0][1][3], 3.0)
+
+        self.store.clear()
+        self.assertEqual(self.store.series(["a"], 3600)["a"], [])
+        self.assertEqual(list(self.backend.iter_states()), [])
+
+    def test_flush_and_load(self):
+        """ Test that every resolution is persisted and loaded """
+        for minutes in range(5):
+            self.store.add(session_at(1.0, minutes))
+        self.store.flush()
+
+        store = TimeSeriesStore(self.backend, ((60, 3), (3600, 2)))
+        store.since = Mock(return_value=None)
+        store.load()
+        self.assertEqual(store.series(["a"], 3600),
+                         self.store.series(["a"], 3600))
+
+    def test_rebuild(self):
+        """ Test that the series are rebuilt from stored sessions if missing """
+        now = datetime.now()
+        sessions = {"one": create_session(1.0, timestamp=now)}
+        self.backend.iter_summaries = Mock(
+            return_value=[SessionSummary("one", "/search", 1.0, now)])
+        self.backend.get = Mock(side_effect=sessions.get)
+
+        # The series are rebuilt in the background.
+        self.store.load()
+        self.store._rebuilder.join()
+        self.assertEqual(len(self.store.series(["a"], 60)["a"]), 1)
+        since = self.backend.iter_summaries.call_args[1]['since']
+        self.assertTrue(now - timedelta(hours=3) < since <= now)
+        until = self.backend.iter_summaries.call_args[1]['until']
+        self.assertTrue(now < until <= datetime.now() + timedelta(seconds=1))
+        self.assertEqual(self.store.default_resolution, 3600)
@@ -0,0 +1,105 @@
+import threading
+import unittest
+
+from nose.tools import assert_equals, raises
+
+from linesman.workers import BackgroundWorker
+
+
+class TestBackgroundWorker(unittest.TestCase):
+
+    @raises(ValueError)
+    def test_invalid_drop_policy(self):
+        """ Test that unknown drop policies are rejected """
+        BackgroundWorker(drop_policy="sometimes")
+
+    def test_jobs_run_in_order(self):
+        """ Test that submitted jobs are run in order on another thread """
+        results = []
+        worker = BackgroundWorker()
+        for i in range(10):
+            self.assertTrue(worker.submit(results.append, i))
+        worker.close()
+
+        assert_equals(results, range(10))
+
+    def test_failing_job(self):
+        """ Test that an exception in a job doesn't stop the worker """
+        def fail():
+            raise RuntimeError("Oops")
+
+        results = []
+        worker = BackgroundWorker()
+        worker.submit(fail)
+        worker.submit(results.append, 1)
+        worker.flush()
+
+        assert_equals(results, [1])
+        worker.close()
+
+    def _blocked_worker(self, drop_policy):
+        """
+        Returns a worker with a queue of size 2, whose thread is stuck on a
+        job until the returned event is set.
+        """
+        started = threading.Event()
+        release = threading.Event()
+
+        def block():
+            started.set()
+            release.wait()
+
+        worker = BackgroundWorker(2, drop_policy)
+        worker.submit(block)
+        started.wait()
+        return worker, release
+
+    def test_drop_newest(self):
+        """ Test that the newest job is dropped when the queue is full """
+        results = []
+        worker, release = self._blocked_worker("newest")
+        self.assertTrue(worker.submit(results.append, 1))
+        self.assertTrue(worker.submit(results.append, 2))
+        self.assertFalse(worker.submit(results.append, 3))
+        release.set()
+        worker.close()
+
+        assert_equals(results, [1, 2])
+        assert_equals(worker.dropped, 1)
+
+    def test_drop_oldest(self):
+        """ Test that the oldest job is dropped when the queue is full """
+        results = []
+        worker, release = self._blocked_worker("oldest")
+        worker.submit(results.append, 1)
+        worker.submit(results.append, 2)
+        self.assertTrue(worker.submit(results.append, 3))
+        release.set()
+        worker.close()
+
+        assert_equals(results, [2, 3])
+        assert_equals(worker.dropped, 1)
+
+    def test_drop_oldest_concurrently(self):
+        """ Test that every dropped job is counted once across threads """
+        results = []
+        worker, release = self._blocked_worker("oldest")
+
+        def submit_many():
+            for i in range(200):
+                worker.submit(results.append, i)
+
+        threads = [threading.Thread(target=submit_many) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        release.set()
+        worker.close()
+
+        assert_equals(len(results), 2)
+        assert_equals(worker.dropped, 4 * 200 - 2)
+
+    def test_close_without_jobs(self):
+        """ Test that closing an unused worker does nothing """
+        BackgroundWorker().close()
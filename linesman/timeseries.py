@@ -0,0 +1,286 @@
+# This file is part of linesman.
+#
+# linesman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# linesman is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with linesman.  If not, see <http://www.gnu.org/licenses/>.
+#
+import logging
+import time
+from datetime import datetime
+
+from linesman.hotspots import (ALL_ENDPOINTS, FunctionTotals, SessionRebuilder,
+                               session_time)
+from linesman.windows import WindowedStore
+
+
+log = logging.getLogger(__name__)
+
+# Each resolution is stored by the backend under keys starting with this,
+# followed by its number of seconds.
+STATE_PREFIX = "timeseries:"
+
+# Minutes for two hours, hours for a week and days for 90 days.
+DEFAULT_RESOLUTIONS = ((60, 120), (3600, 168), (86400, 90))
+
+
+def parse_resolutions(value):
+    """
+    Parses resolutions written as whitespace separated `seconds:count`
+    pairs, such as `60:120 3600:168`, into a tuple of `(seconds, count)`
+    tuples.
+
+    Raises a :class:`ValueError` if ``value`` can't be parsed.
+    """
+    resolutions = []
+    for pair in value.split():
+        try:
+            seconds, count = pair.split(":")
+            resolutions.append((int(seconds), int(count)))
+        except ValueError:
+            raise ValueError("Invalid resolution %r; expected "
+                             "`seconds:count'" % pair)
+    return tuple(resolutions)
+
+
+class RollupStore(WindowedStore):
+    """
+    One resolution of a :class:`TimeSeriesStore`: the summed stats of every
+    function in each window of ``bucket_seconds``.  Windows are kept for
+    ``max_buckets`` windows of time after the newest one, rather than by
+    count, and are then added to the window containing them in ``rollup``,
+    if there is one.  See :class:`~linesman.windows.WindowedStore` for the
+    other arguments.
+    """
+
+    def __init__(self, backend, bucket_seconds, max_buckets,
+                 flush_interval=60, rollup=None):
+        super(RollupStore, self).__init__(backend, bucket_seconds,
+                                          max_buckets, flush_interval)
+        self.state_prefix = "%s%d:" % (STATE_PREFIX, self.bucket_seconds)
+        self.rollup = rollup
+
+    def create(self, endpoint, bucket_start):
+        return FunctionTotals(endpoint, bucket_start, self.bucket_seconds)
+
+    def _add_to(self, window, value):
+        # Finer windows are rolled up into coarser ones; everything else is
+        # a session.
+        if isinstance(value, FunctionTotals):
+            window.merge(value)
+        else:
+            window.add(value)
+
+    def _remove_from(self, window, session):
+        window.remove(session)
+
+    def _evict(self, endpoint):
+        if not self.max_buckets:
+            return
+        buckets = self._buckets[endpoint]
+        oldest = buckets[-1][0] - (self.max_buckets - 1) * self.bucket_seconds
+        while buckets and buckets[0][0] < oldest:
+            self._remove(buckets[0][1])
+
+    def _on_evict(self, window):
+        if self.rollup is not None and window.session_count:
+            self.rollup.add(ALL_ENDPOINTS, window.bucket_start, window)
+
+    @property
+    def retention(self):
+        """
+        Number of seconds windows are kept for, or `None` if they are kept
+        forever.
+        """
+        if not self.max_buckets:
+            return None
+        return self.bucket_seconds * self.max_buckets
+
+
+class TimeSeriesStore(object):
+    """
+    Time series of the stats of every function, fed by every stored session.
+    Sessions are summed into windows of the finest resolution, which are
+    rolled up into windows of the next resolution once they are older than
+    it keeps, and so on, so that the amount stored depends on the number of
+    windows kept rather than on the number of requests.
+
+    Every resolution is persisted using the backend's state API, like
+    aggregate profiles.  Sessions should be removed with :meth:`remove`
+    before they are deleted.
+
+    ``backend``:
+        Backend used to persist the series.
+    ``resolutions``:
+        Sequence of `(seconds, count)` tuples, finest first, giving the
+        length of each window and how many of them are kept.  Each length
+        must be a multiple of the previous one.  If a count is 0, every
+        window of that resolution is kept, and it isn't rolled up.
+    ``flush_interval``:
+        Number of seconds between writes of changed windows.
+    """
+
+    def __init__(self, backend, resolutions=DEFAULT_RESOLUTIONS,
+                 flush_interval=60):
+        if not resolutions:
+            raise ValueError("At least one resolution is needed")
+        seconds = [int(length) for length, count in resolutions]
+        for finer, coarser in zip(seconds, seconds[1:]):
+            if coarser <= finer or coarser % finer:
+                raise ValueError("Resolution of %ds isn't a multiple of "
+                                 "%ds" % (coarser, finer))
+
+        self.backend = backend
+        self.levels = []
+        self._rebuilder = SessionRebuilder(backend, self._add_session)
+        rollup = None
+        for length, count in reversed(resolutions):
+            rollup = RollupStore(backend, length, count, flush_interval,
+                                 rollup)
+            self.levels.insert(0, rollup)
+
+    @property
+    def resolutions(self):
+        return [level.bucket_seconds for level in self.levels]
+
+    @property
+    def default_resolution(self):
+        """
+        Resolution shown by default, which is the middle one, so that
+        changes show up over a longer time than the finest resolution keeps.
+        """
+        return self.levels[len(self.levels) // 2].bucket_seconds
+
+    def load(self):
+        """
+        Loads the series persisted by the backend.  If there are none, they
+        are rebuilt from the stored sessions on a background thread; see
+        :meth:`rebuild`.
+        """
+        for level in self.levels:
+            level.load()
+        if not any(level.list() for level in self.levels):
+            self._rebuilder.start(self.rebuild)
+
+    def rebuild(self):
+        """
+        Adds every stored session that started within the time kept by the
+        coarsest resolution, oldest first and loading them one at a time.
+        Sessions that start once this has begun are left to be added as they
+        are stored.
+        """
+        since = None
+        retention = self.levels[-1].retention
+        if retention is not None:
+            since = datetime.fromtimestamp(time.time() - retention)
+
+        count = self._rebuilder.run(since)
+        if count:
+            log.info("Rebuilt the function time series from %d sessions.",
+                     count)
+            self.flush()
+
+    def add(self, session):
+        """
+        Adds ``session`` to the finest window it started in.
+        """
+        self._rebuilder.apply(session, self._add_session)
+
+    def remove(self, session):
+        """
+        Subtracts ``session`` from the window it was added to, or the coarser
+        window that it has since been rolled up into, if either is kept.
+        """
+        return self._rebuilder.apply(session, self._remove_session,
+                                     adding=False)
+
+    def _add_session(self, session):
+        self.levels[0].add(ALL_ENDPOINTS, session_time(session), session)
+        return True
+
+    def _remove_session(self, session):
+        timestamp = session_time(session)
+        for level in self.levels:
+            if level.remove(ALL_ENDPOINTS, timestamp, session):
+                return True
+        return False
+
+    def clear(self):
+        """
+        Removes every window of every resolution.
+        """
+        for level in self.levels:
+            level.clear()
+
+    def flush(self):
+        """
+        Writes every window that changed since the last flush to the
+        backend.
+        """
+        for level in self.levels:
+            level.flush()
+
+    def close(self):
+        """
+        Stops any rebuild of the series and writing them in the background,
+        and then writes every window that changed.
+        """
+        self._rebuilder.stop()
+        for level in self.levels:
+            level.close()
+
+    def series(self, keys, resolution=None):
+        """
+        Returns the time series of each function key in ``keys`` at
+        ``resolution``, one of :attr:`resolutions`, as a dictionary of key
+        to a list of `(bucket start, values)` tuples, oldest first.  The
+        values are in the order of :data:`~linesman.callgraph.FIELDS`, and
+        windows in which a function wasn't called are left out.
+
+        The series cover the time kept by ``resolution``, and windows of
+        finer resolutions that haven't been rolled up yet are summed into
+        the window containing them.
+
+        Raises a :class:`ValueError` if ``resolution`` isn't valid.
+        """
+        if resolution is None:
+            resolution = self.default_resolution
+        if resolution not in self.resolutions:
+            raise ValueError("No resolution of %rs" % resolution)
+        index = self.resolutions.index(resolution)
+        since = self.since(resolution)
+
+        points = dict((key, {}) for key in keys)
+        for level in self.levels[:index + 1]:
+            for window in level.list(since=since):
+                start = window.bucket_start - window.bucket_start % resolution
+                for key, buckets in points.iteritems():
+                    values = window.functions.get(key)
+                    if values is None:
+                        continue
+                    totals = buckets.get(start)
+                    if totals is None:
+                        buckets[start] = list(values)
+                    else:
+                        for f, value in enumerate(values):
+                            totals[f] += value
+        return dict((key, sorted(buckets.iteritems()))
+                    for key, buckets in points.iteritems())
+
+    def since(self, resolution):
+        """
+        Returns the start, in seconds since the epoch, of the time kept by
+        ``resolution``, or `None` if every window of it is kept.
+        """
+        retention = self.levels[self.resolutions.index(resolution)].retention
+        if retention is None:
+            return None
+        return time.time() - retention
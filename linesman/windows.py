@@ -0,0 +1,388 @@
+# This file is part of linesman.
+#
+# linesman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# linesman is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with linesman.  If not, see <http://www.gnu.org/licenses/>.
+#
+import atexit
+import bisect
+import copy
+import logging
+import os
+import threading
+import time
+import weakref
+
+
+log = logging.getLogger(__name__)
+
+# Longest the background thread waits between checks for stores to flush.
+FLUSH_CHECK_INTERVAL = 1.0
+
+
+# Once ``max_endpoints`` endpoints have windows, the values of any other
+# endpoint are added to the windows of this one.
+OTHER_ENDPOINT = "<other>"
+
+
+class WindowedStore(object):
+    """
+    Base class for stores that keep an object per endpoint and window of
+    time, such as aggregate profiles, and persist them using the backend's
+    state API; see :meth:`~linesman.backends.base.Backend.save_state`.
+
+    Objects are kept in memory, and only written to the backend once every
+    ``flush_interval`` seconds, by a background thread, since writing an
+    object usually costs much more than adding a value to it.  Subclasses define :meth:`create`, and
+    the objects it returns must have `endpoint` and `bucket_start`
+    attributes, and an `add` method taking the values passed to :meth:`add`.
+
+    Objects handed out by :meth:`get` and :meth:`flush` are copied before
+    they are changed again, so that they can be read without holding the
+    lock or copying them every time.
+
+    ``backend``:
+        Backend used to persist the objects.
+    ``bucket_seconds``:
+        Length of each window, in seconds.
+    ``max_buckets``:
+        Number of windows kept per endpoint; the oldest are removed as new
+        ones are started.  If 0, every window is kept.
+    ``flush_interval``:
+        Number of seconds between writes of changed objects.  If 0, objects
+        are written by :meth:`add` as soon as they change.
+    ``max_endpoints``:
+        Number of endpoints kept; values of any endpoint past these are
+        added to the windows of :data:`OTHER_ENDPOINT` instead, so that the
+        number of objects is bounded however many endpoints there are.  If
+        0, every endpoint is kept.
+    """
+
+    #: Keys of the objects stored by the backend start with this.
+    state_prefix = None
+
+    def __init__(self, backend, bucket_seconds=3600, max_buckets=24,
+                 flush_interval=60, max_endpoints=0):
+        self.backend = backend
+        self.bucket_seconds = int(bucket_seconds)
+        self.max_buckets = int(max_buckets)
+        self.flush_interval = float(flush_interval)
+        self.max_endpoints = int(max_endpoints)
+        self._windows = {}
+        # Endpoint to a sorted list of the `(bucket_start, id)' of each of
+        # its windows, so that the oldest can be found without scanning.
+        self._buckets = {}
+        self._dirty = set()
+        # Ids of the objects that have been handed out, and must be copied
+        # before they are changed.
+        self._shared = set()
+        self._lock = threading.Lock()
+        self._last_flush = time.time()
+        # Process that this store was last registered with the flusher in.
+        self._flusher_pid = None
+
+    def create(self, endpoint, bucket_start):
+        """
+        Returns a new, empty object for ``endpoint`` and the window starting
+        at ``bucket_start``.
+
+        Raises a :class:`NotImplementedError` exception.
+        """
+        raise NotImplementedError()
+
+    def window_id(self, endpoint, bucket_start):
+        """
+        Returns the id the object of ``endpoint`` and the window starting at
+        ``bucket_start`` is kept under.
+        """
+        return (endpoint, bucket_start)
+
+    def load(self):
+        """
+        Loads the objects persisted by the backend.
+        """
+        with self._lock:
+            self._windows.clear()
+            self._buckets.clear()
+            self._dirty.clear()
+            self._shared.clear()
+            for key, window in self.backend.iter_states(self.state_prefix):
+                self._insert(self.window_id(window.endpoint,
+                                            window.bucket_start), window)
+
+    def add(self, endpoint, timestamp, *args):
+        """
+        Adds a value to the object of ``endpoint`` for the window containing
+        ``timestamp``, in seconds since the epoch.  The remaining arguments
+        are passed on to the `add` method of the object.
+        """
+        bucket_start = int(timestamp - timestamp % self.bucket_seconds)
+
+        with self._lock:
+            if self.flush_interval > 0 and self._flusher_pid != os.getpid():
+                self._flusher_pid = os.getpid()
+                _flusher.register(self)
+            if (self.max_endpoints and endpoint not in self._buckets and
+                    len(self._buckets) >= self.max_endpoints):
+                endpoint = OTHER_ENDPOINT
+            id = self.window_id(endpoint, bucket_start)
+            window = self._windows.get(id)
+            if window is None:
+                window = self.create(endpoint, bucket_start)
+                self._insert(id, window)
+                self._evict(endpoint)
+                if id not in self._windows:
+                    # The value is older than every window kept.
+                    return
+            elif id in self._shared:
+                window = self._windows[id] = copy.deepcopy(window)
+                self._shared.discard(id)
+            self._add_to(window, *args)
+            self._dirty.add(id)
+
+        if self.flush_interval <= 0:
+            self.flush()
+
+    def remove(self, endpoint, timestamp, *args):
+        """
+        Takes a value added by :meth:`add` back out of the object of
+        ``endpoint`` for the window containing ``timestamp``, if that window
+        is still kept.  The remaining arguments are passed on to the
+        `remove` method of the object.
+
+        Returns True if the window was kept.
+        """
+        bucket_start = int(timestamp - timestamp % self.bucket_seconds)
+
+        with self._lock:
+            if self.max_endpoints and endpoint not in self._buckets:
+                endpoint = OTHER_ENDPOINT
+            id = self.window_id(endpoint, bucket_start)
+            window = self._windows.get(id)
+            if window is None:
+                return False
+            if id in self._shared:
+                window = self._windows[id] = copy.deepcopy(window)
+                self._shared.discard(id)
+            self._remove_from(window, *args)
+            self._dirty.add(id)
+
+        if self.flush_interval <= 0:
+            self.flush()
+        return True
+
+    def clear(self):
+        """
+        Removes every object, here and from the backend.
+        """
+        with self._lock:
+            windows = self._windows.values()
+            self._windows.clear()
+            self._buckets.clear()
+            self._dirty.clear()
+            self._shared.clear()
+            self._on_clear()
+
+        for window in windows:
+            self.backend.delete_state(self._state_key(window))
+
+    def _evict(self, endpoint):
+        """
+        Removes the oldest windows of ``endpoint`` beyond ``max_buckets``.
+        """
+        if not self.max_buckets:
+            return
+        buckets = self._buckets[endpoint]
+        while len(buckets) > self.max_buckets:
+            self._remove(buckets[0][1])
+
+    def _insert(self, id, window):
+        """
+        Keeps ``window`` under ``id``, with the lock held.
+        """
+        self._windows[id] = window
+        bisect.insort(self._buckets.setdefault(window.endpoint, []),
+                      (window.bucket_start, id))
+
+    def _remove(self, id):
+        """
+        Removes the object kept under ``id``, here and from the backend.
+        """
+        window = self._windows.pop(id)
+        buckets = self._buckets[window.endpoint]
+        buckets.remove((window.bucket_start, id))
+        if not buckets:
+            del self._buckets[window.endpoint]
+        self._dirty.discard(id)
+        self._shared.discard(id)
+        self.backend.delete_state(self._state_key(window))
+        self._on_evict(window)
+
+    def _add_to(self, window, *args):
+        """
+        Adds the arguments of :meth:`add` to ``window``, with the lock held.
+        """
+        window.add(*args)
+
+    def _remove_from(self, window, *args):
+        """
+        Takes the arguments of :meth:`remove` out of ``window``, with the
+        lock held.
+        """
+        window.remove(*args)
+
+    def _on_clear(self):
+        """
+        Called, with the lock held, once every object has been removed by
+        :meth:`clear`.
+        """
+
+    def _on_evict(self, window):
+        """
+        Called, with the lock held, after ``window`` has been removed to make
+        room for newer ones.
+        """
+
+    def flush(self):
+        """
+        Writes every object that changed since the last flush to the
+        backend.
+        """
+        with self._lock:
+            self._last_flush = time.time()
+            # The objects are saved once the lock is released, so they are
+            # copied before they're changed again.
+            windows = [self._windows[id] for id in self._dirty]
+            self._shared.update(self._dirty)
+            self._dirty.clear()
+
+        for window in windows:
+            self.backend.save_state(self._state_key(window), window)
+
+    def flush_due(self):
+        """
+        Returns True if ``flush_interval`` seconds have passed since the last
+        flush.
+        """
+        return time.time() - self._last_flush >= self.flush_interval
+
+    def close(self):
+        """
+        Stops writing changed objects in the background, and then writes
+        any that are left.
+        """
+        _flusher.unregister(self)
+        self.flush()
+
+    def get(self, id):
+        """
+        Returns the object kept under ``id``, or `None` if there is no such
+        object.  It is never changed once it has been returned, and so
+        shouldn't be modified.
+        """
+        with self._lock:
+            window = self._windows.get(id)
+            if window is not None:
+                self._shared.add(id)
+            return window
+
+    def list(self, endpoint=None, since=None):
+        """
+        Returns every object, ordered by endpoint and then newest first.
+        The objects are shared, so they shouldn't be modified.
+
+        ``endpoint``:
+            Only include the objects of this endpoint.
+        ``since``:
+            Only include windows that end after this many seconds since the
+            epoch.
+        """
+        with self._lock:
+            windows = list(self._windows.itervalues())
+        return sorted((window for window in windows
+                       if (endpoint is None or window.endpoint == endpoint) and
+                       (since is None or
+                        window.bucket_start + self.bucket_seconds > since)),
+                      key=lambda window: (window.endpoint,
+                                          -window.bucket_start))
+
+    def _state_key(self, window):
+        return "%s%s:%d" % (self.state_prefix, window.endpoint,
+                            window.bucket_start)
+
+
+class _Flusher(object):
+    """
+    Writes the changed objects of every :class:`WindowedStore` once their
+    ``flush_interval`` has passed, on a single background thread, so that
+    adding values never waits for the backend.
+
+    The thread is started lazily, and again if the process has forked since
+    it was started, since threads do not survive a fork.  Stores are only
+    weakly referenced.
+    """
+
+    def __init__(self):
+        self._stores = weakref.WeakSet()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def register(self, store):
+        with self._lock:
+            self._stores.add(store)
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run,
+                                            name="linesman-flusher")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def unregister(self, store):
+        with self._lock:
+            self._stores.discard(store)
+
+    def _next_check(self):
+        with self._lock:
+            return min([FLUSH_CHECK_INTERVAL] +
+                       [store.flush_interval for store in self._stores])
+
+    def _run(self):
+        while not self._stop.wait(self._next_check()):
+            self._flush_due()
+
+    def _flush_due(self):
+        with self._lock:
+            stores = [store for store in self._stores if store.flush_due()]
+        for store in stores:
+            try:
+                store.flush()
+            except Exception:
+                log.exception("Failed to save the objects of %r.", store)
+
+    def stop(self):
+        """
+        Stops the background thread.
+        """
+        self._stop.set()
+        thread = self._thread
+        if thread is not None and self._pid == os.getpid():
+            thread.join()
+        self._thread = None
+        self._pid = None
+
+
+_flusher = _Flusher()
+atexit.register(_flusher.stop)
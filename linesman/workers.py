@@ -0,0 +1,148 @@
+# This file is part of linesman.
+#
+# linesman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# linesman is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with linesman.  If not, see <http://www.gnu.org/licenses/>.
+#
+import logging
+import os
+import threading
+from Queue import Empty, Full, Queue
+
+
+log = logging.getLogger(__name__)
+
+DROP_POLICIES = ("newest", "oldest", "block")
+
+
+class BackgroundWorker(object):
+    """
+    Runs jobs, in order, on a single background thread.  Jobs are buffered in
+    a bounded queue, so that a slow job--such as writing a session to
+    disk--never holds up the thread that submitted it.
+
+    The thread is started lazily, and restarted if the process has forked
+    since it was started, since threads do not survive a fork.
+
+    ``max_size``:
+        Maximum number of jobs waiting to be run.
+    ``drop_policy``:
+        What to do when the queue is full:
+
+            - `newest` discards the job being submitted.
+            - `oldest` discards the job that has been waiting the longest.
+            - `block` waits until there is room in the queue.
+    """
+
+    def __init__(self, max_size=100, drop_policy="newest"):
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError("drop_policy must be one of %s, not %r" % (
+                ", ".join(DROP_POLICIES), drop_policy))
+
+        self.max_size = int(max_size)
+        self.drop_policy = drop_policy
+        self.dropped = 0
+
+        self._queue = Queue(self.max_size)
+        self._lock = threading.Lock()
+        # Held while counting dropped jobs, and while the oldest job is
+        # swapped for a new one.
+        self._drop_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def _ensure_started(self):
+        """
+        Starts the worker thread if it is not already running in this
+        process.
+        """
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run,
+                                            name="linesman-worker")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                func, args, kwargs = job
+                func(*args, **kwargs)
+            except Exception:
+                log.exception("Background job failed.")
+            finally:
+                self._queue.task_done()
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Queues ``func`` to be called with ``args`` and ``kwargs`` on the
+        worker thread.
+
+        Returns True if the job was queued, or False if it was dropped.
+        """
+        self._ensure_started()
+        job = (func, args, kwargs)
+
+        if self.drop_policy == "block":
+            self._queue.put(job)
+            return True
+
+        while True:
+            try:
+                self._queue.put_nowait(job)
+                return True
+            except Full:
+                pass
+
+            if self.drop_policy == "newest":
+                with self._drop_lock:
+                    self.dropped += 1
+                log.debug("Background queue is full; dropping job.")
+                return False
+
+            # Make room by discarding the oldest job.  Submitters that don't
+            # hold the lock may still take the room, so try again if so.
+            with self._drop_lock:
+                try:
+                    self._queue.get_nowait()
+                except Empty:
+                    continue
+                self._queue.task_done()
+                self.dropped += 1
+                try:
+                    self._queue.put_nowait(job)
+                except Full:
+                    continue
+            log.debug("Background queue is full; dropped oldest job.")
+            return True
+
+    def flush(self):
+        """
+        Blocks until every queued job has been run.
+        """
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.join()
+
+    def close(self):
+        """
+        Runs any outstanding jobs and then stops the worker thread.
+        """
+        if self._thread is None or not self._thread.is_alive():
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None